@@ -48,14 +48,50 @@ class ExtraNetworkLora(extra_networks.ExtraNetwork):
             if not getattr(p, "is_hr_pass", False) or not hasattr(p, "lora_hashes"):
                 p.lora_hashes = {}
 
-            for item in networks.loaded_networks:
-                if item.network_on_disk.shorthash and item.mentioned_name:
-                    p.lora_hashes[item.mentioned_name.translate(self.remove_symbols)] = item.network_on_disk.shorthash
+            self.resolve_pending_hashes(p)
 
-            if p.lora_hashes:
-                p.extra_generation_params["Lora hashes"] = ', '.join(f'{k}: {v}' for k, v in p.lora_hashes.items())
+            pending = {}
+            for item in networks.loaded_networks:
+                if item.mentioned_name:
+                    pending[item.mentioned_name.translate(self.remove_symbols)] = item.network_on_disk
+                    item.network_on_disk.read_hash()
+
+            if any(network_on_disk.hash_future is not None for network_on_disk in pending.values()):
+                # hashes are still calculated in background; they are collected when infotext is first created, after sampling
+                p.extra_generation_params["Lora hashes"] = lambda **kwargs: self.resolve_hashes(p, pending)
+            else:
+                self.resolve_hashes(p, pending)
+
+    @staticmethod
+    def resolve_hashes(p, pending):
+        """
+        Waits for hashes of networks in pending, a mapping of names to NetworkOnDisk, adds them to p.lora_hashes as strings, and
+        sets "Lora hashes" in p.extra_generation_params to plain text.
+        """
+
+        for name, network_on_disk in pending.items():
+            shorthash = network_on_disk.wait_for_hash()
+            if shorthash:
+                p.lora_hashes[name] = shorthash
+
+        text = ', '.join(f'{k}: {v}' for k, v in p.lora_hashes.items()) or None
+        if text:
+            p.extra_generation_params["Lora hashes"] = text
+
+        return text
+
+    @staticmethod
+    def resolve_pending_hashes(p):
+        """Replaces "Lora hashes" in p.extra_generation_params with plain text if it is still waiting for hashes, so that it can be serialized."""
+
+        value = p.extra_generation_params.get("Lora hashes")
+        if callable(value):
+            del p.extra_generation_params["Lora hashes"]
+            value()
 
     def deactivate(self, p):
+        self.resolve_pending_hashes(p)
+
         if self.errors:
             p.comment("Networks with errors: " + ", ".join(f"{k} ({v})" for k, v in self.errors.items()))
 
@@ -6,7 +6,7 @@ import enum
 import torch.nn as nn
 import torch.nn.functional as F
 
-from modules import sd_models, cache, errors, hashes, shared
+from modules import errors, hashes, shared, safetensors_index
 import modules.models.sd3.mmdit
 
 NetworkWeights = namedtuple('NetworkWeights', ['network_key', 'sd_key', 'w', 'sd_module'])
@@ -27,15 +27,13 @@ class NetworkOnDisk:
         self.filename = filename
         self.metadata = {}
         self.is_safetensors = os.path.splitext(filename)[1].lower() == ".safetensors"
-
-        def read_metadata():
-            metadata = sd_models.read_metadata_from_safetensors(filename)
-
-            return metadata
+        self.header_sd_version = "Unknown"
 
         if self.is_safetensors:
             try:
-                self.metadata = cache.cached_data_for_file('safetensors-metadata', "lora/" + self.name, filename, read_metadata)
+                header = safetensors_index.get(filename)
+                self.metadata = header["metadata"]
+                self.header_sd_version = header["sd_version"]
             except Exception as e:
                 errors.display(e, f"reading lora {filename}")
 
@@ -50,6 +48,7 @@ class NetworkOnDisk:
 
         self.hash = None
         self.shorthash = None
+        self.hash_future = None
         self.set_hash(
             self.metadata.get('sshs_model_hash') or
             hashes.sha256_from_cache(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or
@@ -66,7 +65,8 @@ class NetworkOnDisk:
         elif len(self.metadata):
             return SdVersion.SD1
 
-        return SdVersion.Unknown
+        # files without trainer metadata; the version is guessed from names of tensors
+        return SdVersion.__members__.get(self.header_sd_version, SdVersion.Unknown)
 
     def set_hash(self, v):
         self.hash = v
@@ -77,8 +77,31 @@ class NetworkOnDisk:
             networks.available_network_hash_lookup[self.shorthash] = self
 
     def read_hash(self):
-        if not self.hash:
-            self.set_hash(hashes.sha256(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors) or '')
+        """Starts calculating the hash in background if it's not known; use wait_for_hash() to get the result."""
+
+        if not self.hash and self.hash_future is None:
+            self.hash_future = hashes.sha256_async(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors, priority=hashes.PRIORITY_REQUEST)
+            self.hash_future.add_done_callback(self.set_hash_from_future)
+
+    def set_hash_from_future(self, future):
+        if future.exception() is None:
+            self.set_hash(future.result() or '')
+
+        self.hash_future = None
+
+    def wait_for_hash(self):
+        """Returns shorthash, waiting for the hash to be calculated if it's still in progress; the hash is moved ahead of files that are hashed in advance."""
+
+        future = self.hash_future
+        if future is not None:
+            if not future.done():
+                hashes.sha256_async(self.filename, "lora/" + self.name, use_addnet_hash=self.is_safetensors, priority=hashes.PRIORITY_IMMEDIATE)
+
+            # done callbacks run after waiters are woken up, so set_hash_from_future may not have run yet
+            if future.exception() is None:
+                self.set_hash(future.result() or '')
+
+        return self.shorthash
 
     def get_alias(self):
         import networks
@@ -18,7 +18,7 @@ import network_oft
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, sd_hijack_clip, hashes, safetensors_index, step_profiler, metrics
 import modules.textual_inversion.textual_inversion as textual_inversion
 import modules.models.sd3.mmdit
 
@@ -270,6 +270,10 @@ def load_network(name, network_on_disk):
     return net
 
 
+def collect_metrics():
+    metrics.cache_entries.set(len(networks_in_memory), cache="lora")
+
+
 def purge_networks_from_memory():
     while len(networks_in_memory) > shared.opts.lora_in_memory_limit and len(networks_in_memory) > 0:
         name = next(iter(networks_in_memory))
@@ -317,6 +321,8 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
                 net = networks_in_memory.get(name)
 
             if net is None or os.path.getmtime(network_on_disk.filename) > net.mtime:
+                metrics.cache_lookups_total.inc(cache="lora", result="miss")
+
                 try:
                     net = load_network(name, network_on_disk)
 
@@ -325,6 +331,8 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
                 except Exception as e:
                     errors.display(e, f"loading network {network_on_disk.filename}")
                     continue
+            else:
+                metrics.cache_lookups_total.inc(cache="lora", result="hit")
 
             net.mentioned_name = name
 
@@ -363,6 +371,9 @@ def load_networks(names, te_multipliers=None, unet_multipliers=None, dyn_dims=No
         if shared.opts.lora_not_found_gradio_warning:
             gr.Warning(lora_not_found_message)
 
+    # text encoder outputs cached by sd_hijack_clip are only valid for the same set of LoRAs
+    sd_hijack_clip.text_encoder_weights_keys["lora"] = tuple((x.name, x.mtime, x.te_multiplier, x.dyn_dim) for x in loaded_networks if x.te_multiplier != 0)
+
     purge_networks_from_memory()
 
 
@@ -415,6 +426,24 @@ def network_apply_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn
     If not, restores original weights from backup and alters weights according to networks.
     """
 
+    if getattr(self, 'network_layer_name', None) is None:
+        return
+
+    current_names = getattr(self, "network_current_names", ())
+    wanted_names = tuple((x.name, x.te_multiplier, x.unet_multiplier, x.dyn_dim) for x in loaded_networks)
+    if current_names == wanted_names:
+        return
+
+    network_patch_weights(self)
+
+
+@step_profiler.timed("lora patching")
+def network_patch_weights(self: Union[torch.nn.Conv2d, torch.nn.Linear, torch.nn.GroupNorm, torch.nn.LayerNorm, torch.nn.MultiheadAttention]):
+    """
+    Does the work of network_apply_weights for a layer whose weights do not have the currently selected set of networks
+    applied: makes backups of original weights if needed, restores them, and alters weights according to networks.
+    """
+
     network_layer_name = getattr(self, 'network_layer_name', None)
     if network_layer_name is None:
         return
@@ -671,6 +700,13 @@ def process_network_files(names: list[str] | None = None):
         available_network_aliases[name] = entry
         available_network_aliases[entry.alias] = entry
 
+    if not names:
+        safetensors_index.forget_missing(candidates, [shared.cmd_opts.lora_dir, shared.cmd_opts.lyco_dir_backcompat])
+
+
+def prewarm_hashes():
+    hashes.prewarm((x.filename, "lora/" + x.name, x.is_safetensors) for x in available_networks.values())
+
 
 def update_available_networks_by_names(names: list[str]):
     process_network_files(names)
@@ -735,3 +771,4 @@ available_network_hash_lookup = {}
 forbidden_network_aliases = {}
 
 list_available_networks()
+metrics.add_collector(collect_metrics)
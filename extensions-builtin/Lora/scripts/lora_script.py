@@ -26,6 +26,9 @@ def before_ui():
 
 networks.originals = lora_patches.LoraPatches()
 
+if shared.cmd_opts.prewarm_hashes:
+    networks.prewarm_hashes()
+
 script_callbacks.on_model_loaded(networks.assign_network_names_to_compvis_modules)
 script_callbacks.on_script_unloaded(unload)
 script_callbacks.on_before_ui(before_ui)
@@ -48,7 +48,6 @@ class UpscalerScuNET(modules.upscaler.Upscaler):
             model,
             tile_size=shared.opts.SCUNET_tile,
             tile_overlap=shared.opts.SCUNET_tile_overlap,
-            scale=1,  # ScuNET is a denoising model, not an upscaler
             desc='ScuNET',
         )
         devices.torch_gc()
@@ -51,7 +51,6 @@ class UpscalerSwinIR(Upscaler):
             model,
             tile_size=shared.opts.SWIN_tile,
             tile_overlap=shared.opts.SWIN_tile_overlap,
-            scale=model.scale,
             desc="SwinIR",
         )
         devices.torch_gc()
@@ -254,7 +254,7 @@ def weighted_histogram_filter(img, kernel, kernel_center, percentile_min=0.0, pe
         img (nparray):
             The image, a 2-D array of floats, to which the filter is being applied.
         kernel (nparray):
-            The kernel, a 2-D array of floats.
+            The kernel, a 2-D array of non-negative floats.
         kernel_center (nparray):
             The kernel center coordinate, a 1-D array with two elements.
         percentile_min (float):
@@ -271,103 +271,62 @@ def weighted_histogram_filter(img, kernel, kernel_center, percentile_min=0.0, pe
         (nparray): A filtered copy of the input image "img", a 2-D array of floats.
     """
 
-    # Converts an index tuple into a vector.
-    def vec(x):
-        return np.array(x)
-
-    kernel_min = -kernel_center
-    kernel_max = vec(kernel.shape) - kernel_center
-
-    def weighted_histogram_filter_single(idx):
-        idx = vec(idx)
-        min_index = np.maximum(0, idx + kernel_min)
-        max_index = np.minimum(vec(img.shape), idx + kernel_max)
-        window_shape = max_index - min_index
-
-        class WeightedElement:
-            """
-            An element of the histogram, its weight
-            and bounds.
-            """
-
-            def __init__(self, value, weight):
-                self.value: float = value
-                self.weight: float = weight
-                self.window_min: float = 0.0
-                self.window_max: float = 1.0
-
-        # Collect the values in the image as WeightedElements,
-        # weighted by their corresponding kernel values.
-        values = []
-        for window_tup in np.ndindex(tuple(window_shape)):
-            window_index = vec(window_tup)
-            image_index = window_index + min_index
-            centered_kernel_index = image_index - idx
-            kernel_index = centered_kernel_index + kernel_center
-            element = WeightedElement(img[tuple(image_index)], kernel[tuple(kernel_index)])
-            values.append(element)
-
-        def sort_key(x: WeightedElement):
-            return x.value
-
-        values.sort(key=sort_key)
-
-        # Calculate the height of the stack (sum)
-        # and each sample's range they occupy in the stack
-        sum = 0
-        for i in range(len(values)):
-            values[i].window_min = sum
-            sum += values[i].weight
-            values[i].window_max = sum
-
-        # Calculate what range of this stack ("window")
-        # we want to get the weighted average across.
-        window_min = sum * percentile_min
-        window_max = sum * percentile_max
-        window_width = window_max - window_min
-
-        # Ensure the window is within the stack and at least a certain size.
-        if window_width < min_width:
-            window_center = (window_min + window_max) / 2
-            window_min = window_center - min_width / 2
-            window_max = window_center + min_width / 2
-
-            if window_max > sum:
-                window_max = sum
-                window_min = sum - min_width
-
-            if window_min < 0:
-                window_min = 0
-                window_max = min_width
-
-        value = 0
-        value_weight = 0
-
-        # Get the weighted average of all the samples
-        # that overlap with the window, weighted
-        # by the size of their overlap.
-        for i in range(len(values)):
-            if window_min >= values[i].window_max:
-                continue
-            if window_max <= values[i].window_min:
-                break
-
-            s = max(window_min, values[i].window_min)
-            e = min(window_max, values[i].window_max)
-            w = e - s
-
-            value += values[i].value * w
-            value_weight += w
-
-        return value / value_weight if value_weight != 0 else 0
-
-    img_out = img.copy()
-
-    # Apply the kernel operation over each pixel.
-    for index in np.ndindex(img.shape):
-        img_out[index] = weighted_histogram_filter_single(index)
-
-    return img_out
+    # Every pixel's neighbourhood becomes one row of a (height, width, kernel size) array,
+    # so that all pixels are filtered at once. Cells of the kernel that fall outside
+    # of the image get a weight of 0, which makes them take no space in the stack.
+    center_y, center_x = np.broadcast_to(kernel_center, (2,))
+    pad = ((center_y, kernel.shape[0] - 1 - center_y), (center_x, kernel.shape[1] - 1 - center_x))
+
+    def windows(x):
+        x = np.lib.stride_tricks.sliding_window_view(np.pad(x, pad), kernel.shape)
+        return x.reshape(img.shape + (kernel.size,))
+
+    values = windows(img.astype(np.float64))
+    weights = windows(np.ones(img.shape)) * kernel.astype(np.float64).reshape(-1)
+
+    # Sort the samples of every pixel by value, keeping their weights.
+    order = np.argsort(values, axis=-1, kind="stable")
+    values = np.take_along_axis(values, order, axis=-1)
+    weights = np.take_along_axis(weights, order, axis=-1)
+
+    # Calculate the height of the stack (sum)
+    # and each sample's range they occupy in the stack
+    stack_max = np.cumsum(weights, axis=-1)
+    stack_min = np.concatenate([np.zeros(img.shape + (1,)), stack_max[..., :-1]], axis=-1)
+    total = stack_max[..., -1]
+
+    # Calculate what range of this stack ("window")
+    # we want to get the weighted average across.
+    window_min = total * percentile_min
+    window_max = total * percentile_max
+    window_width = window_max - window_min
+
+    # Ensure the window is within the stack and at least a certain size.
+    narrow = window_width < min_width
+    window_center = (window_min + window_max) / 2
+    window_min = np.where(narrow, window_center - min_width / 2, window_min)
+    window_max = np.where(narrow, window_center + min_width / 2, window_max)
+
+    above = narrow & (window_max > total)
+    window_max = np.where(above, total, window_max)
+    window_min = np.where(above, total - min_width, window_min)
+
+    below = narrow & (window_min < 0)
+    window_min = np.where(below, 0, window_min)
+    window_max = np.where(below, min_width, window_max)
+
+    # Get the weighted average of all the samples
+    # that overlap with the window, weighted
+    # by the size of their overlap.
+    overlap = np.minimum(window_max[..., None], stack_max) - np.maximum(window_min[..., None], stack_min)
+    overlap = np.maximum(overlap, 0)
+
+    value = (values * overlap).sum(axis=-1)
+    value_weight = overlap.sum(axis=-1)
+
+    img_out = np.divide(value, value_weight, out=np.zeros_like(value), where=value_weight != 0)
+
+    return img_out.astype(img.dtype)
 
 
 def smoothstep(x):
@@ -1,32 +1,43 @@
+import asyncio
 import base64
+import collections
+import copy
 import io
+import json
+import mimetypes
 import os
+import queue
+import threading
 import time
+import uuid
 import datetime
 import uvicorn
 import ipaddress
 import requests
 import gradio as gr
 from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, sd_schedulers
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, ui_common, infotext_utils, sd_models, sd_schedulers, hashes, sd_models_prefetch, step_profiler, metrics, infotext_index
 from modules.api import models
 from modules.shared import opts
-from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
+from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images, get_fixed_seed
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
 from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
-from PIL import PngImagePlugin
+from PIL import Image, PngImagePlugin
+from pydantic import BaseModel
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
-from modules import devices
+from modules import devices, paths_internal, lowvram
 from typing import Any
 import piexif
 import piexif.helper
@@ -55,6 +66,22 @@ def setUpscalers(req: dict):
     return reqDict
 
 
+extras_stream_lookahead = 4
+"""how many images extra-batch-images-stream endpoint keeps decoded in advance, and how many finished ones it lets wait to be sent"""
+
+stream_client_timeout = 300
+"""how long, in seconds, streaming endpoints wait for the client to take a result before giving up on the request"""
+
+
+def encode_extras_stream_item(index, name, processed):
+    return models.ExtrasStreamItem(
+        index=index,
+        name=name,
+        images=[encode_pil_to_base64(image) for image, _ in processed],
+        html_info=ui_common.plaintext_to_html(processed[-1][1]) if processed else "",
+    )
+
+
 def verify_url(url):
     """Returns True if the url refers to a global resource."""
 
@@ -75,6 +102,14 @@ def verify_url(url):
 
 
 def decode_base64_to_image(encoding):
+    try:
+        stored_image = find_api_image(encoding)
+    except StoredImageNotFound as e:
+        raise HTTPException(status_code=404, detail="Stored image not found or expired") from e
+
+    if stored_image is not None:
+        return images.read(stored_image)
+
     if encoding.startswith("http://") or encoding.startswith("https://"):
         if not opts.api_enable_requests:
             raise HTTPException(status_code=500, detail="Requests not allowed")
@@ -100,9 +135,16 @@ def decode_base64_to_image(encoding):
 
 
 def encode_pil_to_base64(image):
+    if isinstance(image, str):
+        return image
+
+    return base64.b64encode(encode_pil_to_bytes(image))
+
+
+def encode_pil_to_bytes(image):
+    """Encodes the image in samples_format, keeping its generation parameters."""
+
     with io.BytesIO() as output_bytes:
-        if isinstance(image, str):
-            return image
         if opts.samples_format.lower() == 'png':
             use_metadata = False
             metadata = PngImagePlugin.PngInfo()
@@ -127,9 +169,133 @@ def encode_pil_to_base64(image):
         else:
             raise HTTPException(status_code=500, detail="Invalid image format")
 
-        bytes_data = output_bytes.getvalue()
+        return output_bytes.getvalue()
+
+
+image_transports = ["base64", "binary", "path", "url"]
+
+api_images_dir = os.path.join(paths_internal.default_output_dir, "api-images")
+"""where images returned by reference, and images uploaded to /sdapi/v1/images, are stored until they expire"""
+
+api_images_url = "/sdapi/v1/images/"
+
+
+def get_image_transport(request: Request | None):
+    """
+    Returns how images should be sent back: as base64 strings in JSON (base64), as parts of a multipart/form-data response (binary),
+    or as references to stored files, either paths (path) or URLs (url). Chosen by X-Image-Transport request header, or by api_image_transport setting.
+    """
+
+    transport = request.headers.get("x-image-transport") if request is not None else None
+    transport = transport or opts.api_image_transport
+
+    if transport not in image_transports:
+        raise HTTPException(status_code=422, detail=f"Unknown image transport: {transport}; must be one of: {', '.join(image_transports)}")
+
+    return transport
+
+
+api_images_sweep_interval = 60
+"""minimum time, in seconds, between scans of api_images_dir for expired images; expired images are not served even before they are removed"""
+
+api_images_next_sweep = 0
+api_images_sweep_lock = Lock()
+
+
+def remove_expired_api_images():
+    """Removes stored images older than api_image_reference_ttl; does nothing if it was done less than api_images_sweep_interval seconds ago."""
+
+    global api_images_next_sweep
+
+    now = time.time()
+    with api_images_sweep_lock:
+        if now < api_images_next_sweep:
+            return
+
+        api_images_next_sweep = now + api_images_sweep_interval
+
+    if not os.path.isdir(api_images_dir):
+        return
+
+    expire_before = time.time() - opts.api_image_reference_ttl
+    for entry in os.scandir(api_images_dir):
+        try:
+            if entry.stat().st_mtime < expire_before:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def store_api_image(data: bytes, extension: str, transport: str):
+    """Writes encoded image into api_images_dir, and returns a reference to it: a path or a URL depending on transport."""
+
+    remove_expired_api_images()
+    os.makedirs(api_images_dir, exist_ok=True)
+
+    filename = os.path.join(api_images_dir, f"{uuid.uuid4().hex}.{extension}")
+    with open(filename, "wb") as file:
+        file.write(data)
+
+    return os.path.abspath(filename) if transport == "path" else api_images_url + os.path.basename(filename)
+
+
+class StoredImageNotFound(Exception):
+    """Raised by find_api_image for a reference to a stored image that does not exist or has expired."""
+
+
+def find_api_image(reference: str):
+    """
+    Returns the filename of a stored image that reference (a path or a URL returned by store_api_image) refers to, or None if
+    it does not refer to one. Raises StoredImageNotFound if the image is gone.
+    """
+
+    if reference.startswith(api_images_url):
+        name = reference[len(api_images_url):]
+    elif os.path.isabs(reference) and os.path.dirname(os.path.abspath(reference)) == os.path.abspath(api_images_dir):
+        name = os.path.basename(reference)
+    else:
+        return None
+
+    filename = os.path.join(api_images_dir, name)
+    if os.path.basename(name) != name or not os.path.isfile(filename) or os.path.getmtime(filename) < time.time() - opts.api_image_reference_ttl:
+        raise StoredImageNotFound(reference)
+
+    return filename
+
+
+def multipart_response(response: BaseModel, images):
+    """Makes a multipart/form-data response with response model as JSON in the first part, named "info", followed by encoded images, named "image"."""
+
+    boundary = uuid.uuid4().hex
+    extension = opts.samples_format.lower()
+    content_type = mimetypes.guess_type(f"image.{extension}")[0] or "application/octet-stream"
 
-    return base64.b64encode(bytes_data)
+    parts = [(b'Content-Disposition: form-data; name="info"\r\nContent-Type: application/json\r\n\r\n', response.json().encode("utf8"))]
+    for i, image in enumerate(images):
+        headers = f'Content-Disposition: form-data; name="image"; filename="{i:05}.{extension}"\r\nContent-Type: {content_type}\r\n\r\n'
+        parts.append((headers.encode("utf8"), encode_pil_to_bytes(image)))
+
+    body = b"".join(b"--" + boundary.encode() + b"\r\n" + headers + data + b"\r\n" for headers, data in parts) + b"--" + boundary.encode() + b"--\r\n"
+
+    return Response(content=body, media_type=f"multipart/form-data; boundary={boundary}")
+
+
+def images_response(request: Request | None, response: BaseModel, images, field="images"):
+    """Puts images into the specified field of response model using transport chosen by get_image_transport, and returns what the endpoint should return."""
+
+    transport = get_image_transport(request)
+
+    if transport == "binary":
+        return multipart_response(response, images)
+
+    if transport == "base64":
+        encoded = [encode_pil_to_base64(image) for image in images]
+    else:
+        encoded = [store_api_image(encode_pil_to_bytes(image), opts.samples_format.lower(), transport) for image in images]
+
+    setattr(response, field, encoded if field == "images" else next(iter(encoded), None))
+
+    return response
 
 
 def api_middleware(app: FastAPI):
@@ -196,6 +362,84 @@ def api_middleware(app: FastAPI):
         return handle_exception(request, e)
 
 
+txt2img_batch_item_fields = {'prompt', 'negative_prompt', 'hr_prompt', 'hr_negative_prompt', 'seed', 'subseed', 'force_task_id'}
+
+
+def txt2img_batch_key(args):
+    """Returns a string that is the same for txt2img requests that only differ in prompts and seeds, and can be batched together."""
+
+    return json.dumps({k: v for k, v in args.items() if k not in txt2img_batch_item_fields}, sort_keys=True, default=str)
+
+
+class BatchItem:
+    def __init__(self, task_id, args, script_args):
+        self.task_id = task_id
+        self.args = args
+        self.script_args = script_args
+        self.size = args.get('batch_size') or 1
+        self.future = Future()
+
+
+class PendingBatch:
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.closed = threading.Event()
+
+
+class DynamicBatcher:
+    """
+    Collects compatible requests arriving within api_dynamic_batching_window milliseconds of each other so that they can be
+    processed as one batch. The first request of a batch waits for the window to pass or for the batch to fill up, and then runs
+    all collected requests by calling run(items), which must set the result for each item's future. Other requests of the batch
+    wait for their results.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.lock = threading.Lock()
+        self.open_batches = {}
+
+    def close(self, key, batch):
+        if self.open_batches.get(key) is batch:
+            del self.open_batches[key]
+
+        batch.closed.set()
+
+    def submit(self, key, item):
+        with self.lock:
+            batch = self.open_batches.get(key)
+            if batch is not None and batch.size + item.size > opts.api_dynamic_batching_max_size:
+                self.close(key, batch)
+                batch = None
+
+            is_first = batch is None
+            if is_first:
+                batch = PendingBatch()
+                self.open_batches[key] = batch
+
+            batch.items.append(item)
+            batch.size += item.size
+
+            if batch.size >= opts.api_dynamic_batching_max_size:
+                self.close(key, batch)
+
+        if is_first:
+            batch.closed.wait(opts.api_dynamic_batching_window / 1000)
+
+            with self.lock:
+                self.close(key, batch)
+
+            try:
+                self.run(batch.items)
+            except Exception as e:
+                for x in batch.items:
+                    if not x.future.done():
+                        x.future.set_exception(e)
+
+        return item.future.result()
+
+
 class Api:
     def __init__(self, app: FastAPI, queue_lock: Lock):
         if shared.cmd_opts.api_auth:
@@ -207,14 +451,21 @@ class Api:
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.txt2img_batcher = DynamicBatcher(self.run_txt2img_batch)
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
+        self.add_api_route("/sdapi/v1/extra-batch-images-stream", self.extras_batch_images_stream_api, methods=["POST"])
+        self.add_api_route("/sdapi/v1/images", self.upload_images_api, methods=["POST"], response_model=models.StoredImagesResponse)
+        self.add_api_route("/sdapi/v1/images/{name}", self.get_stored_image_api, methods=["GET"])
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
+        self.add_api_route("/sdapi/v1/infotext-index/query", self.infotext_index_query, methods=["POST"], response_model=models.InfotextIndexQueryResponse)
+        self.add_api_route("/sdapi/v1/infotext-index/refresh", self.infotext_index_refresh, methods=["POST"], response_model=models.InfotextIndexRefreshResponse)
         self.add_api_route("/sdapi/v1/progress", self.progressapi, methods=["GET"], response_model=models.ProgressResponse)
         self.add_api_route("/sdapi/v1/interrogate", self.interrogateapi, methods=["POST"])
+        self.add_api_route("/sdapi/v1/interrogate-batch-stream", self.interrogate_batch_stream_api, methods=["POST"])
         self.add_api_route("/sdapi/v1/interrupt", self.interruptapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/skip", self.skip, methods=["POST"])
         self.add_api_route("/sdapi/v1/options", self.get_config, methods=["GET"], response_model=models.OptionsModel)
@@ -225,6 +476,8 @@ class Api:
         self.add_api_route("/sdapi/v1/upscalers", self.get_upscalers, methods=["GET"], response_model=list[models.UpscalerItem])
         self.add_api_route("/sdapi/v1/latent-upscale-modes", self.get_latent_upscale_modes, methods=["GET"], response_model=list[models.LatentUpscalerModeItem])
         self.add_api_route("/sdapi/v1/sd-models", self.get_sd_models, methods=["GET"], response_model=list[models.SDModelItem])
+        self.add_api_route("/sdapi/v1/sd-models/hash-progress", self.get_hash_progress, methods=["GET"], response_model=list[models.HashProgressItem])
+        self.add_api_route("/sdapi/v1/sd-models/residency", self.get_model_residency, methods=["GET"], response_model=models.ResidencyResponse)
         self.add_api_route("/sdapi/v1/sd-vae", self.get_sd_vaes, methods=["GET"], response_model=list[models.SDVaeItem])
         self.add_api_route("/sdapi/v1/hypernetworks", self.get_hypernetworks, methods=["GET"], response_model=list[models.HypernetworkItem])
         self.add_api_route("/sdapi/v1/face-restorers", self.get_face_restorers, methods=["GET"], response_model=list[models.FaceRestorerItem])
@@ -239,6 +492,8 @@ class Api:
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/profile", self.get_profile, methods=["GET"], response_model=models.ProfileResponse)
+        self.add_api_route("/metrics", self.get_metrics, methods=["GET"], response_class=PlainTextResponse)
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
@@ -429,7 +684,22 @@ class Api:
 
         return params
 
-    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+    def job_lock(self, task_id, args):
+        """Returns the context manager for holding queue_lock while running a generation job, telling the scheduler what the job needs so it can be grouped with similar ones."""
+
+        if not hasattr(self.queue_lock, 'job'):
+            return self.queue_lock
+
+        override_settings = args.get('override_settings') or {}
+
+        checkpoint_name = override_settings.get('sd_model_checkpoint') or opts.sd_model_checkpoint
+        checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint_name) if checkpoint_name else None
+        checkpoint = checkpoint_info.filename if checkpoint_info else checkpoint_name
+        vae = override_settings.get('sd_vae', opts.sd_vae)
+
+        return self.queue_lock.job(task_id=task_id, key=(checkpoint, vae, args.get('width'), args.get('height')))
+
+    def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI, request: Request = None):
         task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
 
         script_runner = scripts.scripts_txt2img
@@ -464,32 +734,109 @@ class Api:
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
-            with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
-                p.is_api = True
-                p.scripts = script_runner
-                p.outpath_grids = opts.outdir_txt2img_grids
-                p.outpath_samples = opts.outdir_txt2img_samples
+        with sd_models_prefetch.prefetcher.task(task_id, (args.get('override_settings') or {}).get('sd_model_checkpoint')):
+            if opts.api_dynamic_batching and selectable_scripts is None and not txt2imgreq.alwayson_scripts and not txt2imgreq.infotext and args.get('n_iter', 1) == 1:
+                item = BatchItem(task_id, args, script_args)
+                processed = self.txt2img_batcher.submit(txt2img_batch_key(args), item)
+            else:
+                with self.job_lock(task_id, args):
+                    processed = self.run_txt2img([task_id], args, script_args, selectable_scripts)
 
-                try:
-                    shared.state.begin(job="scripts_txt2img")
-                    start_task(task_id)
-                    if selectable_scripts is not None:
-                        p.script_args = script_args
-                        processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
-                    else:
-                        p.script_args = tuple(script_args) # Need to pass args as tuple here
-                        processed = process_images(p)
-                    finish_task(task_id)
-                finally:
-                    shared.state.end()
-                    shared.total_tqdm.clear()
+        response = models.TextToImageResponse(images=[], parameters=vars(txt2imgreq), info=processed.js())
+
+        return images_response(request, response, processed.images if send_images else [])
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+    def run_txt2img(self, task_ids, args, script_args, selectable_scripts=None):
+        """Runs txt2img for one or more tasks (more than one if requests were batched together); must be called with queue_lock held."""
 
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
+        for task_id in reversed(task_ids):
+            sd_models_prefetch.prefetcher.start_task(task_id)
 
-    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
+            p.is_api = True
+            p.scripts = scripts.scripts_txt2img
+            p.outpath_grids = opts.outdir_txt2img_grids
+            p.outpath_samples = opts.outdir_txt2img_samples
+
+            try:
+                shared.state.begin(job="scripts_txt2img")
+                for task_id in reversed(task_ids):
+                    start_task(task_id)
+                if selectable_scripts is not None:
+                    p.script_args = script_args
+                    processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
+                else:
+                    p.script_args = tuple(script_args) # Need to pass args as tuple here
+                    processed = process_images(p)
+                for task_id in task_ids:
+                    finish_task(task_id)
+            finally:
+                shared.state.end()
+                shared.total_tqdm.clear()
+
+        return processed
+
+    def run_txt2img_batch(self, items):
+        """Runs txt2img requests collected by txt2img_batcher as a single job, and splits the results between them."""
+
+        args = dict(items[0].args)
+        subseed_strength = args.get('subseed_strength') or 0
+
+        prompts, negative_prompts, hr_prompts, hr_negative_prompts, seeds, subseeds = [], [], [], [], [], []
+        for item in items:
+            seed = get_fixed_seed(item.args.get('seed'))
+            subseed = get_fixed_seed(item.args.get('subseed'))
+
+            prompts += [item.args.get('prompt') or ''] * item.size
+            negative_prompts += [item.args.get('negative_prompt') or ''] * item.size
+            hr_prompts += [item.args.get('hr_prompt') or item.args.get('prompt') or ''] * item.size
+            hr_negative_prompts += [item.args.get('hr_negative_prompt') or item.args.get('negative_prompt') or ''] * item.size
+            seeds += [int(seed) + (x if subseed_strength == 0 else 0) for x in range(item.size)]
+            subseeds += [int(subseed) + x for x in range(item.size)]
+
+        args.update(prompt=prompts, negative_prompt=negative_prompts, hr_prompt=hr_prompts, hr_negative_prompt=hr_negative_prompts, seed=seeds, subseed=subseeds, batch_size=len(prompts))
+
+        task_ids = [item.task_id for item in items]
+        with self.job_lock(task_ids[0], args):
+            processed = self.run_txt2img(task_ids, args, items[0].script_args)
+
+        first = processed.index_of_first_image
+        batch_images = processed.images[first:]
+        infotexts = processed.infotexts[first:]
+
+        offset = 0
+        for item in items:
+            part = copy.copy(processed)
+            part.images = batch_images[offset:offset + item.size]
+            part.infotexts = infotexts[offset:offset + item.size]
+            part.extra_generation_params = dict(processed.extra_generation_params)
+            part.profile = copy.deepcopy(processed.profile)
+            part.all_prompts = processed.all_prompts[offset:offset + item.size]
+            part.all_negative_prompts = processed.all_negative_prompts[offset:offset + item.size]
+            part.all_seeds = processed.all_seeds[offset:offset + item.size]
+            part.all_subseeds = processed.all_subseeds[offset:offset + item.size]
+            part.seed = part.all_seeds[0]
+            part.subseed = part.all_subseeds[0]
+            part.prompt = part.all_prompts[0]
+            part.negative_prompt = part.all_negative_prompts[0]
+            part.info = part.infotexts[0] if part.infotexts else processed.info
+            part.batch_size = item.size
+            part.index_of_first_image = 0
+
+            # the merged job made one grid of all images; each request gets a grid of its own images instead
+            if first > 0 and (item.size > 1 or not opts.grid_only_if_multiple):
+                grid = images.image_grid(part.images, item.size)
+                if opts.enable_pnginfo:
+                    grid.info["parameters"] = part.info
+
+                part.images = [grid, *part.images]
+                part.infotexts = [part.info, *part.infotexts]
+                part.index_of_first_image = 1
+
+            item.future.set_result(part)
+            offset += item.size
+
+    def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI, request: Request = None):
         task_id = img2imgreq.force_task_id or create_task_id("img2img")
 
         init_images = img2imgreq.init_images
@@ -534,7 +881,9 @@ class Api:
 
         add_task_to_queue(task_id)
 
-        with self.queue_lock:
+        with sd_models_prefetch.prefetcher.task(task_id, (args.get('override_settings') or {}).get('sd_model_checkpoint')), self.job_lock(task_id, args):
+            sd_models_prefetch.prefetcher.start_task(task_id)
+
             with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
                 p.init_images = [decode_base64_to_image(x) for x in init_images]
                 p.is_api = True
@@ -556,15 +905,15 @@ class Api:
                     shared.state.end()
                     shared.total_tqdm.clear()
 
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
 
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        response = models.ImageToImageResponse(images=[], parameters=vars(img2imgreq), info=processed.js())
 
-    def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
+        return images_response(request, response, processed.images if send_images else [])
+
+    def extras_single_image_api(self, req: models.ExtrasSingleImageRequest, request: Request = None):
         reqDict = setUpscalers(req)
 
         reqDict['image'] = decode_base64_to_image(reqDict['image'])
@@ -572,9 +921,9 @@ class Api:
         with self.queue_lock:
             result = postprocessing.run_extras(extras_mode=0, image_folder="", input_dir="", output_dir="", save_output=False, **reqDict)
 
-        return models.ExtrasSingleImageResponse(image=encode_pil_to_base64(result[0][0]), html_info=result[1])
+        return images_response(request, models.ExtrasSingleImageResponse(html_info=result[1]), result[0][:1], field="image")
 
-    def extras_batch_images_api(self, req: models.ExtrasBatchImagesRequest):
+    def extras_batch_images_api(self, req: models.ExtrasBatchImagesRequest, request: Request = None):
         reqDict = setUpscalers(req)
 
         image_list = reqDict.pop('imageList', [])
@@ -583,7 +932,256 @@ class Api:
         with self.queue_lock:
             result = postprocessing.run_extras(extras_mode=1, image_folder=image_folder, image="", input_dir="", output_dir="", save_output=False, **reqDict)
 
-        return models.ExtrasBatchImagesResponse(images=list(map(encode_pil_to_base64, result[0])), html_info=result[1])
+        return images_response(request, models.ExtrasBatchImagesResponse(images=[], html_info=result[1]), result[0])
+
+    def extras_batch_images_stream_api(self, req: models.ExtrasBatchImagesRequest, request: Request):
+        """Same as extra-batch-images, but responds with NDJSON: one ExtrasStreamItem per line, sent as soon as each image is done."""
+
+        args = postprocessing.create_args_for_extras(req.resize_mode, req.gfpgan_visibility, req.codeformer_visibility, req.codeformer_weight, req.upscaling_resize, req.upscaling_resize_w, req.upscaling_resize_h, req.upscaling_crop, req.upscaler_1, req.upscaler_2, req.extras_upscaler_2_visibility)
+
+        return StreamingResponse(self.extras_stream(req.imageList, args, request), media_type="application/x-ndjson")
+
+    def extras_stream(self, image_list, args, request=None):
+        """
+        Yields results of postprocessing as JSON lines, in order of image_list. Images are processed by extras_stream_worker on a
+        separate thread as a pipeline, and at most extras_stream_lookahead results wait to be sent, so memory use does not depend
+        on the number of images.
+        """
+
+        return self.ndjson_stream(self.extras_stream_worker, (image_list, args), name="extras-stream", request=request)
+
+    async def ndjson_stream(self, worker, args, name, request=None):
+        """
+        Runs worker(*args, put, cancelled) on a separate thread and yields results it puts as JSON lines. The worker puts futures
+        of pydantic models with put(), which blocks while extras_stream_lookahead results wait to be sent; the worker must not
+        hold queue_lock while it calls put(). cancelled is set when the client disconnects, or when the client does not take
+        results for stream_client_timeout seconds; put() returns False after that.
+        """
+
+        results = queue.Queue(maxsize=extras_stream_lookahead)
+        cancelled = threading.Event()
+
+        def put(item):
+            deadline = time.monotonic() + stream_client_timeout
+            while not cancelled.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    if time.monotonic() > deadline:
+                        cancelled.set()
+
+            return False
+
+        def run():
+            try:
+                worker(*args, put, cancelled)
+            finally:
+                put(None)
+
+        def get():
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                return Ellipsis
+
+        threading.Thread(target=run, name=name, daemon=True).start()
+
+        try:
+            while True:
+                future = await run_in_threadpool(get)
+                if future is Ellipsis:
+                    if request is not None and await request.is_disconnected():
+                        break
+
+                    continue
+
+                if future is None:
+                    break
+
+                result = await asyncio.wrap_future(future)
+                yield result.json() + "\n"
+        finally:
+            cancelled.set()
+
+    def extras_stream_worker(self, image_list, args, put, cancelled):
+        """
+        Runs the pipeline for extras_stream: images are decoded on a thread pool ahead of time, postprocessed one by one, each
+        while holding queue_lock, and encoded on another thread pool while the next image is postprocessed. The lock is released
+        between images, so that other jobs are not held up by a slow client.
+        """
+
+        upcoming = iter(enumerate(image_list))
+        decoded = collections.deque()
+
+        def decode_ahead():
+            while len(decoded) < extras_stream_lookahead:
+                index, file = next(upcoming, (None, None))
+                if file is None:
+                    break
+
+                decoded.append((index, file.name, decode_pool.submit(decode_base64_to_image, file.data)))
+
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="extras-decode") as decode_pool, ThreadPoolExecutor(max_workers=2, thread_name_prefix="extras-encode") as encode_pool:
+            decode_ahead()
+
+            while decoded and not cancelled.is_set():
+                index, name, image_future = decoded.popleft()
+                decode_ahead()
+
+                try:
+                    image = image_future.result()
+
+                    with self.queue_lock, postprocessing.models_resident():
+                        shared.state.begin(job="extras")
+                        shared.state.textinfo = name
+
+                        try:
+                            processed = postprocessing.postprocess_image(image, name, args) or []
+                        finally:
+                            interrupted = shared.state.interrupted or shared.state.stopping_generation
+                            shared.state.end()
+                except Exception as e:
+                    result = Future()
+                    result.set_result(models.ExtrasStreamItem(index=index, name=name, error=getattr(e, "detail", None) or str(e)))
+                else:
+                    result = encode_pool.submit(encode_extras_stream_item, index, name, processed)
+
+                if not put(result) or interrupted:
+                    break
+
+            devices.torch_gc()
+
+    def interrogate_batch_stream_api(self, req: models.InterrogateBatchRequest, request: Request):
+        """Interrogates many images in batches; responds with NDJSON, one InterrogateStreamItem per line, in order of images."""
+
+        if req.model not in ("clip", "deepdanbooru"):
+            raise HTTPException(status_code=404, detail="Model not found")
+
+        return StreamingResponse(self.ndjson_stream(self.interrogate_stream_worker, (req.images, req.model), name="interrogate-stream", request=request), media_type="application/x-ndjson")
+
+    def interrogate_stream_worker(self, image_list, model, put, cancelled):
+        """
+        Runs the pipeline for interrogate_batch_stream_api: images are decoded and converted into model inputs on a thread pool
+        ahead of time, and batches of interrogate_batch_size images go through the models. queue_lock is held, and models are
+        kept on device, only while one batch is processed; results are handed to the stream after the lock is released.
+        """
+
+        batch_size = max(1, shared.opts.interrogate_batch_size)
+
+        if model == "clip":
+            interrogator = shared.interrogator
+            resident = interrogator.resident
+            preprocess = interrogator.preprocess
+        else:
+            resident = deepbooru.model.resident
+            preprocess = deepbooru.DeepDanbooru.preprocess
+
+        def prepare(file):
+            return preprocess(decode_base64_to_image(file.data).convert("RGB"))
+
+        def finished(index, name, caption=None, error=None):
+            result = Future()
+            result.set_result(models.InterrogateStreamItem(index=index, name=name, caption=caption, error=error))
+            return put(result)
+
+        def run_batch(batch):
+            with self.queue_lock, resident():
+                shared.state.begin(job="interrogate")
+                shared.state.textinfo = batch[0][1]
+
+                try:
+                    if model == "clip":
+                        lowvram.send_everything_to_cpu()
+                        devices.torch_gc()
+                        interrogator.load()
+                        return interrogator.interrogate_preprocessed([x[2] for x in batch])
+
+                    deepbooru.model.start()
+                    return deepbooru.model.tag_preprocessed([x[2] for x in batch])
+                finally:
+                    shared.state.end()
+
+        upcoming = iter(enumerate(image_list))
+        pending = collections.deque()
+
+        with ThreadPoolExecutor(max_workers=4, thread_name_prefix="interrogate-preprocess") as pool:
+            def prepare_ahead():
+                while len(pending) < batch_size * 2:
+                    index, file = next(upcoming, (None, None))
+                    if file is None:
+                        break
+
+                    pending.append((index, file.name, pool.submit(prepare, file)))
+
+            prepare_ahead()
+
+            while pending and not cancelled.is_set():
+                batch = []
+                while pending and len(batch) < batch_size:
+                    index, name, future = pending.popleft()
+                    try:
+                        batch.append((index, name, future.result()))
+                    except Exception as e:
+                        if not finished(index, name, error=getattr(e, "detail", None) or str(e)):
+                            return
+
+                prepare_ahead()
+
+                if not batch:
+                    continue
+
+                try:
+                    captions = run_batch(batch)
+                except Exception as e:
+                    errors.report("Error interrogating", exc_info=True)
+                    captions = [None] * len(batch)
+                    error = str(e)
+                else:
+                    error = None
+
+                for (index, name, _), caption in zip(batch, captions):
+                    if not finished(index, name, caption=caption, error=error):
+                        return
+
+                if shared.state.interrupted or shared.state.stopping_generation:
+                    break
+
+    async def upload_images_api(self, request: Request):
+        """
+        Stores images sent as raw bytes in request body, or as files of a multipart/form-data request, without re-encoding them.
+        Returned references can be used instead of base64 data in image fields of other endpoints until they expire.
+        """
+
+        transport = "path" if get_image_transport(request) == "path" else "url"
+
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            uploads = [await value.read() for _, value in form.multi_items() if not isinstance(value, str)]
+        else:
+            uploads = [await request.body()]
+
+        # only reading the request needs the event loop; checking and writing images is done on a worker thread
+        return await run_in_threadpool(self.store_uploaded_images, uploads, transport)
+
+    def store_uploaded_images(self, uploads, transport):
+        references = []
+        for data in uploads:
+            try:
+                with Image.open(BytesIO(data)) as image:
+                    extension = (image.format or "png").lower()
+            except Exception as e:
+                raise HTTPException(status_code=422, detail="Invalid image data") from e
+
+            references.append(store_api_image(data, extension, transport))
+
+        return models.StoredImagesResponse(images=references)
+
+    def get_stored_image_api(self, name: str):
+        try:
+            return FileResponse(find_api_image(api_images_url + name))
+        except StoredImageNotFound as e:
+            raise HTTPException(status_code=404, detail="Stored image not found or expired") from e
 
     def pnginfoapi(self, req: models.PNGInfoRequest):
         image = decode_base64_to_image(req.image.strip())
@@ -599,6 +1197,13 @@ class Api:
 
         return models.PNGInfoResponse(info=geninfo, items=items, parameters=params)
 
+    def infotext_index_query(self, req: models.InfotextIndexQueryRequest):
+        total, entries = infotext_index.index.query(**vars(req))
+        return models.InfotextIndexQueryResponse(total=total, images=entries)
+
+    def infotext_index_refresh(self):
+        return models.InfotextIndexRefreshResponse(**infotext_index.refresh())
+
     def progressapi(self, req: models.ProgressRequest = Depends()):
         # copy from check_progress_call of ui.py
 
@@ -727,6 +1332,12 @@ class Api:
         import modules.sd_models as sd_models
         return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in sd_models.checkpoints_list.values()]
 
+    def get_hash_progress(self):
+        return hashes.progress()
+
+    def get_model_residency(self):
+        return sd_models.residency.stats()
+
     def get_sd_vaes(self):
         import modules.sd_vae as sd_vae
         return [{"model_name": x, "filename": sd_vae.vae_dict[x]} for x in sd_vae.vae_dict.keys()]
@@ -883,6 +1494,12 @@ class Api:
             cuda = {'error': f'{err}'}
         return models.MemoryResponse(ram=ram, cuda=cuda)
 
+    def get_profile(self):
+        return models.ProfileResponse(**step_profiler.summary())
+
+    def get_metrics(self):
+        return PlainTextResponse(metrics.exposition(), media_type="text/plain; version=0.0.4")
+
     def get_extensions_list(self):
         from modules import extensions
         extensions.list_extensions()
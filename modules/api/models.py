@@ -175,6 +175,16 @@ class ExtrasBatchImagesRequest(ExtrasBaseRequest):
 class ExtrasBatchImagesResponse(ExtraBaseResponse):
     images: list[str] = Field(title="Images", description="The generated images in base64 format.")
 
+class ExtrasStreamItem(BaseModel):
+    index: int = Field(title="Index", description="Position of the image in imageList of the request.")
+    name: str = Field(title="File name")
+    images: list[str] = Field(default=[], title="Images", description="The processed image followed by extra images made by postprocessing scripts, in base64 format.")
+    html_info: str = Field(default="", title="HTML info", description="A series of HTML tags containing the process info.")
+    error: Optional[str] = Field(default=None, title="Error", description="Why the image could not be processed, if it could not.")
+
+class StoredImagesResponse(BaseModel):
+    images: list[str] = Field(title="Images", description="References to stored images, usable instead of base64 data in requests until they expire.")
+
 class PNGInfoRequest(BaseModel):
     image: str = Field(title="Image", description="The base64 encoded PNG image")
 
@@ -183,6 +193,29 @@ class PNGInfoResponse(BaseModel):
     items: dict = Field(title="Items", description="A dictionary containing all the other fields the image had")
     parameters: dict = Field(title="Parameters", description="A dictionary with parsed generation info fields")
 
+class InfotextIndexQueryRequest(BaseModel):
+    model_hash: Optional[str] = Field(default=None, title="Model hash", description="Only images made with the checkpoint with this short hash")
+    model: Optional[str] = Field(default=None, title="Model", description="Only images made with the checkpoint with this name")
+    sampler: Optional[str] = Field(default=None, title="Sampler", description="Only images made with this sampler")
+    seed_min: Optional[int] = Field(default=None, title="Minimum seed", description="Only images with seed greater than or equal to this")
+    seed_max: Optional[int] = Field(default=None, title="Maximum seed", description="Only images with seed less than or equal to this")
+    width: Optional[int] = Field(default=None, title="Width", description="Only images of this width")
+    height: Optional[int] = Field(default=None, title="Height", description="Only images of this height")
+    prompt: Optional[str] = Field(default=None, title="Prompt", description="Only images with prompt containing this text")
+    lora: Optional[str] = Field(default=None, title="LoRA", description="Only images made with LoRA with this name or hash")
+    directory: Optional[str] = Field(default=None, title="Directory", description="Only images in this directory and its subdirectories")
+    offset: int = Field(default=0, title="Offset", description="Number of matching images to skip")
+    limit: int = Field(default=100, title="Limit", description="Maximum number of images to return")
+
+class InfotextIndexQueryResponse(BaseModel):
+    total: int = Field(title="Total", description="Number of matching images")
+    images: list[dict] = Field(title="Images", description="Path and generation parameters of matching images, newest first")
+
+class InfotextIndexRefreshResponse(BaseModel):
+    added: int = Field(title="Added", description="Number of new or changed images that were read")
+    removed: int = Field(title="Removed", description="Number of images that no longer exist and were removed from index")
+    total: int = Field(title="Total", description="Number of images in index")
+
 class ProgressRequest(BaseModel):
     skip_current_image: bool = Field(default=False, title="Skip current image", description="Skip current image serialization")
 
@@ -200,6 +233,16 @@ class InterrogateRequest(BaseModel):
 class InterrogateResponse(BaseModel):
     caption: str = Field(default=None, title="Caption", description="The generated caption for the image.")
 
+class InterrogateBatchRequest(BaseModel):
+    images: list[FileData] = Field(title="Images", description="List of images to work on. Must be Base64 strings")
+    model: str = Field(default="clip", title="Model", description="The interrogate model used: clip or deepdanbooru.")
+
+class InterrogateStreamItem(BaseModel):
+    index: int = Field(title="Index", description="Position of the image in images of the request.")
+    name: str = Field(title="File name")
+    caption: Optional[str] = Field(default=None, title="Caption", description="The generated caption for the image.")
+    error: Optional[str] = Field(default=None, title="Error", description="Why the image could not be interrogated, if it could not.")
+
 class TrainResponse(BaseModel):
     info: str = Field(title="Train info", description="Response string from train embedding or hypernetwork task.")
 
@@ -260,6 +303,28 @@ class SDModelItem(BaseModel):
     filename: str = Field(title="Filename")
     config: Optional[str] = Field(title="Config file")
 
+class HashProgressItem(BaseModel):
+    filename: str = Field(title="Filename")
+    title: str = Field(title="Title", description="Name of the file's entry in the hash cache")
+    priority: int = Field(title="Priority", description="Lower values are hashed first")
+    running: bool = Field(title="Running", description="Whether the hash is being calculated right now, as opposed to waiting in queue")
+    bytes_done: int = Field(title="Bytes done")
+    bytes_total: int = Field(title="Bytes total", description="Size of the file; 0 until the hashing has started")
+
+class ResidencyTierItem(BaseModel):
+    entries: int = Field(title="Entries", description="Number of checkpoints resident in the tier")
+    bytes: int = Field(title="Bytes", description="Total size of checkpoints resident in the tier")
+    budget_bytes: Optional[int] = Field(title="Budget", description="Maximum total size of the tier, if limited")
+    hits: int = Field(title="Hits")
+    misses: int = Field(title="Misses")
+    hit_rate: Optional[float] = Field(title="Hit rate")
+    evictions: int = Field(title="Evictions")
+
+class ResidencyResponse(BaseModel):
+    gpu: ResidencyTierItem = Field(title="GPU", description="Whole models, ready to use")
+    ram: ResidencyTierItem = Field(title="RAM", description="Checkpoint weights cached in pinned memory")
+    disk: ResidencyTierItem = Field(title="Disk", description="Checkpoint weights read from disk")
+
 class SDVaeItem(BaseModel):
     model_name: str = Field(title="Model Name")
     filename: str = Field(title="Filename")
@@ -299,6 +364,11 @@ class MemoryResponse(BaseModel):
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
 
 
+class ProfileResponse(BaseModel):
+    last_job: Optional[dict] = Field(default=None, title="Last job", description="Total time and time spent in each component during the last finished generation job")
+    components: dict = Field(title="Components", description="For each component, number of calls, total time, and percentiles and histogram buckets of latest durations")
+
+
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
     img2img: list = Field(default=None, title="Img2img", description="Titles of scripts (img2img)")
@@ -3,9 +3,16 @@ from functools import wraps
 import html
 import time
 
-from modules import shared, progress, errors, devices, fifo_lock, profiling
+from modules import shared, progress, errors, devices, job_scheduler, profiling, metrics
 
-queue_lock = fifo_lock.FIFOLock()
+queue_lock = job_scheduler.JobScheduler()
+
+
+def collect_metrics():
+    metrics.queue_length.set(queue_lock.waiting_count())
+
+
+metrics.add_collector(collect_metrics)
 
 
 def wrap_queued_call(func):
@@ -1,3 +1,4 @@
+import contextlib
 import os
 import re
 
@@ -12,6 +13,7 @@ re_special = re.compile(r'([\\()])')
 class DeepDanbooru:
     def __init__(self):
         self.model = None
+        self.resident_jobs = 0
 
     def load(self):
         if self.model is not None:
@@ -35,10 +37,21 @@ class DeepDanbooru:
         self.model.to(devices.device)
 
     def stop(self):
-        if not shared.opts.interrogate_keep_models_in_memory:
+        if not shared.opts.interrogate_keep_models_in_memory and self.resident_jobs == 0 and self.model is not None:
             self.model.to(devices.cpu)
             devices.torch_gc()
 
+    @contextlib.contextmanager
+    def resident(self):
+        """While active, the model stays on device between calls of tag() instead of being moved to RAM after each one."""
+
+        self.resident_jobs += 1
+        try:
+            yield
+        finally:
+            self.resident_jobs -= 1
+            self.stop()
+
     def tag(self, pil_image):
         self.start()
         res = self.tag_multi(pil_image)
@@ -46,23 +59,44 @@ class DeepDanbooru:
 
         return res
 
+    def tag_batch(self, pil_images):
+        """Returns tags for a list of images, running the model on all of them at once."""
+
+        self.start()
+        res = self.tag_preprocessed([self.preprocess(x) for x in pil_images])
+        self.stop()
+
+        return res
+
+    @staticmethod
+    def preprocess(pil_image):
+        """Returns the image as an array the model takes as input; does not use the model, so it can be called from other threads."""
+
+        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
+        return np.array(pic, dtype=np.float32) / 255
+
     def tag_multi(self, pil_image, force_disable_ranks=False):
+        return self.tag_preprocessed([self.preprocess(pil_image)], force_disable_ranks)[0]
+
+    def tag_preprocessed(self, arrays, force_disable_ranks=False):
+        """Returns a list of tags for a list of images made by preprocess(), running the model on all of them at once; the model must be started."""
+
+        with torch.no_grad(), devices.autocast():
+            x = torch.from_numpy(np.stack(arrays)).to(devices.device, devices.dtype)
+            y = self.model(x).detach().float().cpu().numpy()
+
+        return [self.format_tags(probabilities, force_disable_ranks) for probabilities in y]
+
+    def format_tags(self, probabilities, force_disable_ranks=False):
         threshold = shared.opts.interrogate_deepbooru_score_threshold
         use_spaces = shared.opts.deepbooru_use_spaces
         use_escape = shared.opts.deepbooru_escape
         alpha_sort = shared.opts.deepbooru_sort_alpha
         include_ranks = shared.opts.interrogate_return_ranks and not force_disable_ranks
 
-        pic = images.resize_image(2, pil_image.convert("RGB"), 512, 512)
-        a = np.expand_dims(np.array(pic, dtype=np.float32), 0) / 255
-
-        with torch.no_grad(), devices.autocast():
-            x = torch.from_numpy(a).to(devices.device, devices.dtype)
-            y = self.model(x)[0].detach().cpu().numpy()
-
         probability_dict = {}
 
-        for tag, probability in zip(self.model.tags, y):
+        for tag, probability in zip(self.model.tags, probabilities):
             if probability < threshold:
                 continue
 
@@ -1,75 +1,331 @@
 import hashlib
+import heapq
+import itertools
+import mmap
 import os.path
+import threading
+from concurrent.futures import Future
 
-from modules import shared
+from modules import shared, metrics
 import modules.cache
 
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+blksize = 16 * 1024 * 1024
+
+PRIORITY_IMMEDIATE = 0
+"""for files the caller is waiting for right now"""
+
+PRIORITY_REQUEST = 10
+"""for files used by the current generation request, which will need the hash soon"""
+
+PRIORITY_BACKGROUND = 20
+"""for everything else"""
+
+
+def hash_file(filename, offset=0, progress=None):
+    """
+    Calculates sha256 of file's contents starting from offset. Reads the file using mmap in large blocks, falling back to regular reads
+    where mmap is not available. If progress is specified, it's called with the number of bytes hashed so far after each block.
+    """
 
-def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+        size = os.fstat(f.fileno()).st_size
+
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > offset else None
+        except (OSError, ValueError):
+            m = None
+
+        if m is not None:
+            with m, memoryview(m) as view:
+                for pos in range(offset, size, blksize):
+                    hash_sha256.update(view[pos:pos + blksize])
+                    if progress is not None:
+                        progress(min(pos + blksize, size) - offset)
+        else:
+            f.seek(offset)
+            done = 0
+            for chunk in iter(lambda: f.read(blksize), b""):
+                hash_sha256.update(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done)
 
     return hash_sha256.hexdigest()
 
 
+def calculate_sha256(filename):
+    return hash_file(filename)
+
+
+def file_identity(stat):
+    """
+    Returns a key that stays the same for as long as the file is not modified, even if it is renamed or moved to
+    another directory on the same filesystem. Takes the result of os.stat().
+    """
+
+    return f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def hashes_cache(use_addnet_hash):
+    return cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+
+
+def identity_cache(use_addnet_hash):
+    return cache("hashes-addnet-identity") if use_addnet_hash else cache("hashes-identity")
+
+
+def store_sha256(stat, title, use_addnet_hash, sha256_value):
+    hashes_cache(use_addnet_hash)[title] = {
+        "mtime": stat.st_mtime,
+        "sha256": sha256_value,
+    }
+
+    identity_cache(use_addnet_hash)[file_identity(stat)] = sha256_value
+
+    dump_cache()
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+    """
+    Looks up the hash by file's identity (see file_identity()) first, and by title second. Renamed files are found by
+    identity, and get their title entry updated.
+    """
+
+    hashes = hashes_cache(use_addnet_hash)
     try:
-        ondisk_mtime = os.path.getmtime(filename)
+        stat = os.stat(filename)
     except FileNotFoundError:
         return None
 
-    if title not in hashes:
+    identity = file_identity(stat)
+    by_identity = identity_cache(use_addnet_hash)
+    entry = hashes.get(title)
+
+    cached_sha256 = by_identity.get(identity)
+    if cached_sha256 is not None:
+        if entry is None or entry.get("sha256") != cached_sha256 or entry.get("mtime", 0) < stat.st_mtime:
+            hashes[title] = {"mtime": stat.st_mtime, "sha256": cached_sha256}
+
+        return cached_sha256
+
+    if entry is None:
         return None
 
-    cached_sha256 = hashes[title].get("sha256", None)
-    cached_mtime = hashes[title].get("mtime", 0)
+    cached_sha256 = entry.get("sha256", None)
+    cached_mtime = entry.get("mtime", 0)
 
-    if ondisk_mtime > cached_mtime or cached_sha256 is None:
+    if stat.st_mtime > cached_mtime or cached_sha256 is None:
         return None
 
+    # entries made before the identity index existed
+    by_identity[identity] = cached_sha256
+
     return cached_sha256
 
 
+class HashJob:
+    def __init__(self, filename, title, use_addnet_hash, priority):
+        self.filename = filename
+        self.title = title
+        self.use_addnet_hash = use_addnet_hash
+        self.priority = priority
+        self.future = Future()
+        self.started = False
+        self.bytes_done = 0
+        self.bytes_total = 0
+
+    @property
+    def key(self):
+        return self.title, self.use_addnet_hash
+
+    def run(self):
+        try:
+            self.future.set_result(self.calculate())
+        except Exception as e:
+            self.future.set_exception(e)
+
+    def calculate(self):
+        sha256_value = sha256_from_cache(self.filename, self.title, self.use_addnet_hash)
+        if sha256_value is not None:
+            return sha256_value
+
+        stat = os.stat(self.filename)
+        self.bytes_total = stat.st_size
+
+        offset = 0
+        if self.use_addnet_hash:
+            with open(self.filename, "rb") as file:
+                offset = int.from_bytes(file.read(8), "little") + 8
+
+        sha256_value = hash_file(self.filename, offset=offset, progress=self.set_progress)
+
+        store_sha256(stat, self.title, self.use_addnet_hash, sha256_value)
+
+        return sha256_value
+
+    def set_progress(self, bytes_done):
+        self.bytes_done = bytes_done
+
+
+class HashingService:
+    """
+    Calculates hashes of model files using a pool of background threads. Jobs are taken from a priority queue, so files needed by the current
+    request are hashed before files that are only being hashed in advance. Results are written to the same cache as sha256() uses.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.queue = []
+        self.jobs = {}
+        self.counter = itertools.count()
+        self.workers = []
+
+    def submit(self, filename, title, use_addnet_hash=False, priority=PRIORITY_BACKGROUND) -> Future:
+        with self.lock:
+            job = self.jobs.get((title, use_addnet_hash))
+            if job is None:
+                job = HashJob(filename, title, use_addnet_hash, priority)
+                self.jobs[job.key] = job
+            elif job.started or job.priority <= priority:
+                return job.future
+
+            # a job whose priority is raised gets pushed again; the stale entry is skipped when it's popped
+            job.priority = priority
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+
+            self.start_workers()
+            self.condition.notify()
+
+        return job.future
+
+    def run_now(self, filename, title, use_addnet_hash=False):
+        """Calculates the hash on calling thread, unless it's already being calculated by a worker, in which case waits for the worker to finish."""
+
+        with self.lock:
+            job = self.jobs.get((title, use_addnet_hash))
+            if job is not None and job.started:
+                return_when_done = job.future
+            else:
+                return_when_done = None
+
+                if job is None:
+                    job = HashJob(filename, title, use_addnet_hash, PRIORITY_IMMEDIATE)
+                    self.jobs[job.key] = job
+
+                job.priority = PRIORITY_IMMEDIATE
+                job.started = True
+
+        if return_when_done is not None:
+            return return_when_done.result()
+
+        self.run_job(job)
+        return job.future.result()
+
+    def run_job(self, job):
+        try:
+            job.run()
+        finally:
+            with self.lock:
+                if self.jobs.get(job.key) is job:
+                    del self.jobs[job.key]
+
+    def start_workers(self):
+        count = max(1, shared.opts.hash_threads)
+
+        while len(self.workers) < count:
+            thread = threading.Thread(target=self.worker, name=f"hashing-{len(self.workers)}", daemon=True)
+            self.workers.append(thread)
+            thread.start()
+
+    def next_job(self):
+        with self.lock:
+            while True:
+                while not self.queue:
+                    self.condition.wait()
+
+                priority, _, job = heapq.heappop(self.queue)
+                if not job.started and job.priority == priority:
+                    job.started = True
+                    return job
+
+    def worker(self):
+        while True:
+            self.run_job(self.next_job())
+
+    def progress(self):
+        """Returns a list of dicts describing queued and running jobs, running ones first."""
+
+        with self.lock:
+            jobs = sorted(self.jobs.values(), key=lambda x: (not x.started, x.priority))
+
+            return [
+                {
+                    "filename": job.filename,
+                    "title": job.title,
+                    "priority": job.priority,
+                    "running": job.started,
+                    "bytes_done": job.bytes_done,
+                    "bytes_total": job.bytes_total,
+                }
+                for job in jobs
+            ]
+
+
+service = HashingService()
+
+
 def sha256(filename, title, use_addnet_hash=False):
-    hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
+    """Returns sha256 of the file, calculating it on the calling thread if it's not in cache; this blocks for as long as it takes to read the file."""
 
     sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+    metrics.cache_lookups_total.inc(cache="hash", result="miss" if sha256_value is None else "hit")
     if sha256_value is not None:
         return sha256_value
 
     if shared.cmd_opts.no_hashing:
         return None
 
-    print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
-            sha256_value = addnet_hash_safetensors(file)
-    else:
-        sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+    return service.run_now(filename, title, use_addnet_hash)
 
-    hashes[title] = {
-        "mtime": os.path.getmtime(filename),
-        "sha256": sha256_value,
-    }
 
-    dump_cache()
+def sha256_async(filename, title, use_addnet_hash=False, priority=PRIORITY_BACKGROUND) -> Future:
+    """Returns a Future for sha256 of the file; if it's not in cache, it's queued to be calculated by background threads with specified priority."""
+
+    sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+    metrics.cache_lookups_total.inc(cache="hash", result="miss" if sha256_value is None else "hit")
+    if sha256_value is not None or shared.cmd_opts.no_hashing:
+        future = Future()
+        future.set_result(sha256_value)
+        return future
+
+    return service.submit(filename, title, use_addnet_hash, priority)
+
+
+def progress():
+    return service.progress()
 
-    return sha256_value
+
+def prewarm(files):
+    """Queues hashes for calculation in background. Takes an iterable of (filename, title, use_addnet_hash) tuples."""
+
+    count = 0
+    for filename, title, use_addnet_hash in files:
+        if not sha256_async(filename, title, use_addnet_hash).done():
+            count += 1
+
+    if count:
+        print(f"Queued {count} files for calculating hashes in background")
 
 
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     b.seek(0)
     header = b.read(8)
@@ -81,4 +337,3 @@ def addnet_hash_safetensors(b):
         hash_sha256.update(chunk)
 
     return hash_sha256.hexdigest()
-
@@ -6,7 +6,9 @@ import pytz
 import io
 import math
 import os
+import threading
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import re
 
 import numpy as np
@@ -19,7 +21,7 @@ import string
 import json
 import hashlib
 
-from modules import sd_samplers, shared, script_callbacks, errors
+from modules import sd_samplers, shared, script_callbacks, errors, step_profiler, cache
 from modules.paths_internal import roboto_ttf_file
 from modules.shared import opts
 
@@ -551,7 +553,7 @@ def get_next_sequence_number(path, basename):
         basename = f"{basename}-"
 
     prefix_length = len(basename)
-    for p in os.listdir(path):
+    for p in os.listdir(path) + background_saver.pending_in_directory(path):
         if p.startswith(basename):
             parts = os.path.splitext(p[prefix_length:])[0].split('-')  # splits the filename (removing the basename first if one is defined, so the sequence number is always the first element)
             try:
@@ -562,6 +564,166 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+class SequenceNumbers:
+    """
+    Keeps the next sequence number for every directory and basename in cache, so that saving an image does not have to
+    list the whole directory. The directory is only scanned with get_next_sequence_number() when there's no entry for it,
+    or when the entry is stale: the directory was deleted and created again, or its modification time differs from the
+    last one this process saw, which means that something else has added or removed files there.
+    Numbers only go up: unlike with scanning, deleting latest images does not make their numbers used again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(path, basename):
+        return f"{os.path.abspath(path)}\n{basename}"
+
+    @staticmethod
+    def directory_identity(stat):
+        return [stat.st_dev, stat.st_ino]
+
+    def next(self, path, basename):
+        """Returns the next sequence number for directory path and basename, and reserves it."""
+
+        if not opts.save_images_sequence_cache:
+            return get_next_sequence_number(path, basename)
+
+        key = self.key(path, basename)
+        numbers = cache.cache("image-sequence-numbers")
+
+        with self.lock:
+            stat = os.stat(path)
+            identity = self.directory_identity(stat)
+
+            entry = numbers.get(key)
+            if entry is None or entry.get("identity") != identity:
+                number = get_next_sequence_number(path, basename)
+            elif entry.get("mtime") != stat.st_mtime_ns:
+                number = max(get_next_sequence_number(path, basename), entry["next"])
+            else:
+                number = entry["next"]
+
+            numbers[key] = {"identity": identity, "next": number + 1, "mtime": stat.st_mtime_ns}
+
+        return number
+
+    def written(self, path, basename):
+        """
+        Records modification time of directory path after this process has written files there, so that its own writes do
+        not make the entry stale. Files added by others between the write and this call go unnoticed; save_image still skips
+        numbers of files that exist.
+        """
+
+        if not opts.save_images_sequence_cache:
+            return
+
+        key = self.key(path, basename)
+        numbers = cache.cache("image-sequence-numbers")
+
+        with self.lock:
+            entry = numbers.get(key)
+            if entry is not None:
+                numbers[key] = {**entry, "mtime": os.stat(path).st_mtime_ns}
+
+    def used(self, path, basename, number):
+        """Records that number was used, for when save_image had to skip numbers because files with them already existed."""
+
+        if not opts.save_images_sequence_cache:
+            return
+
+        key = self.key(path, basename)
+        numbers = cache.cache("image-sequence-numbers")
+
+        with self.lock:
+            entry = numbers.get(key)
+            if entry is not None and entry["next"] <= number:
+                numbers[key] = {**entry, "next": number + 1}
+
+
+sequence_numbers = SequenceNumbers()
+
+
+class BackgroundSaver:
+    """
+    Writes images to disk on background threads, so that generation can continue while images are being encoded.
+    At most save_images_async_max_pending images wait to be written; submit() blocks until there is room.
+    Filenames of images that are not written yet are tracked, so that their sequence numbers are not used again,
+    and so that code that needs the file can wait for it with wait(), or for all files with flush().
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}
+        """maps filename to the number of writes to it that have not finished"""
+
+        self.count = 0
+        self.executor = None
+        self.threads = 0
+
+    def submit(self, filename, func):
+        """Runs func, which writes filename, on a background thread; returns a Future."""
+
+        with self.condition:
+            while self.count >= max(1, opts.save_images_async_max_pending):
+                self.condition.wait()
+
+            threads = max(1, opts.save_images_async_threads)
+            if self.executor is None or self.threads != threads:
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+
+                self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="image-saver")
+                self.threads = threads
+
+            self.pending[filename] = self.pending.get(filename, 0) + 1
+            self.count += 1
+
+            return self.executor.submit(self.run, filename, func)
+
+    def run(self, filename, func):
+        try:
+            func()
+        except Exception as e:
+            errors.display(e, f"saving image {filename}")
+        finally:
+            with self.condition:
+                self.pending[filename] -= 1
+                if self.pending[filename] <= 0:
+                    del self.pending[filename]
+
+                self.count -= 1
+                self.condition.notify_all()
+
+    def is_pending(self, filename):
+        with self.condition:
+            return filename in self.pending
+
+    def pending_in_directory(self, path):
+        """Returns names of files in directory path that are not written yet."""
+
+        path = os.path.normpath(path)
+
+        with self.condition:
+            return [os.path.basename(x) for x in self.pending if os.path.normpath(os.path.dirname(x)) == path]
+
+    def wait(self, filename, timeout=None):
+        """Waits until filename is written, if it's being written; returns False if timeout expires first."""
+
+        with self.condition:
+            return self.condition.wait_for(lambda: filename not in self.pending, timeout)
+
+    def flush(self, timeout=None):
+        """Waits until all submitted images are written; returns False if timeout expires first."""
+
+        with self.condition:
+            return self.condition.wait_for(lambda: self.count == 0, timeout)
+
+
+background_saver = BackgroundSaver()
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -621,6 +783,7 @@ def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_p
         image.save(filename, format=image_format, quality=opts.jpeg_quality)
 
 
+@step_profiler.timed("image save")
 def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None):
     """Save an image.
 
@@ -653,6 +816,9 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             The full path of the saved imaged.
         txt_fullfn (`str` or None):
             If a text file is saved for this image, this will be its full path. Otherwise None.
+
+    If save_images_async setting is enabled, files are written by background_saver after the function returns;
+    use background_saver.wait(fullfn) to make sure the file exists.
     """
     namegen = FilenameGenerator(p, seed, prompt, image, basename=basename)
 
@@ -686,13 +852,16 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             file_decoration = f"-{file_decoration}"
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
+            basecount = sequence_numbers.next(path, basename)
             fullfn = None
             for i in range(500):
                 fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
                 fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
+                if not os.path.exists(fullfn) and not background_saver.is_pending(fullfn):
                     break
+
+            if i > 0:
+                sequence_numbers.used(path, basename, basecount + i)
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
     else:
@@ -731,38 +900,55 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
 
-    image.already_saved_as = fullfn
+    txt_fullfn = f"{fullfn_without_extension}.txt" if opts.save_txt and info is not None else None
 
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+    def write():
+        _atomically_save_image(image, fullfn_without_extension, extension)
 
-        if resize_to is not None:
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+
+            downscaled = image
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    downscaled = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    downscaled = image.resize(resize_to)
             try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
-        try:
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
+                _atomically_save_image(downscaled, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
+
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
+
+        if opts.infotext_index_enable and info is not None:
+            from modules import infotext_index
+
+            try:
+                infotext_index.index.add_saved_image(fullfn, info)
+            except Exception as e:
+                errors.display(e, "adding image to infotext index")
+
+        sequence_numbers.written(path, basename)
 
-    if opts.save_txt and info is not None:
-        txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
+        script_callbacks.image_saved_callback(params)
+
+    if opts.save_images_async:
+        background_saver.submit(fullfn, write)
     else:
-        txt_fullfn = None
+        write()
 
-    script_callbacks.image_saved_callback(params)
+    image.already_saved_as = fullfn
 
     return fullfn, txt_fullfn
 
@@ -0,0 +1,378 @@
+"""
+Index of generation parameters of images in output directories, for finding images by seed, prompt, model, sampler,
+size or LoRA without opening and parsing every file.
+
+The index is column-oriented: every field is a separate column, numbers are stored as numpy arrays, and strings are
+dictionary-encoded as int32 codes into a table of unique values, so queries are vectorized comparisons of codes. It is
+kept in a single .npz file in the cache directory. Images saved by webui are added as they are saved; refresh() brings
+the index up to date with files in output directories, only opening files that are new or changed since last time.
+"""
+
+import io
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from modules import cache, errors, images, infotext_utils, shared
+
+index_version = 1
+
+numeric_columns = {
+    "mtime": np.float64,
+    "size": np.int64,
+    "seed": np.int64,
+    "width": np.int32,
+    "height": np.int32,
+    "steps": np.int32,
+    "cfg_scale": np.float32,
+}
+"""columns with numbers; missing values are stored as -1"""
+
+string_columns = ["path", "prompt", "negative_prompt", "model_hash", "model", "sampler", "lora_hashes"]
+"""columns with strings; missing values are stored as empty strings"""
+
+infotext_fields = {
+    "seed": "Seed",
+    "width": "Size-1",
+    "height": "Size-2",
+    "steps": "Steps",
+    "cfg_scale": "CFG scale",
+    "model_hash": "Model hash",
+    "model": "Model",
+    "sampler": "Sampler",
+    "lora_hashes": "Lora hashes",
+}
+"""maps column name to the key of the field in parameters parsed by infotext_utils.parse_infotext_parts"""
+
+image_extensions = {".png", ".jpg", ".jpeg", ".webp", ".avif"}
+
+
+def parse_lora_hashes(text):
+    """Parses value of "Lora hashes" infotext field, 'name1: hash1, name2: hash2', into a dict."""
+
+    res = {}
+    for item in text.split(","):
+        name, _, lora_hash = item.strip().rpartition(":")
+        if name:
+            res[name.strip()] = lora_hash.strip()
+
+    return res
+
+
+class StringColumn:
+    """Strings stored as codes into a table of unique values."""
+
+    def __init__(self, values=(), codes=()):
+        self.values = list(values)
+        self.lookup = {value: i for i, value in enumerate(self.values)}
+        self.codes = list(codes)
+
+    def encode(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.lookup[value] = code
+
+        return code
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def set(self, row, value):
+        self.codes[row] = self.encode(value)
+
+    def get(self, row):
+        return self.values[self.codes[row]]
+
+    def matching_codes(self, predicate):
+        """Returns an array of codes of unique values for which predicate is true."""
+
+        return np.array([code for code, value in enumerate(self.values) if predicate(value)], dtype=np.int32)
+
+    def compacted(self, rows):
+        """Returns a new column with only specified rows, and without values that are no longer used."""
+
+        res = StringColumn()
+        for row in rows:
+            res.append(self.get(row))
+
+        return res
+
+    def pack(self, name):
+        encoded = [value.encode("utf8") for value in self.values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in encoded], dtype=np.int64)
+
+        return {
+            f"{name}.codes": np.array(self.codes, dtype=np.int32),
+            f"{name}.blob": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            f"{name}.offsets": offsets,
+        }
+
+    @staticmethod
+    def unpack(data, name):
+        blob = data[f"{name}.blob"].tobytes()
+        offsets = data[f"{name}.offsets"].tolist()
+        values = [blob[start:end].decode("utf8") for start, end in zip(offsets, offsets[1:])]
+
+        return StringColumn(values, data[f"{name}.codes"].tolist())
+
+
+def entry_from_infotext(infotext):
+    """Returns a dict with values for all columns except path, mtime and size, parsed from infotext."""
+
+    prompt, negative_prompt, params = infotext_utils.parse_infotext_parts(infotext or "")
+
+    res = {"prompt": prompt, "negative_prompt": negative_prompt}
+
+    for column, field in infotext_fields.items():
+        value = params.get(field)
+
+        if column in numeric_columns:
+            convert = float if np.issubdtype(numeric_columns[column], np.floating) else int
+            try:
+                res[column] = convert(value) if value is not None else -1
+            except (ValueError, OverflowError):
+                res[column] = -1
+        else:
+            res[column] = str(value) if value is not None else ""
+
+    return res
+
+
+class InfotextIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.save_lock = threading.Lock()
+        self.loaded = False
+        self.changes = 0
+        self.clear()
+
+    def clear(self):
+        self.numbers = {name: [] for name in numeric_columns}
+        self.strings = {name: StringColumn() for name in string_columns}
+        self.rows = {}
+        """maps path to row number"""
+
+    def __len__(self):
+        with self.lock:
+            self.load()
+            return len(self.rows)
+
+    def load(self):
+        if self.loaded:
+            return
+
+        self.loaded = True
+
+        if not os.path.isfile(self.filename):
+            return
+
+        try:
+            with np.load(self.filename, allow_pickle=False) as data:
+                if int(data["version"]) != index_version:
+                    return
+
+                self.numbers = {name: data[name].tolist() for name in numeric_columns}
+                self.strings = {name: StringColumn.unpack(data, name) for name in string_columns}
+        except Exception:
+            errors.report(f"Error loading infotext index from {self.filename}; it will be rebuilt", exc_info=True)
+            self.clear()
+            return
+
+        self.rows = {path: row for row, path in enumerate(self.strings["path"].get(x) for x in range(len(self.numbers["mtime"])))}
+
+    def save(self):
+        # saves from different threads are done one after another, so that a save with older data can't replace a newer file;
+        # the main lock is only held while arrays are made, so images can be added while the file is written
+        with self.save_lock:
+            with self.lock:
+                arrays = {"version": np.array(index_version)}
+                for name, dtype in numeric_columns.items():
+                    arrays[name] = np.array(self.numbers[name], dtype=dtype)
+                for name, column in self.strings.items():
+                    arrays.update(column.pack(name))
+
+                self.changes = 0
+
+            buffer = io.BytesIO()
+            np.savez(buffer, **arrays)
+
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            temp_filename = f"{self.filename}.tmp"
+            with open(temp_filename, "wb") as file:
+                file.write(buffer.getbuffer())
+            os.replace(temp_filename, self.filename)
+
+    def add(self, path, infotext, stat=None):
+        """Adds or updates the entry for image file at path, with parameters parsed from infotext."""
+
+        path = os.path.abspath(path)
+        if stat is None:
+            stat = os.stat(path)
+
+        entry = entry_from_infotext(infotext)
+        entry.update(path=path, mtime=stat.st_mtime, size=stat.st_size)
+
+        with self.lock:
+            self.load()
+
+            row = self.rows.get(path)
+            if row is None:
+                self.rows[path] = len(self.numbers["mtime"])
+                for name in numeric_columns:
+                    self.numbers[name].append(entry[name])
+                for name, column in self.strings.items():
+                    column.append(entry[name])
+            else:
+                for name in numeric_columns:
+                    self.numbers[name][row] = entry[name]
+                for name, column in self.strings.items():
+                    column.set(row, entry[name])
+
+            self.changes += 1
+
+    def add_saved_image(self, path, infotext):
+        """Called after an image is saved by webui; writes the index to disk every infotext_index_save_every additions."""
+
+        self.add(path, infotext)
+
+        with self.lock:
+            should_save = self.changes >= shared.opts.infotext_index_save_every
+
+        if should_save:
+            self.save()
+
+    def remove(self, paths):
+        with self.lock:
+            removed = {self.rows[path] for path in paths if path in self.rows}
+            if not removed:
+                return
+
+            keep = [row for row in range(len(self.numbers["mtime"])) if row not in removed]
+            self.numbers = {name: [values[row] for row in keep] for name, values in self.numbers.items()}
+            self.strings = {name: column.compacted(keep) for name, column in self.strings.items()}
+            self.rows = {self.strings["path"].get(row): row for row in range(len(keep))}
+            self.changes += len(removed)
+
+    def refresh(self, directories):
+        """
+        Updates the index with image files in directories and their subdirectories: new and changed files are read and
+        added, and entries for files that no longer exist are removed. Returns a dict with numbers of added and removed entries.
+        """
+
+        directories = [os.path.abspath(x) for x in directories]
+        seen = set()
+        added = 0
+
+        with self.lock:
+            self.load()
+            known = {path: (self.numbers["mtime"][row], self.numbers["size"][row]) for path, row in self.rows.items()}
+
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for filename in files:
+                    if os.path.splitext(filename)[1].lower() not in image_extensions:
+                        continue
+
+                    path = os.path.join(root, filename)
+                    seen.add(path)
+
+                    try:
+                        stat = os.stat(path)
+                        if known.get(path) == (stat.st_mtime, stat.st_size):
+                            continue
+
+                        with Image.open(path) as image:
+                            infotext, _ = images.read_info_from_image(image)
+                    except Exception as e:
+                        print(f"Error reading generation parameters from {path}: {e}")
+                        continue
+
+                    self.add(path, infotext, stat)
+                    added += 1
+
+        missing = [path for path in known if path not in seen and any(path.startswith(os.path.join(x, "")) for x in directories)]
+        self.remove(missing)
+
+        self.save()
+
+        return {"added": added, "removed": len(missing), "total": len(self)}
+
+    def entry(self, row):
+        res = {name: values[row] for name, values in self.numbers.items()}
+        res.update({name: column.get(row) for name, column in self.strings.items()})
+        return res
+
+    def query(self, model_hash=None, model=None, sampler=None, seed_min=None, seed_max=None, width=None, height=None, prompt=None, lora=None, directory=None, offset=0, limit=100):
+        """
+        Returns a tuple of the number of matching images, and a list of entries for matching images, newest first,
+        starting at offset and limited to limit entries. String arguments match exactly, except for prompt, which
+        matches a substring of the prompt, lora, which matches a LoRA name or hash, and directory, which matches
+        images in the directory and its subdirectories.
+        """
+
+        with self.lock:
+            self.load()
+
+            count = len(self.numbers["mtime"])
+            mask = np.ones(count, dtype=bool)
+
+            def codes(name):
+                return np.array(self.strings[name].codes, dtype=np.int32)
+
+            def numbers(name):
+                return np.array(self.numbers[name], dtype=numeric_columns[name])
+
+            for name, value in [("model_hash", model_hash), ("model", model), ("sampler", sampler)]:
+                if value is not None:
+                    mask &= codes(name) == self.strings[name].lookup.get(value, -1)
+
+            for name, value in [("width", width), ("height", height)]:
+                if value is not None:
+                    mask &= numbers(name) == value
+
+            if seed_min is not None or seed_max is not None:
+                seeds = numbers("seed")
+                mask &= seeds >= (seed_min if seed_min is not None else 0)
+                if seed_max is not None:
+                    mask &= seeds <= seed_max
+
+            if prompt is not None:
+                mask &= np.isin(codes("prompt"), self.strings["prompt"].matching_codes(lambda x: prompt in x))
+
+            if lora is not None:
+                def has_lora(text):
+                    hashes = parse_lora_hashes(text)
+                    return lora in hashes or lora in hashes.values()
+
+                mask &= np.isin(codes("lora_hashes"), self.strings["lora_hashes"].matching_codes(has_lora))
+
+            if directory is not None:
+                prefix = os.path.join(os.path.abspath(directory), "")
+                mask &= np.isin(codes("path"), self.strings["path"].matching_codes(lambda x: x.startswith(prefix)))
+
+            rows = np.flatnonzero(mask)
+            rows = rows[np.argsort(-numbers("mtime")[rows], kind="stable")]
+
+            return len(rows), [self.entry(row) for row in rows[offset:offset + limit].tolist()]
+
+
+index = InfotextIndex(os.path.join(cache.cache_dir, "infotext-index.npz"))
+
+
+def output_directories():
+    """Directories with images saved by webui, which are indexed by refresh()."""
+
+    names = ["outdir_samples", "outdir_txt2img_samples", "outdir_img2img_samples", "outdir_extras_samples", "outdir_grids", "outdir_txt2img_grids", "outdir_img2img_grids", "outdir_save"]
+    directories = {os.path.abspath(x) for x in (getattr(shared.opts, name, "") for name in names) if x}
+
+    return sorted(x for x in directories if os.path.isdir(x))
+
+
+def refresh():
+    return index.refresh(output_directories())
@@ -103,6 +103,12 @@ def initialize_rest(*, reload_script_modules=False):
     sd_models.list_models()
     startup_timer.record("list SD models")
 
+    if cmd_opts.prewarm_hashes:
+        from modules import sd_hijack
+        sd_models.prewarm_hashes()
+        sd_hijack.model_hijack.embedding_db.prewarm_hashes()
+        startup_timer.record("queue hashes")
+
     from modules import localization
     localization.list_localizations(cmd_opts.localizations_dir)
     startup_timer.record("list localizations")
@@ -1,24 +1,39 @@
+import contextlib
+import hashlib
 import os
 import sys
 from collections import namedtuple
 from pathlib import Path
 import re
 
+import numpy as np
 import torch
 import torch.hub
 
 from torchvision import transforms
 from torchvision.transforms.functional import InterpolationMode
 
-from modules import devices, paths, shared, lowvram, modelloader, errors, torch_utils
+from modules import devices, paths, shared, lowvram, modelloader, errors, torch_utils, cache
 
 blip_image_eval_size = 384
 clip_model_name = 'ViT-L/14'
 
-Category = namedtuple("Category", ["name", "topn", "items"])
+Category = namedtuple("Category", ["name", "topn", "items", "content_hash"], defaults=[None])
 
 re_topn = re.compile(r"\.top(\d+)$")
 
+text_features_batch_size = 1024
+"""number of phrases encoded by CLIP at once when computing text features for categories"""
+
+
+def items_hash(items):
+    return hashlib.sha256("\n".join(items).encode("utf8")).hexdigest()
+
+
+def text_features_filename(content_hash):
+    model_name = re.sub(r"\W", "_", clip_model_name)
+    return os.path.join(cache.cache_dir, "interrogate", f"{model_name}-{content_hash}.npy")
+
 def category_types():
     return [f.stem for f in Path(shared.interrogator.content_dir).glob('*.txt')]
 
@@ -52,6 +67,14 @@ class InterrogateModels:
     def __init__(self, content_dir):
         self.loaded_categories = None
         self.skip_categories = []
+        self.text_features = {}
+        """maps content hash of a list of phrases to a CPU tensor with their normalized CLIP text features, memory-mapped from disk"""
+
+        self.categories_features = None
+        """(key, features, slices) tuple with text features of all categories in one matrix on interrogate device; see categories_text_features()"""
+
+        self.resident_jobs = 0
+
         self.content_dir = content_dir
         self.running_on_cpu = devices.device_interrogate == torch.device("cpu")
 
@@ -76,7 +99,7 @@ class InterrogateModels:
                 with open(filename, "r", encoding="utf8") as file:
                     lines = [x.strip() for x in file.readlines()]
 
-                self.loaded_categories.append(Category(name=filename.stem, topn=topn, items=lines))
+                self.loaded_categories.append(Category(name=filename.stem, topn=topn, items=lines, content_hash=items_hash(lines)))
 
         return self.loaded_categories
 
@@ -133,13 +156,27 @@ class InterrogateModels:
 
         self.dtype = torch_utils.get_param(self.clip_model).dtype
 
+    def keep_in_memory(self):
+        return shared.opts.interrogate_keep_models_in_memory or self.resident_jobs > 0
+
+    @contextlib.contextmanager
+    def resident(self):
+        """While active, models stay on interrogate device between calls instead of being moved to RAM after each one."""
+
+        self.resident_jobs += 1
+        try:
+            yield
+        finally:
+            self.resident_jobs -= 1
+            self.unload()
+
     def send_clip_to_ram(self):
-        if not shared.opts.interrogate_keep_models_in_memory:
+        if not self.keep_in_memory():
             if self.clip_model is not None:
                 self.clip_model = self.clip_model.to(devices.cpu)
 
     def send_blip_to_ram(self):
-        if not shared.opts.interrogate_keep_models_in_memory:
+        if not self.keep_in_memory():
             if self.blip_model is not None:
                 self.blip_model = self.blip_model.to(devices.cpu)
 
@@ -147,40 +184,208 @@ class InterrogateModels:
         self.send_clip_to_ram()
         self.send_blip_to_ram()
 
+        if not self.keep_in_memory():
+            self.categories_features = None
+
         devices.torch_gc()
 
-    def rank(self, image_features, text_array, top_count=1):
+    def encode_text_features(self, items):
+        """Returns normalized CLIP text features for items as a float16 numpy array of shape (len(items), features)."""
+
         import clip
 
-        devices.torch_gc()
+        res = []
+        for i in range(0, len(items), text_features_batch_size):
+            text_tokens = clip.tokenize(items[i:i + text_features_batch_size], truncate=True).to(devices.device_interrogate)
+            text_features = self.clip_model.encode_text(text_tokens).float()
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+            res.append(text_features.half().cpu())
 
-        if shared.opts.interrogate_clip_dict_limit != 0:
-            text_array = text_array[0:int(shared.opts.interrogate_clip_dict_limit)]
+        if not res:
+            return np.zeros((0, self.clip_model.text_projection.shape[1]), dtype=np.float16)
 
-        top_count = min(top_count, len(text_array))
-        text_tokens = clip.tokenize(list(text_array), truncate=True).to(devices.device_interrogate)
-        text_features = self.clip_model.encode_text(text_tokens).type(self.dtype)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
+        return torch.cat(res).numpy()
 
-        similarity = torch.zeros((1, len(text_array))).to(devices.device_interrogate)
-        for i in range(image_features.shape[0]):
-            similarity += (100.0 * image_features[i].unsqueeze(0) @ text_features.T).softmax(dim=-1)
-        similarity /= image_features.shape[0]
+    def get_text_features(self, items, content_hash=None):
+        """
+        Returns normalized CLIP text features for items as a CPU tensor. Features are computed once for every list of items
+        and stored in cache directory, from where they are memory-mapped.
+        """
 
-        top_probs, top_labels = similarity.cpu().topk(top_count, dim=-1)
-        return [(text_array[top_labels[0][i].numpy()], (top_probs[0][i].numpy()*100)) for i in range(top_count)]
+        content_hash = content_hash or items_hash(items)
 
-    def generate_caption(self, pil_image):
-        gpu_image = transforms.Compose([
+        features = self.text_features.get(content_hash)
+        if features is not None:
+            return features
+
+        filename = text_features_filename(content_hash)
+
+        array = None
+        if os.path.exists(filename):
+            try:
+                # copy-on-write mapping gives a writable array that torch accepts without copying the file into memory
+                array = np.load(filename, mmap_mode="c")
+            except Exception:
+                errors.report(f"Error loading CLIP text features from {filename}", exc_info=True)
+
+            if array is not None and array.shape[0] != len(items):
+                array = None
+
+        if array is None:
+            array = self.encode_text_features(items)
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(f"{filename}.tmp", "wb") as file:
+                np.save(file, array)
+            os.replace(f"{filename}.tmp", filename)
+
+        features = torch.from_numpy(array)
+        self.text_features[content_hash] = features
+
+        return features
+
+    def categories_text_features(self, categories):
+        """
+        Returns text features of items of all categories stacked into one matrix on interrogate device, and a list of
+        (start, end) row ranges of categories in it. Only first interrogate_clip_dict_limit items of each category are used.
+        """
+
+        limit = int(shared.opts.interrogate_clip_dict_limit)
+        counts = [len(cat.items) if limit == 0 else min(limit, len(cat.items)) for cat in categories]
+        key = ([cat.content_hash or items_hash(cat.items) for cat in categories], counts, self.dtype, devices.device_interrogate)
+
+        if self.categories_features is not None and self.categories_features[0] == key:
+            return self.categories_features[1], self.categories_features[2]
+
+        parts = [self.get_text_features(cat.items, content_hash)[:count] for cat, content_hash, count in zip(categories, key[0], counts)]
+        features = torch.cat(parts).to(devices.device_interrogate, dtype=self.dtype)
+
+        slices = []
+        start = 0
+        for count in counts:
+            slices.append((start, start + count))
+            start += count
+
+        self.categories_features = (key, features, slices)
+
+        return features, slices
+
+    def rank_categories(self, image_features, categories):
+        """
+        For every category, returns a list of its topn items that are most similar to image_features, as (item, score) tuples.
+        Similarities with items of all categories are calculated with a single matrix multiplication.
+        """
+
+        if not categories:
+            return []
+
+        text_features, slices = self.categories_text_features(categories)
+        similarity = (100.0 * image_features.type(self.dtype) @ text_features.T).float()
+
+        return self.top_matches(similarity, categories, slices)
+
+    def rank_categories_batch(self, image_features, categories):
+        """Same as rank_categories, but every row of image_features is a separate image; returns a list with a result for every image."""
+
+        if not categories:
+            return [[] for _ in range(image_features.shape[0])]
+
+        text_features, slices = self.categories_text_features(categories)
+        similarity = (100.0 * image_features.type(self.dtype) @ text_features.T).float()
+
+        return [self.top_matches(similarity[i:i + 1], categories, slices) for i in range(similarity.shape[0])]
+
+    @staticmethod
+    def top_matches(similarity, categories, slices):
+        res = []
+        for cat, (start, end) in zip(categories, slices):
+            probs = similarity[:, start:end].softmax(dim=-1).mean(dim=0)
+
+            top_probs, top_labels = probs.cpu().topk(min(cat.topn, end - start))
+            res.append([(cat.items[label], prob * 100) for prob, label in zip(top_probs.tolist(), top_labels.tolist())])
+
+        return res
+
+    def rank(self, image_features, text_array, top_count=1):
+        return self.rank_categories(image_features, [Category(name="", topn=top_count, items=list(text_array))])[0]
+
+    @staticmethod
+    def blip_preprocess(pil_image):
+        return transforms.Compose([
             transforms.Resize((blip_image_eval_size, blip_image_eval_size), interpolation=InterpolationMode.BICUBIC),
             transforms.ToTensor(),
             transforms.Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
-        ])(pil_image).unsqueeze(0).type(self.dtype).to(devices.device_interrogate)
+        ])(pil_image)
+
+    def generate_captions(self, blip_images):
+        """Returns a list of BLIP captions for a batch of images made by blip_preprocess() stacked together."""
+
+        gpu_images = blip_images.type(self.dtype).to(devices.device_interrogate)
 
         with torch.no_grad():
-            caption = self.blip_model.generate(gpu_image, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
+            return self.blip_model.generate(gpu_images, sample=False, num_beams=shared.opts.interrogate_clip_num_beams, min_length=shared.opts.interrogate_clip_min_length, max_length=shared.opts.interrogate_clip_max_length)
 
-        return caption[0]
+    def generate_caption(self, pil_image):
+        return self.generate_captions(self.blip_preprocess(pil_image).unsqueeze(0))[0]
+
+    @staticmethod
+    def format_matches(caption, categories_matches):
+        res = caption
+
+        for matches in categories_matches:
+            for match, score in matches:
+                if shared.opts.interrogate_return_ranks:
+                    res += f", ({match}:{score/100:.3f})"
+                else:
+                    res += f", {match}"
+
+        return res
+
+    def preprocess(self, pil_image):
+        """
+        Returns a tuple of BLIP and CLIP inputs made from the image, as CPU tensors. Models must be loaded by load() first;
+        this does not run them, so it can be called from other threads.
+        """
+
+        pil_image = pil_image.convert("RGB")
+        return self.blip_preprocess(pil_image), self.clip_preprocess(pil_image)
+
+    def interrogate_preprocessed(self, inputs):
+        """
+        Returns a list of captions for a list of images, given as inputs made by preprocess(). Captioning and ranking are each
+        done for the whole list at once. Models must be loaded by load() first, and they are not unloaded.
+        """
+
+        captions = self.generate_captions(torch.stack([blip_image for blip_image, _ in inputs]))
+        clip_images = torch.stack([clip_image for _, clip_image in inputs])
+
+        with torch.no_grad(), devices.autocast():
+            image_features = self.clip_model.encode_image(clip_images.type(self.dtype).to(devices.device_interrogate)).type(self.dtype)
+            image_features /= image_features.norm(dim=-1, keepdim=True)
+
+            ranks = self.rank_categories_batch(image_features, self.categories())
+
+        return [self.format_matches(caption, categories_matches) for caption, categories_matches in zip(captions, ranks)]
+
+    def interrogate_batch(self, pil_images):
+        """Returns a list of captions for images, same as calling interrogate() for every one of them, but with images processed in batches."""
+
+        res = []
+        shared.state.begin(job="interrogate")
+        try:
+            lowvram.send_everything_to_cpu()
+            devices.torch_gc()
+
+            with self.resident():
+                self.load()
+
+                batch_size = max(1, shared.opts.interrogate_batch_size)
+                for i in range(0, len(pil_images), batch_size):
+                    res += self.interrogate_preprocessed([self.preprocess(x) for x in pil_images[i:i + batch_size]])
+        finally:
+            shared.state.end()
+
+        return res
 
     def interrogate(self, pil_image):
         res = ""
@@ -204,13 +409,7 @@ class InterrogateModels:
 
                 image_features /= image_features.norm(dim=-1, keepdim=True)
 
-                for cat in self.categories():
-                    matches = self.rank(image_features, cat.items, top_count=cat.topn)
-                    for match, score in matches:
-                        if shared.opts.interrogate_return_ranks:
-                            res += f", ({match}:{score/100:.3f})"
-                        else:
-                            res += f", {match}"
+                res = self.format_matches(res, self.rank_categories(image_features, self.categories()))
 
         except Exception:
             errors.report("Error interrogating", exc_info=True)
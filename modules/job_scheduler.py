@@ -0,0 +1,169 @@
+import contextlib
+import threading
+import time
+
+from modules import shared, metrics
+
+
+class Waiter:
+    def __init__(self, task_id, key):
+        self.task_id = task_id
+        self.key = key
+        self.event = threading.Event()
+        self.skips = 0
+        self.created_at = time.time()
+
+
+def key_similarity(a, b):
+    """Compares two (checkpoint, VAE, width, height) keys; tuples compare so that same checkpoint matters most, then VAE, then resolution."""
+
+    if a is None or b is None:
+        return False, False, False
+
+    return a[0] == b[0], a[0] == b[0] and a[1] == b[1], a[0] == b[0] and a[1] == b[1] and a[2:] == b[2:]
+
+
+class JobScheduler:
+    """
+    A lock that can be used instead of FIFOLock. When api_job_grouping setting is disabled, waiting threads get the
+    lock in order of arrival. When enabled, the lock goes to the waiting job most similar to the job that just finished
+    (by checkpoint, then VAE, then resolution; see key_similarity), so that jobs using the same checkpoint run back to
+    back instead of switching models for every job. A job that has been passed over api_job_grouping_max_skips times
+    is served next regardless, which bounds how long a job can wait.
+
+    The lock is handed over directly to the chosen waiter on release, so a thread that comes later can't take it first.
+    """
+
+    def __init__(self):
+        self._inner_lock = threading.Lock()
+        self._locked = False
+        self._waiters = []
+        self._current_key = None
+        self._last_key = None
+        self._acquired_at = None
+        self.average_duration = None
+        """exponential moving average of how long, in seconds, a job holds the lock"""
+
+    def acquire(self, blocking=True, task_id=None, key=None):
+        with self._inner_lock:
+            if not self._locked:
+                self._locked = True
+                self._on_acquired(key)
+                metrics.queue_wait_seconds.observe(0.0)
+                return True
+
+            if not blocking:
+                return False
+
+            waiter = Waiter(task_id, key)
+            self._waiters.append(waiter)
+
+        waiter.event.wait()
+        metrics.queue_wait_seconds.observe(time.time() - waiter.created_at)
+        return True
+
+    def release(self):
+        with self._inner_lock:
+            self._on_released()
+
+            waiter = self._choose(self._waiters, self._last_key, count_skips=True)
+            if waiter is None:
+                self._locked = False
+                return
+
+            self._waiters.remove(waiter)
+            self._on_acquired(waiter.key)
+            waiter.event.set()
+
+    __enter__ = acquire
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
+    @contextlib.contextmanager
+    def job(self, task_id=None, key=None):
+        """Context manager for holding the lock for a job; key is a (checkpoint, VAE, width, height) tuple, or None if unknown."""
+
+        self.acquire(task_id=task_id, key=key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _on_acquired(self, key):
+        self._current_key = key
+        self._acquired_at = time.time()
+
+    def _on_released(self):
+        duration = time.time() - self._acquired_at
+        self.average_duration = duration if self.average_duration is None else self.average_duration * 0.8 + duration * 0.2
+        self._last_key = self._current_key
+
+    @staticmethod
+    def _choose(waiters, last_key, count_skips=False):
+        if not waiters:
+            return None
+
+        if not shared.opts.api_job_grouping:
+            return waiters[0]
+
+        starving = [w for w in waiters if w.skips >= shared.opts.api_job_grouping_max_skips]
+        if starving:
+            chosen = starving[0]
+        else:
+            # max() returns the first of equal elements, so ties go to the job that came first
+            chosen = max(waiters, key=lambda w: key_similarity(w.key, last_key))
+
+        if count_skips:
+            for w in waiters:
+                if w is chosen:
+                    break
+
+                w.skips += 1
+
+        return chosen
+
+    def waiting_count(self):
+        with self._inner_lock:
+            return len(self._waiters)
+
+    def expected_waits(self):
+        """Returns a dict mapping task ids of waiting jobs to expected number of seconds until they start, in expected order."""
+
+        with self._inner_lock:
+            if not self._locked:
+                return {}
+
+            average_duration = self.average_duration or 0
+            remaining = max(0.0, average_duration - (time.time() - self._acquired_at))
+
+            waiters = [Waiter(w.task_id, w.key) for w in self._waiters]
+            for copy, w in zip(waiters, self._waiters):
+                copy.skips = w.skips
+
+            last_key = self._current_key
+
+        res = {}
+        while waiters:
+            waiter = self._choose(waiters, last_key, count_skips=True)
+            waiters.remove(waiter)
+
+            if waiter.task_id is not None:
+                res[waiter.task_id] = remaining
+
+            remaining += average_duration
+            last_key = waiter.key
+
+        return res
+
+    def expected_wait(self):
+        """Expected number of seconds until a job submitted now would start, assuming it won't be grouped with anything."""
+
+        with self._inner_lock:
+            if not self._locked:
+                return 0.0
+
+            average_duration = self.average_duration or 0
+            remaining = max(0.0, average_duration - (time.time() - self._acquired_at))
+
+            return remaining + average_duration * len(self._waiters)
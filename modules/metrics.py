@@ -0,0 +1,247 @@
+"""
+Counters, gauges and histograms for monitoring and autoscaling, served by /metrics in Prometheus text exposition format.
+
+Code that knows when something happens updates a metric directly (metric.inc(), metric.observe()). Values that already
+exist elsewhere, such as cache statistics or memory use, are copied into metrics by collectors - functions registered
+with add_collector() that run every time metrics are exported.
+"""
+
+import bisect
+import threading
+
+from modules import errors
+
+default_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0]
+"""upper bounds, in seconds, of histogram buckets"""
+
+registry = {}
+"""maps metric name to Metric, in order of creation"""
+
+registry_lock = threading.Lock()
+
+collectors = []
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{k}="{escape_label_value(v)}"' for k, v in labels) + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        """maps a tuple of label values to the value"""
+
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"metric {self.name} has labels {self.labelnames}, got {tuple(labels)}")
+
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def samples(self):
+        """Returns a list of (name, labels, value) tuples, where labels is a tuple of (name, value) pairs."""
+
+        with self.lock:
+            return [(self.name, tuple(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+    def exposition(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up. set() is for counters kept elsewhere, which are copied by collectors."""
+
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        with self.lock:
+            key = self.key(labels)
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets or default_buckets)
+
+    def observe(self, value, **labels):
+        with self.lock:
+            key = self.key(labels)
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = HistogramValue(self.buckets)
+
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry.counts[index] += 1
+
+            entry.count += 1
+            entry.total += value
+
+    def samples(self):
+        res = []
+
+        with self.lock:
+            for key, entry in self.values.items():
+                labels = tuple(zip(self.labelnames, key))
+
+                cumulative = 0
+                for bound, count in zip(self.buckets, entry.counts):
+                    cumulative += count
+                    res.append((f"{self.name}_bucket", labels + (("le", format_value(float(bound))),), cumulative))
+
+                res.append((f"{self.name}_bucket", labels + (("le", "+Inf"),), entry.count))
+                res.append((f"{self.name}_sum", labels, entry.total))
+                res.append((f"{self.name}_count", labels, entry.count))
+
+        return res
+
+
+def register(cls, name, documentation, labelnames=(), **kwargs):
+    """Returns the metric with specified name, creating it if it does not exist yet, so modules that are reloaded get the same metric."""
+
+    with registry_lock:
+        metric = registry.get(name)
+        if metric is None:
+            metric = registry[name] = cls(name, documentation, labelnames, **kwargs)
+        elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+            raise ValueError(f"metric {name} is already registered with a different type or labels")
+
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    return register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=None):
+    return register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def add_collector(func):
+    """Adds a function that updates metrics with current values; it is called every time metrics are exported."""
+
+    if func not in collectors:
+        collectors.append(func)
+
+
+def exposition():
+    """Returns all metrics as text in Prometheus exposition format."""
+
+    for func in list(collectors):
+        try:
+            func()
+        except Exception as e:
+            errors.report(f"Error collecting metrics with {func}: {e}", exc_info=True)
+
+    with registry_lock:
+        metrics = list(registry.values())
+
+    lines = []
+    for metric in metrics:
+        lines += metric.exposition()
+
+    return "\n".join(lines) + "\n"
+
+
+component_seconds = histogram("sd_component_duration_seconds", "Time spent in a component of a generation job, such as UNet, VAE decode or text encoding", ["component"])
+job_seconds = histogram("sd_job_duration_seconds", "Time it took to run a generation job")
+queue_wait_seconds = histogram("sd_queue_wait_seconds", "Time a job waited in queue before starting")
+queue_length = gauge("sd_queue_length", "Number of jobs waiting in queue")
+images_total = counter("sd_images_generated_total", "Number of images generated; images per second is the rate of this divided by the rate of sd_job_duration_seconds_sum")
+sampling_steps_total = counter("sd_sampling_steps_total", "Number of sampling steps done", ["sampler"])
+sampling_seconds_total = counter("sd_sampling_seconds_total", "Time spent sampling; iterations per second is the rate of sd_sampling_steps_total divided by the rate of this", ["sampler"])
+model_swap_seconds = histogram("sd_model_swap_seconds", "Time it took to switch to another checkpoint, by where its weights were found", ["source"])
+cache_lookups_total = counter("sd_cache_lookups_total", "Number of lookups in a cache", ["cache", "result"])
+cache_entries = gauge("sd_cache_entries", "Number of entries in a cache", ["cache"])
+cache_bytes = gauge("sd_cache_bytes", "Size of entries in a cache", ["cache"])
+ram_bytes = gauge("sd_ram_bytes", "System memory: used by this process, and total", ["kind"])
+vram_bytes = gauge("sd_vram_bytes", "GPU memory: free and total as reported by the driver, allocated and reserved by torch, with peaks", ["kind"])
+
+
+def collect_memory():
+    try:
+        import os
+        import psutil
+
+        process = psutil.Process(os.getpid())
+        ram_bytes.set(process.memory_info().rss, kind="used")
+        ram_bytes.set(psutil.virtual_memory().total, kind="total")
+    except Exception:
+        pass
+
+    import torch
+
+    if not torch.cuda.is_available():
+        return
+
+    from modules import devices
+
+    free, total = torch.cuda.mem_get_info()
+    vram_bytes.set(free, kind="free")
+    vram_bytes.set(total, kind="total")
+
+    stats = torch.cuda.memory_stats(devices.device)
+    vram_bytes.set(stats.get("allocated_bytes.all.current", 0), kind="allocated")
+    vram_bytes.set(stats.get("allocated_bytes.all.peak", 0), kind="allocated_peak")
+    vram_bytes.set(stats.get("reserved_bytes.all.current", 0), kind="reserved")
+    vram_bytes.set(stats.get("reserved_bytes.all.peak", 0), kind="reserved_peak")
+
+
+add_collector(collect_memory)
@@ -1,11 +1,20 @@
+import contextlib
 import os
 
 from PIL import Image
 
-from modules import shared, images, devices, scripts, scripts_postprocessing, ui_common, infotext_utils
+from modules import shared, images, devices, scripts, scripts_postprocessing, ui_common, infotext_utils, deepbooru
 from modules.shared import opts
 
 
+@contextlib.contextmanager
+def models_resident():
+    """Keeps interrogate and DeepBooru models on device until the end of the job, so scripts captioning every image only load them once."""
+
+    with shared.interrogator.resident(), deepbooru.model.resident():
+        yield
+
+
 def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output: bool = True):
     devices.torch_gc()
 
@@ -44,89 +53,110 @@ def run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir,
     data_to_process = list(get_images(extras_mode, image, image_folder, input_dir))
     shared.state.job_count = len(data_to_process)
 
-    for image_placeholder, name in data_to_process:
-        image_data: Image.Image
+    with models_resident():
+        for image_placeholder, name in data_to_process:
+            image_data: Image.Image
+
+            shared.state.nextjob()
+            shared.state.textinfo = name
+            shared.state.skipped = False
 
-        shared.state.nextjob()
-        shared.state.textinfo = name
-        shared.state.skipped = False
+            if shared.state.interrupted or shared.state.stopping_generation:
+                break
 
-        if shared.state.interrupted or shared.state.stopping_generation:
-            break
+            if isinstance(image_placeholder, str):
+                try:
+                    image_data = images.read(image_placeholder)
+                except Exception:
+                    continue
+            else:
+                image_data = image_placeholder
 
-        if isinstance(image_placeholder, str):
-            try:
-                image_data = images.read(image_placeholder)
-            except Exception:
+            results = postprocess_image(image_data, name, args, outpath=outpath, save_output=save_output)
+            if results is None:
                 continue
-        else:
-            image_data = image_placeholder
 
-        image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
+            for image_result, infotext in results:
+                if extras_mode != 2 or show_extras_results:
+                    outputs.append(image_result)
 
-        parameters, existing_pnginfo = images.read_info_from_image(image_data)
-        if parameters:
-            existing_pnginfo["parameters"] = parameters
+    devices.torch_gc()
+    shared.state.end()
+    return outputs, ui_common.plaintext_to_html(infotext), ''
 
-        initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
 
-        scripts.scripts_postproc.run(initial_pp, args)
+def postprocess_image(image_data, name, args, *, outpath=None, save_output=False):
+    """
+    Runs postprocessing scripts on one image, saving results into outpath if save_output is set. Returns a list of (image, infotext)
+    tuples for the processed image followed by extra images made by scripts, or None if the image was skipped.
+    """
 
-        if shared.state.skipped:
-            continue
+    image_data = image_data if image_data.mode in ("RGBA", "RGB") else image_data.convert("RGB")
 
-        used_suffixes = {}
-        for pp in [initial_pp, *initial_pp.extra_images]:
-            suffix = pp.get_suffix(used_suffixes)
+    parameters, existing_pnginfo = images.read_info_from_image(image_data)
+    if parameters:
+        existing_pnginfo["parameters"] = parameters
 
-            if opts.use_original_name_batch and name is not None:
-                basename = os.path.splitext(os.path.basename(name))[0]
-                forced_filename = basename + suffix
-            else:
-                basename = ''
-                forced_filename = None
-
-            infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
-
-            if opts.enable_pnginfo:
-                pp.image.info = existing_pnginfo
-                pp.image.info["postprocessing"] = infotext
-
-            shared.state.assign_current_image(pp.image)
-
-            if save_output:
-                fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
-
-                if pp.caption:
-                    caption_filename = os.path.splitext(fullfn)[0] + ".txt"
-                    existing_caption = ""
-                    try:
-                        with open(caption_filename, encoding="utf8") as file:
-                            existing_caption = file.read().strip()
-                    except FileNotFoundError:
-                        pass
-
-                    action = shared.opts.postprocessing_existing_caption_action
-                    if action == 'Prepend' and existing_caption:
-                        caption = f"{existing_caption} {pp.caption}"
-                    elif action == 'Append' and existing_caption:
-                        caption = f"{pp.caption} {existing_caption}"
-                    elif action == 'Keep' and existing_caption:
-                        caption = existing_caption
-                    else:
-                        caption = pp.caption
-
-                    caption = caption.strip()
-                    if caption:
-                        with open(caption_filename, "w", encoding="utf8") as file:
-                            file.write(caption)
-
-            if extras_mode != 2 or show_extras_results:
-                outputs.append(pp.image)
+    initial_pp = scripts_postprocessing.PostprocessedImage(image_data)
 
-    devices.torch_gc()
-    shared.state.end()
-    return outputs, ui_common.plaintext_to_html(infotext), ''
+    scripts.scripts_postproc.run(initial_pp, args)
+
+    if shared.state.skipped:
+        return None
+
+    results = []
+
+    used_suffixes = {}
+    for pp in [initial_pp, *initial_pp.extra_images]:
+        suffix = pp.get_suffix(used_suffixes)
+
+        if opts.use_original_name_batch and name is not None:
+            basename = os.path.splitext(os.path.basename(name))[0]
+            forced_filename = basename + suffix
+        else:
+            basename = ''
+            forced_filename = None
+
+        infotext = ", ".join([k if k == v else f'{k}: {infotext_utils.quote(v)}' for k, v in pp.info.items() if v is not None])
+
+        if opts.enable_pnginfo:
+            pp.image.info = existing_pnginfo
+            pp.image.info["postprocessing"] = infotext
+
+        shared.state.assign_current_image(pp.image)
+
+        if save_output:
+            fullfn, _ = images.save_image(pp.image, path=outpath, basename=basename, extension=opts.samples_format, info=infotext, short_filename=True, no_prompt=True, grid=False, pnginfo_section_name="extras", existing_info=existing_pnginfo, forced_filename=forced_filename, suffix=suffix)
+
+            if pp.caption:
+                images.background_saver.wait(fullfn)  # background saver may write the infotext .txt file with the same name
+
+                caption_filename = os.path.splitext(fullfn)[0] + ".txt"
+                existing_caption = ""
+                try:
+                    with open(caption_filename, encoding="utf8") as file:
+                        existing_caption = file.read().strip()
+                except FileNotFoundError:
+                    pass
+
+                action = shared.opts.postprocessing_existing_caption_action
+                if action == 'Prepend' and existing_caption:
+                    caption = f"{existing_caption} {pp.caption}"
+                elif action == 'Append' and existing_caption:
+                    caption = f"{pp.caption} {existing_caption}"
+                elif action == 'Keep' and existing_caption:
+                    caption = existing_caption
+                else:
+                    caption = pp.caption
+
+                caption = caption.strip()
+                if caption:
+                    with open(caption_filename, "w", encoding="utf8") as file:
+                        file.write(caption)
+
+        results.append((pp.image, infotext))
+
+    return results
 
 
 def run_postprocessing_webui(id_task, *args, **kwargs):
@@ -136,7 +166,15 @@ def run_postprocessing_webui(id_task, *args, **kwargs):
 def run_extras(extras_mode, resize_mode, image, image_folder, input_dir, output_dir, show_extras_results, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, upscale_first: bool, save_output: bool = True, max_side_length: int = 0):
     """old handler for API"""
 
-    args = scripts.scripts_postproc.create_args_for_run({
+    args = create_args_for_extras(resize_mode, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, max_side_length)
+
+    return run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output=save_output)
+
+
+def create_args_for_extras(resize_mode, gfpgan_visibility, codeformer_visibility, codeformer_weight, upscaling_resize, upscaling_resize_w, upscaling_resize_h, upscaling_crop, extras_upscaler_1, extras_upscaler_2, extras_upscaler_2_visibility, max_side_length: int = 0):
+    """converts arguments of old API handler into args for postprocessing scripts"""
+
+    return scripts.scripts_postproc.create_args_for_run({
         "Upscale": {
             "upscale_enabled": True,
             "upscale_mode": resize_mode,
@@ -159,5 +197,3 @@ def run_extras(extras_mode, resize_mode, image, image_folder, input_dir, output_
             "codeformer_weight": codeformer_weight,
         },
     })
-
-    return run_postprocessing(extras_mode, image, image_folder, input_dir, output_dir, show_extras_results, *args, save_output=save_output)
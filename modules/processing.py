@@ -5,6 +5,7 @@ import math
 import os
 import sys
 import hashlib
+import time
 from dataclasses import dataclass, field
 
 import torch
@@ -16,7 +17,7 @@ from skimage import exposure
 from typing import Any
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, profiling, sd_hijack_optimizations, sd_vae_tiled, sd_hijack_clip, step_profiler, metrics
 from modules.rng import slerp # noqa: F401
 from modules.sd_hijack import model_hijack
 from modules.sd_samplers_common import images_tensor_to_samples, decode_first_stage, approximation_indexes
@@ -490,6 +491,26 @@ class StableDiffusionProcessing:
         cache[0] = cached_params
         return cache[1]
 
+    def encoding_plan(self, *calls):
+        """
+        Returns a context manager, inside of which get_conds_with_caching calls with arguments from calls (tuples of function,
+        required_prompts, steps, caches, extra_network_data, hires_steps) use text encoder outputs computed for all of them at once
+        (see sd_hijack_clip.encoding_plan). Calls whose result is already cached are skipped.
+        """
+
+        batches = []
+        for function, required_prompts, steps, caches, extra_network_data, hires_steps in calls:
+            cached_params = self.cached_params(required_prompts, steps, extra_network_data, hires_steps, shared.opts.use_old_scheduling)
+            if any(cache[0] is not None and cached_params == cache[0] for cache in caches):
+                continue
+
+            if function == prompt_parser.get_multicond_learned_conditioning:
+                batches += prompt_parser.get_multicond_learned_conditioning_batches(required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
+            else:
+                batches += prompt_parser.get_learned_conditioning_batches(required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
+
+        return sd_hijack_clip.encoding_plan(shared.sd_model, batches)
+
     def setup_conds(self):
         prompts = prompt_parser.SdConditioning(self.prompts, width=self.width, height=self.height)
         negative_prompts = prompt_parser.SdConditioning(self.negative_prompts, width=self.width, height=self.height, is_negative_prompt=True)
@@ -499,8 +520,12 @@ class StableDiffusionProcessing:
         self.step_multiplier = total_steps // self.steps
         self.firstpass_steps = total_steps
 
-        self.uc = self.get_conds_with_caching(prompt_parser.get_learned_conditioning, negative_prompts, total_steps, [self.cached_uc], self.extra_network_data)
-        self.c = self.get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, prompts, total_steps, [self.cached_c], self.extra_network_data)
+        uc_args = (prompt_parser.get_learned_conditioning, negative_prompts, total_steps, [self.cached_uc], self.extra_network_data, None)
+        c_args = (prompt_parser.get_multicond_learned_conditioning, prompts, total_steps, [self.cached_c], self.extra_network_data, None)
+
+        with step_profiler.span("text encoding"), self.encoding_plan(uc_args, c_args):
+            self.uc = self.get_conds_with_caching(*uc_args)
+            self.c = self.get_conds_with_caching(*c_args)
 
     def get_conds(self):
         return self.c, self.uc
@@ -568,6 +593,9 @@ class Processed:
         self.infotexts = infotexts or [info] * len(images_list)
         self.version = program_version()
 
+        self.profile = None
+        """time spent in generation components, see step_profiler.JobProfile.result()"""
+
     def js(self):
         obj = {
             "prompt": self.all_prompts[0],
@@ -602,6 +630,7 @@ class Processed:
             "clip_skip": self.clip_skip,
             "is_using_inpainting_conditioning": self.is_using_inpainting_conditioning,
             "version": self.version,
+            "profile": self.profile,
         }
 
         return json.dumps(obj, default=lambda o: None)
@@ -622,52 +651,93 @@ class DecodedSamples(list):
     already_decoded = True
 
 
+def get_vae_decode_batch_size(batch):
+    """Returns how many samples decode_latent_batch decodes at once: sd_vae_decode_batch_size setting, or, if it's 0, as many as fit into free memory."""
+
+    if shared.opts.sd_vae_decode_batch_size > 0:
+        return min(shared.opts.sd_vae_decode_batch_size, batch.shape[0])
+
+    if sd_vae_tiled.should_tile(batch.shape[2], batch.shape[3]):
+        return 1
+
+    element_size = torch.tensor([], dtype=devices.dtype_vae).element_size()
+    bytes_per_sample = batch.shape[2] * batch.shape[3] * sd_vae_tiled.bytes_per_latent_pixel * element_size
+
+    available = sd_hijack_optimizations.get_available_vram()
+
+    return max(1, min(batch.shape[0], int(available // bytes_per_sample)))
+
+
+def autofix_vae_nans(model, e):
+    """Called when VAE produces NaNs; converts VAE to a more precise dtype if settings allow it, or re-raises the exception."""
+
+    if shared.opts.auto_vae_precision_bfloat16:
+        autofix_dtype = torch.bfloat16
+        autofix_dtype_text = "bfloat16"
+        autofix_dtype_setting = "Automatically convert VAE to bfloat16"
+        autofix_dtype_comment = ""
+    elif shared.opts.auto_vae_precision:
+        autofix_dtype = torch.float32
+        autofix_dtype_text = "32-bit float"
+        autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
+        autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
+    else:
+        raise e
+
+    if devices.dtype_vae == autofix_dtype:
+        raise e
+
+    errors.print_error_explanation(
+        "A tensor with all NaNs was produced in VAE.\n"
+        f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
+        f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
+    )
+
+    devices.dtype_vae = autofix_dtype
+    model.first_stage_model.to(devices.dtype_vae)
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
+    """Decodes latents with VAE in chunks of get_vae_decode_batch_size() samples; if a chunk does not fit into memory, it's split into smaller ones."""
+
     samples = DecodedSamples()
 
     if check_for_nans:
         devices.test_for_nans(batch, "unet")
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
-
-        if check_for_nans:
-
-            try:
-                devices.test_for_nans(sample, "vae")
-            except devices.NansException as e:
-                if shared.opts.auto_vae_precision_bfloat16:
-                    autofix_dtype = torch.bfloat16
-                    autofix_dtype_text = "bfloat16"
-                    autofix_dtype_setting = "Automatically convert VAE to bfloat16"
-                    autofix_dtype_comment = ""
-                elif shared.opts.auto_vae_precision:
-                    autofix_dtype = torch.float32
-                    autofix_dtype_text = "32-bit float"
-                    autofix_dtype_setting = "Automatically revert VAE to 32-bit floats"
-                    autofix_dtype_comment = "\nTo always start with 32-bit VAE, use --no-half-vae commandline flag."
-                else:
-                    raise e
+    chunk_size = get_vae_decode_batch_size(batch)
 
-                if devices.dtype_vae == autofix_dtype:
-                    raise e
+    i = 0
+    while i < batch.shape[0]:
+        try:
+            with step_profiler.span("vae decode"):
+                decoded = decode_first_stage(model, batch[i:i + chunk_size])
+        except torch.cuda.OutOfMemoryError:
+            if chunk_size == 1:
+                raise
 
-                errors.print_error_explanation(
-                    "A tensor with all NaNs was produced in VAE.\n"
-                    f"Web UI will now convert VAE into {autofix_dtype_text} and retry.\n"
-                    f"To disable this behavior, disable the '{autofix_dtype_setting}' setting.{autofix_dtype_comment}"
-                )
+            chunk_size = max(1, chunk_size // 2)
+            devices.torch_gc()
+            continue
 
-                devices.dtype_vae = autofix_dtype
-                model.first_stage_model.to(devices.dtype_vae)
-                batch = batch.to(devices.dtype_vae)
+        for j, sample in enumerate(decoded):
+            if check_for_nans:
+                try:
+                    devices.test_for_nans(sample, "vae")
+                except devices.NansException as e:
+                    autofix_vae_nans(model, e)
+                    batch = batch.to(devices.dtype_vae)
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+                    # the rest of the chunk was decoded with the old dtype too, so it's decoded again starting from this sample
+                    i += j
+                    break
 
-        if target_device is not None:
-            sample = sample.to(target_device)
+            if target_device is not None:
+                sample = sample.to(target_device)
 
-        samples.append(sample)
+            samples.append(sample)
+        else:
+            i += decoded.shape[0]
 
     return samples
 
@@ -843,9 +913,16 @@ def process_images(p: StableDiffusionProcessing) -> Processed:
         # backwards compatibility, fix sampler and scheduler if invalid
         sd_samplers.fix_p_invalid_sampler_and_scheduler(p)
 
-        with profiling.Profiler():
+        started_at = time.perf_counter()
+
+        with profiling.Profiler(), step_profiler.job() as job_profile:
             res = process_images_inner(p)
 
+        metrics.job_seconds.observe(time.perf_counter() - started_at)
+
+        if job_profile is not None:
+            res.profile = job_profile.result()
+
     finally:
         sd_models.apply_token_merging(p.sd_model, 0)
 
@@ -984,13 +1061,14 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
             sd_models.apply_alpha_schedule_override(p.sd_model, p)
 
-            with devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
+            with step_profiler.span("sampling"), devices.without_autocast() if devices.unet_needs_upcast else devices.autocast():
                 samples_ddim = p.sample(conditioning=p.c, unconditional_conditioning=p.uc, seeds=p.seeds, subseeds=p.subseeds, subseed_strength=p.subseed_strength, prompts=p.prompts)
 
             if p.scripts is not None:
-                ps = scripts.PostSampleArgs(samples_ddim)
-                p.scripts.post_sample(p, ps)
-                samples_ddim = ps.samples
+                with step_profiler.span("postprocess scripts"):
+                    ps = scripts.PostSampleArgs(samples_ddim)
+                    p.scripts.post_sample(p, ps)
+                    samples_ddim = ps.samples
 
             if getattr(samples_ddim, 'already_decoded', False):
                 x_samples_ddim = samples_ddim
@@ -1004,6 +1082,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             x_samples_ddim = torch.stack(x_samples_ddim).float()
             x_samples_ddim = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
 
+            metrics.images_total.inc(len(x_samples_ddim))
+
             del samples_ddim
 
             if lowvram.is_enabled(shared.sd_model):
@@ -1014,14 +1094,15 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
             state.nextjob()
 
             if p.scripts is not None:
-                p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
+                with step_profiler.span("postprocess scripts"):
+                    p.scripts.postprocess_batch(p, x_samples_ddim, batch_number=n)
 
-                p.prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
-                p.negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                    p.prompts = p.all_prompts[n * p.batch_size:(n + 1) * p.batch_size]
+                    p.negative_prompts = p.all_negative_prompts[n * p.batch_size:(n + 1) * p.batch_size]
 
-                batch_params = scripts.PostprocessBatchListArgs(list(x_samples_ddim))
-                p.scripts.postprocess_batch_list(p, batch_params, batch_number=n)
-                x_samples_ddim = batch_params.images
+                    batch_params = scripts.PostprocessBatchListArgs(list(x_samples_ddim))
+                    p.scripts.postprocess_batch_list(p, batch_params, batch_number=n)
+                    x_samples_ddim = batch_params.images
 
             def infotext(index=0, use_main_prompt=False):
                 return create_infotext(p, p.prompts, p.seeds, p.subseeds, use_main_prompt=use_main_prompt, index=index, all_negative_prompts=p.negative_prompts)
@@ -1046,9 +1127,10 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 image = Image.fromarray(x_sample)
 
                 if p.scripts is not None:
-                    pp = scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image(p, pp)
-                    image = pp.image
+                    with step_profiler.span("postprocess scripts"):
+                        pp = scripts.PostprocessImageArgs(image)
+                        p.scripts.postprocess_image(p, pp)
+                        image = pp.image
 
                 mask_for_overlay = getattr(p, "mask_for_overlay", None)
 
@@ -1077,14 +1159,17 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 image, original_denoised_image = apply_overlay(image, p.paste_to, overlay_image)
 
                 if p.scripts is not None:
-                    pp = scripts.PostprocessImageArgs(image)
-                    p.scripts.postprocess_image_after_composite(p, pp)
-                    image = pp.image
+                    with step_profiler.span("postprocess scripts"):
+                        pp = scripts.PostprocessImageArgs(image)
+                        p.scripts.postprocess_image_after_composite(p, pp)
+                        image = pp.image
+
+                # infotext is made once per image while the GPU lock is held; saves below and the returned infotext share it
+                text = infotext(i)
 
                 if save_samples:
-                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p)
+                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=text, p=p)
 
-                text = infotext(i)
                 infotexts.append(text)
                 if opts.enable_pnginfo:
                     image.info["parameters"] = text
@@ -1094,14 +1179,14 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     if opts.return_mask or opts.save_mask:
                         image_mask = mask_for_overlay.convert('RGB')
                         if save_samples and opts.save_mask:
-                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask")
+                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=text, p=p, suffix="-mask")
                         if opts.return_mask:
                             output_images.append(image_mask)
 
                     if opts.return_mask_composite or opts.save_mask_composite:
                         image_mask_composite = Image.composite(original_denoised_image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(2, mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
                         if save_samples and opts.save_mask_composite:
-                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask-composite")
+                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=text, p=p, suffix="-mask-composite")
                         if opts.return_mask_composite:
                             output_images.append(image_mask_composite)
 
@@ -1118,16 +1203,16 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         unwanted_grid_because_of_img_count = len(output_images) < 2 and opts.grid_only_if_multiple
         if (opts.return_grid or opts.grid_save) and not p.do_not_save_grid and not unwanted_grid_because_of_img_count:
             grid = images.image_grid(output_images, p.batch_size)
+            text = infotext(use_main_prompt=True)
 
             if opts.return_grid:
-                text = infotext(use_main_prompt=True)
                 infotexts.insert(0, text)
                 if opts.enable_pnginfo:
                     grid.info["parameters"] = text
                 output_images.insert(0, grid)
                 index_of_first_image = 1
             if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=text, short_filename=not opts.grid_extended_filename, p=p, grid=True)
 
     if not p.disable_extra_networks and p.extra_network_data:
         extra_networks.deactivate(p, p.extra_network_data)
@@ -1145,7 +1230,8 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
     )
 
     if p.scripts is not None:
-        p.scripts.postprocess(p, res)
+        with step_profiler.span("postprocess scripts"):
+            p.scripts.postprocess(p, res)
 
     return res
 
@@ -1507,8 +1593,12 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
         steps = self.hr_second_pass_steps or self.steps
         total_steps = sampler_config.total_steps(steps) if sampler_config else steps
 
-        self.hr_uc = self.get_conds_with_caching(prompt_parser.get_learned_conditioning, hr_negative_prompts, self.firstpass_steps, [self.cached_hr_uc, self.cached_uc], self.hr_extra_network_data, total_steps)
-        self.hr_c = self.get_conds_with_caching(prompt_parser.get_multicond_learned_conditioning, hr_prompts, self.firstpass_steps, [self.cached_hr_c, self.cached_c], self.hr_extra_network_data, total_steps)
+        hr_uc_args = (prompt_parser.get_learned_conditioning, hr_negative_prompts, self.firstpass_steps, [self.cached_hr_uc, self.cached_uc], self.hr_extra_network_data, total_steps)
+        hr_c_args = (prompt_parser.get_multicond_learned_conditioning, hr_prompts, self.firstpass_steps, [self.cached_hr_c, self.cached_c], self.hr_extra_network_data, total_steps)
+
+        with step_profiler.span("text encoding"), self.encoding_plan(hr_uc_args, hr_c_args):
+            self.hr_uc = self.get_conds_with_caching(*hr_uc_args)
+            self.hr_c = self.get_conds_with_caching(*hr_c_args)
 
     def setup_conds(self):
         if self.is_hr_pass:
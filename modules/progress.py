@@ -11,7 +11,7 @@ import modules.shared as shared
 from collections import OrderedDict
 import string
 import random
-from typing import List
+from typing import Dict, List
 
 current_task = None
 pending_tasks = OrderedDict()
@@ -55,6 +55,8 @@ def add_task_to_queue(id_job):
 class PendingTasksResponse(BaseModel):
     size: int = Field(title="Pending task size")
     tasks: List[str] = Field(title="Pending task ids")
+    expected_wait: float = Field(default=None, title="Expected wait", description="expected number of seconds until a task submitted now would start")
+    expected_waits: Dict[str, float] = Field(default={}, title="Expected waits", description="expected number of seconds until each waiting task starts")
 
 class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
@@ -79,9 +81,15 @@ def setup_progress_api(app):
 
 
 def get_pending_tasks():
-    pending_tasks_ids = list(pending_tasks)
+    from modules.call_queue import queue_lock
+
+    expected_waits = queue_lock.expected_waits() if hasattr(queue_lock, 'expected_waits') else {}
+    expected_wait = queue_lock.expected_wait() if hasattr(queue_lock, 'expected_wait') else None
+
+    # tasks waiting for the lock are listed in the order they are expected to run, followed by ones that have not yet reached it
+    pending_tasks_ids = [x for x in expected_waits if x in pending_tasks] + [x for x in pending_tasks if x not in expected_waits]
     pending_len = len(pending_tasks_ids)
-    return PendingTasksResponse(size=pending_len, tasks=pending_tasks_ids)
+    return PendingTasksResponse(size=pending_len, tasks=pending_tasks_ids, expected_wait=expected_wait, expected_waits=expected_waits)
 
 
 def progressapi(req: ProgressRequest):
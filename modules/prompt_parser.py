@@ -202,6 +202,18 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
     return res
 
 
+def get_learned_conditioning_batches(prompts: SdConditioning | list[str], steps, hires_steps=None, use_old_scheduling=False):
+    """Returns lists of texts that get_learned_conditioning with same arguments passes to model.get_learned_conditioning, one for each unique prompt."""
+
+    prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps, hires_steps, use_old_scheduling)
+
+    res = {}
+    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+        res.setdefault(prompt, [x[1] for x in prompt_schedule])
+
+    return list(res.values())
+
+
 re_AND = re.compile(r"\bAND\b")
 re_weight = re.compile(r"^((?:\s|.)*?)(?:\s*:\s*([-+]?(?:\d+\.?|\d*\.\d+)))?\s*$")
 
@@ -267,6 +279,14 @@ def get_multicond_learned_conditioning(model, prompts, steps, hires_steps=None,
     return MulticondLearnedConditioning(shape=(len(prompts),), batch=res)
 
 
+def get_multicond_learned_conditioning_batches(prompts, steps, hires_steps=None, use_old_scheduling=False):
+    """same as get_learned_conditioning_batches, but for get_multicond_learned_conditioning"""
+
+    _, prompt_flat_list, _ = get_multicond_prompt_list(prompts)
+
+    return get_learned_conditioning_batches(prompt_flat_list, steps, hires_steps, use_old_scheduling)
+
+
 class DictWithShape(dict):
     def __init__(self, x, shape=None):
         super().__init__()
@@ -277,6 +297,16 @@ class DictWithShape(dict):
         return self["crossattn"].shape
 
 
+def get_schedule_index(cond_schedule: list[ScheduledPromptConditioning], current_step):
+    """Returns index of the entry in cond_schedule to be used at current_step."""
+
+    for current, entry in enumerate(cond_schedule):
+        if current_step <= entry.end_at_step:
+            return current
+
+    return 0
+
+
 def reconstruct_cond_batch(c: list[list[ScheduledPromptConditioning]], current_step):
     param = c[0][0].cond
     is_dict = isinstance(param, dict)
@@ -289,11 +319,7 @@ def reconstruct_cond_batch(c: list[list[ScheduledPromptConditioning]], current_s
         res = torch.zeros((len(c),) + param.shape, device=param.device, dtype=param.dtype)
 
     for i, cond_schedule in enumerate(c):
-        target_index = 0
-        for current, entry in enumerate(cond_schedule):
-            if current_step <= entry.end_at_step:
-                target_index = current
-                break
+        target_index = get_schedule_index(cond_schedule, current_step)
 
         if is_dict:
             for k, param in cond_schedule[target_index].cond.items():
@@ -328,11 +354,7 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
         conds_for_batch = []
 
         for composable_prompt in composable_prompts:
-            target_index = 0
-            for current, entry in enumerate(composable_prompt.schedules):
-                if current_step <= entry.end_at_step:
-                    target_index = current
-                    break
+            target_index = get_schedule_index(composable_prompt.schedules, current_step)
 
             conds_for_batch.append((len(tensors), composable_prompt.weight))
             tensors.append(composable_prompt.schedules[target_index].cond)
@@ -349,6 +371,75 @@ def reconstruct_multicond_batch(c: MulticondLearnedConditioning, current_step):
     return conds_list, stacked
 
 
+class CompiledCondBatch:
+    """
+    A batch of prompt schedules, as returned by get_learned_conditioning, compiled for lookup by sampling step. Conds used at
+    every step are stacked into one tensor in advance, once for every distinct combination of conds, so get(step) only copies
+    that tensor instead of doing what reconstruct_cond_batch does. Each combination is padded by stack_conds() only to the
+    longest of its own conds, so results are the same as from reconstruct_cond_batch, except that conds of different lengths
+    are padded rather than causing an error.
+    """
+
+    def __init__(self, c: list[list[ScheduledPromptConditioning]]):
+        last_step = max(entry.end_at_step for cond_schedule in c for entry in cond_schedule)
+
+        stacked_by_conds = {}
+        self.stacked_at_step = []
+        """for every step from 0 to last_step + 1, stacked conds to use; steps after that use the last element"""
+
+        for step in range(last_step + 2):
+            conds = [cond_schedule[get_schedule_index(cond_schedule, step)].cond for cond_schedule in c]
+
+            key = tuple(id(x) for x in conds)
+            stacked = stacked_by_conds.get(key)
+            if stacked is None:
+                stacked = stacked_by_conds[key] = self.stack(conds)
+
+            self.stacked_at_step.append(stacked)
+
+    @staticmethod
+    def stack(conds):
+        param = conds[0]
+
+        if isinstance(param, dict):
+            return {k: stack_conds([x[k] for x in conds]) for k in param.keys()}
+
+        return stack_conds(conds).to(device=param.device, dtype=param.dtype)
+
+    def get(self, current_step):
+        """Returns stacked conds for the step; it's a new tensor every time, so callers can change it."""
+
+        stacked = self.stacked_at_step[min(current_step, len(self.stacked_at_step) - 1)]
+
+        if isinstance(stacked, dict):
+            res = {k: v.clone() for k, v in stacked.items()}
+            return DictWithShape(res, res['crossattn'].shape)
+
+        return stacked.clone()
+
+
+class CompiledMulticondBatch:
+    """Same as CompiledCondBatch, but for MulticondLearnedConditioning; get(step) returns the same as reconstruct_multicond_batch(c, step)."""
+
+    def __init__(self, c: MulticondLearnedConditioning):
+        schedules = []
+        self.conds_list = []
+
+        for composable_prompts in c.batch:
+            conds_for_batch = []
+
+            for composable_prompt in composable_prompts:
+                conds_for_batch.append((len(schedules), composable_prompt.weight))
+                schedules.append(composable_prompt.schedules)
+
+            self.conds_list.append(conds_for_batch)
+
+        self.batch = CompiledCondBatch(schedules)
+
+    def get(self, current_step):
+        return self.conds_list, self.batch.get(current_step)
+
+
 re_attention = re.compile(r"""
 \\\(|
 \\\)|
@@ -1,6 +1,6 @@
 import torch
 
-from modules import devices, rng_philox, shared
+from modules import devices, rng_philox, shared, step_profiler
 
 
 def randn(seed, shape, generator=None):
@@ -47,6 +47,15 @@ def randn_like(x):
     return torch.randn_like(x)
 
 
+def randn_batch(generators, shape):
+    """Same as torch.stack([randn_without_seed(shape, generator=x) for x in generators]); for NV source, numbers for all generators are produced in one call."""
+
+    if shared.opts.randn_source == "NV":
+        return torch.asarray(rng_philox.randn_many(generators, shape), device=devices.device)
+
+    return torch.stack([randn_without_seed(shape, generator=generator) for generator in generators])
+
+
 def randn_without_seed(shape, generator=None):
     """Generate a tensor with random numbers from a normal distribution using the previously initialized generator.
 
@@ -96,6 +105,24 @@ def slerp(val, low, high):
     return res
 
 
+def slerp_batch(val, low, high):
+    """Same as stacked results of slerp for every pair of samples from low and high, which have an additional leading batch dimension."""
+
+    low_norm = low/torch.norm(low, dim=2, keepdim=True)
+    high_norm = high/torch.norm(high, dim=2, keepdim=True)
+    dot = (low_norm*high_norm).sum(2)
+
+    omega = torch.acos(dot)
+    so = torch.sin(omega)
+    res = (torch.sin((1.0-val)*omega)/so).unsqueeze(2)*low + (torch.sin(val*omega)/so).unsqueeze(2) * high
+
+    linear = dot.flatten(1).mean(1) > 0.9995
+    if linear.any():
+        res[linear] = low[linear] * val + high[linear] * (1 - val)
+
+    return res
+
+
 class ImageRNG:
     def __init__(self, shape, seeds, subseeds=None, subseed_strength=0.0, seed_resize_from_h=0, seed_resize_from_w=0):
         self.shape = tuple(map(int, shape))
@@ -110,57 +137,53 @@ class ImageRNG:
         self.is_first = True
 
     def first(self):
-        noise_shape = self.shape if self.seed_resize_from_h <= 0 or self.seed_resize_from_w <= 0 else (self.shape[0], int(self.seed_resize_from_h) // 8, int(self.seed_resize_from_w // 8))
-
-        xs = []
-
-        for i, (seed, generator) in enumerate(zip(self.seeds, self.generators)):
-            subnoise = None
-            if self.subseeds is not None and self.subseed_strength != 0:
-                subseed = 0 if i >= len(self.subseeds) else self.subseeds[i]
-                subnoise = randn(subseed, noise_shape)
+        """
+        Generates noise for all seeds at once. Every random number is drawn from a generator freshly created for its seed or
+        subseed, which gives the same numbers as seeding the global generator and drawing from it, done by randn().
+        """
 
-            if noise_shape != self.shape:
-                noise = randn(seed, noise_shape)
-            else:
-                noise = randn(seed, self.shape, generator=generator)
-
-            if subnoise is not None:
-                noise = slerp(self.subseed_strength, noise, subnoise)
-
-            if noise_shape != self.shape:
-                x = randn(seed, self.shape, generator=generator)
-                dx = (self.shape[2] - noise_shape[2]) // 2
-                dy = (self.shape[1] - noise_shape[1]) // 2
-                w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
-                h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
-                tx = 0 if dx < 0 else dx
-                ty = 0 if dy < 0 else dy
-                dx = max(-dx, 0)
-                dy = max(-dy, 0)
-
-                x[:, ty:ty + h, tx:tx + w] = noise[:, dy:dy + h, dx:dx + w]
-                noise = x
+        noise_shape = self.shape if self.seed_resize_from_h <= 0 or self.seed_resize_from_w <= 0 else (self.shape[0], int(self.seed_resize_from_h) // 8, int(self.seed_resize_from_w // 8))
 
-            xs.append(noise)
+        if noise_shape != self.shape:
+            noise = randn_batch([create_generator(seed) for seed in self.seeds], noise_shape)
+        else:
+            noise = randn_batch(self.generators, self.shape)
+
+        if self.subseeds is not None and self.subseed_strength != 0:
+            subseeds = [0 if i >= len(self.subseeds) else self.subseeds[i] for i in range(len(self.seeds))]
+            subnoise = randn_batch([create_generator(subseed) for subseed in subseeds], noise_shape)
+            noise = slerp_batch(self.subseed_strength, noise, subnoise)
+
+        if noise_shape != self.shape:
+            x = randn_batch(self.generators, self.shape)
+            dx = (self.shape[2] - noise_shape[2]) // 2
+            dy = (self.shape[1] - noise_shape[1]) // 2
+            w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
+            h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
+            tx = 0 if dx < 0 else dx
+            ty = 0 if dy < 0 else dy
+            dx = max(-dx, 0)
+            dy = max(-dy, 0)
+
+            x[:, :, ty:ty + h, tx:tx + w] = noise[:, :, dy:dy + h, dx:dx + w]
+            noise = x
+
+        # the global generator used to be seeded with each seed in turn; leave it in the same state as it was then
+        manual_seed(self.seeds[-1])
 
         eta_noise_seed_delta = shared.opts.eta_noise_seed_delta or 0
         if eta_noise_seed_delta:
             self.generators = [create_generator(seed + eta_noise_seed_delta) for seed in self.seeds]
 
-        return torch.stack(xs).to(shared.device)
+        return noise.to(shared.device)
 
+    @step_profiler.timed("noise")
     def next(self):
         if self.is_first:
             self.is_first = False
             return self.first()
 
-        xs = []
-        for generator in self.generators:
-            x = randn_without_seed(self.shape, generator=generator)
-            xs.append(x)
-
-        return torch.stack(xs).to(shared.device)
+        return randn_batch(self.generators, self.shape).to(shared.device)
 
 
 devices.randn = randn
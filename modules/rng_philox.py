@@ -84,19 +84,28 @@ class Generator:
     def randn(self, shape):
         """Generate a sequence of n standard normal random variables using the Philox 4x32 random number generator and the Box-Muller transform."""
 
-        n = 1
-        for x in shape:
-            n *= x
+        return randn_many([self], shape)[0]
 
-        counter = np.zeros((4, n), dtype=np.uint32)
-        counter[0] = self.offset
-        counter[2] = np.arange(n, dtype=np.uint32)  # up to 2^32 numbers can be generated - if you want more you'd need to spill into counter[3]
-        self.offset += 1
 
-        key = np.empty(n, dtype=np.uint64)
-        key.fill(self.seed)
-        key = uint32(key)
+def randn_many(generators, shape):
+    """Same as np.stack([x.randn(shape) for x in generators]), but with a single call to philox4_32: counters and keys for all
+    generators are laid out one after another, so that each generator's numbers are the same as if it was used alone."""
 
-        g = philox4_32(counter, key)
+    n = 1
+    for x in shape:
+        n *= x
 
-        return box_muller(g[0], g[1]).reshape(shape)  # discard g[2] and g[3]
+    count = len(generators)
+
+    counter = np.zeros((4, count * n), dtype=np.uint32)
+    key = np.empty(count * n, dtype=np.uint64)
+
+    for i, generator in enumerate(generators):
+        counter[0, i * n:(i + 1) * n] = generator.offset
+        counter[2, i * n:(i + 1) * n] = np.arange(n, dtype=np.uint32)  # up to 2^32 numbers can be generated - if you want more you'd need to spill into counter[3]
+        key[i * n:(i + 1) * n].fill(generator.seed)
+        generator.offset += 1
+
+    g = philox4_32(counter, uint32(key))
+
+    return box_muller(g[0], g[1]).reshape((count,) + tuple(shape))  # discard g[2] and g[3]
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from modules import cache, errors, hashes
+
+loaded_headers = {}
+"""maps filename to (file identity, header entry) for headers that have already been looked up by this process"""
+
+loaded_headers_lock = threading.Lock()
+
+
+def read_header(filename):
+    """Reads the JSON header of a safetensors file without touching tensor data; a header that is not valid JSON is reported and read as empty."""
+
+    with open(filename, mode="rb") as file:
+        metadata_len = file.read(8)
+        metadata_len = int.from_bytes(metadata_len, "little")
+        json_start = file.read(2)
+
+        assert metadata_len > 2 and json_start in (b'{"', b"{'"), f"{filename} is not a safetensors file"
+
+        json_data = json_start + file.read(metadata_len - 2)
+
+    try:
+        return json.loads(json_data)
+    except Exception:
+        errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
+        return {}
+
+
+def parse_metadata(filename, header):
+    res = {}
+
+    try:
+        for k, v in header.get("__metadata__", {}).items():
+            res[k] = v
+            if isinstance(v, str) and v[0:1] == '{':
+                try:
+                    res[k] = json.loads(v)
+                except Exception:
+                    pass
+    except Exception:
+        errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
+
+    return res
+
+
+def has_cover_images(metadata):
+    try:
+        return len(list(filter(None, json.loads(metadata.get('ssmd_cover_images', '[]'))))) > 0
+    except Exception:
+        return False
+
+
+def detect_sd_version(tensors, metadata):
+    """Returns one of "SD1", "SD2", "SDXL", "SD3" or "Unknown", judging by metadata written by trainers and by names of tensors."""
+
+    if str(metadata.get('ss_base_model_version', "")).startswith("sdxl_"):
+        return "SDXL"
+    if str(metadata.get('ss_v2', "")) == "True":
+        return "SD2"
+
+    if "model.diffusion_model.x_embedder.proj.weight" in tensors:
+        return "SD3"
+    if any(x.startswith(("conditioner.embedders.", "lora_te1_", "lora_te2_")) for x in tensors):
+        return "SDXL"
+    if any(x.startswith("cond_stage_model.model.") for x in tensors):
+        return "SD2"
+    if any(x.startswith("cond_stage_model.transformer.") for x in tensors):
+        return "SD1"
+
+    return "Unknown"
+
+
+def create_entry(filename):
+    header = read_header(filename)
+    metadata = parse_metadata(filename, header)
+    tensors = {k: (v.get("dtype"), v.get("shape")) for k, v in header.items() if k != "__metadata__" and isinstance(v, dict)}
+
+    return {
+        "metadata": metadata,
+        "tensors": tensors,
+        "sd_version": detect_sd_version(tensors, metadata),
+        "has_cover_images": has_cover_images(metadata),
+    }
+
+
+def get(filename):
+    """
+    Returns a dict with information from the header of a safetensors file:
+     - metadata: the __metadata__ section, with JSON values decoded
+     - tensors: maps tensor name to a (dtype, shape) tuple
+     - sd_version: see detect_sd_version()
+     - has_cover_images: whether metadata has non-empty ssmd_cover_images
+
+    Entries are persisted in cache keyed by file identity (see hashes.file_identity()), so renamed files do not get
+    re-read, and kept in memory, so that only files that changed since the last call are looked up in cache.
+    The returned dict must not be modified.
+    """
+
+    identity = hashes.file_identity(os.stat(filename))
+
+    loaded = loaded_headers.get(filename)
+    if loaded is not None and loaded[0] == identity:
+        return loaded[1]
+
+    index = cache.cache("safetensors-index")
+    entry = index.get(identity)
+    if entry is None:
+        entry = create_entry(filename)
+        index[identity] = entry
+
+    with loaded_headers_lock:
+        loaded_headers[filename] = (identity, entry)
+
+    return entry
+
+
+def forget_missing(filenames, directories):
+    """Removes in-memory entries for files inside any of directories that are not in filenames; call after listing directories' contents."""
+
+    filenames = set(filenames)
+    prefixes = tuple(os.path.join(os.path.abspath(x), '') for x in directories if x)
+
+    with loaded_headers_lock:
+        for filename in list(loaded_headers):
+            if filename not in filenames and os.path.abspath(filename).startswith(prefixes):
+                del loaded_headers[filename]
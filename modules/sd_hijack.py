@@ -260,6 +260,11 @@ class StableDiffusionModelHijack:
 
         self.layers = flatten(m)
 
+        checkpoint_info = getattr(m, 'sd_checkpoint_info', None)
+        for layer in self.layers:
+            if isinstance(layer, sd_hijack_clip.TextConditionalModel):
+                layer.sd_checkpoint_filename = checkpoint_info.filename if checkpoint_info else None
+
         import modules.models.diffusion.ddpm_edit
 
         if isinstance(m, ldm.models.diffusion.ddpm.LatentDiffusion):
@@ -1,9 +1,11 @@
+import contextlib
+import hashlib
 import math
 from collections import namedtuple
 
 import torch
 
-from modules import prompt_parser, devices, sd_hijack, sd_emphasis
+from modules import prompt_parser, devices, sd_hijack, sd_emphasis, sd_models_residency, cache, sd_hijack_optimizations, lowvram, metrics
 from modules.shared import opts
 
 
@@ -27,6 +29,90 @@ chunk. Those objects are found in PromptChunk.fixes and, are placed into FrozenC
 are applied by sd_hijack.EmbeddingsWithFixes's forward function."""
 
 
+text_encoder_weights_keys = {}
+"""Maps a name to a value describing a modification an extension made to text encoder's weights (for example, the set of active
+LoRAs). Outputs cached by ConditioningCache are only reused when all those values are the same as when the output was cached."""
+
+
+class ConditioningCache:
+    """
+    Keeps outputs of text encoders for prompt chunks across requests, so that chunks that are used often (negative prompts,
+    style prefixes) are not encoded again. Outputs are kept on device up to cond_cache_mb megabytes; least recently used
+    ones are evicted, and, if cond_cache_disk setting is enabled, written to disk cache, from where they can be read back.
+
+    An entry holds the output for a whole batch of chunks (one chunk from each text in the batch) because the Original
+    emphasis mode normalizes over the whole batch; for a batch of one text, which is the usual case, it's just the chunk.
+    """
+
+    def __init__(self):
+        self.tier = sd_models_residency.Tier("text encoder", budget=lambda: opts.cond_cache_mb * sd_models_residency.MB, policy=lambda: "LRU")
+        self.disk_hits = 0
+
+    def __contains__(self, key):
+        if key in self.tier:
+            return True
+
+        return opts.cond_cache_disk and self.disk_key(key) in cache.cache("text-encoder-conds")
+
+    def enabled(self):
+        return opts.cond_cache_mb > 0 and not torch.is_grad_enabled()
+
+    @staticmethod
+    def disk_key(key):
+        return hashlib.sha256(repr(key).encode("utf8")).hexdigest()
+
+    def get(self, key):
+        z = self.tier.get(key)
+        if z is not None or not opts.cond_cache_disk:
+            return z
+
+        stored = cache.cache("text-encoder-conds").get(self.disk_key(key))
+        if stored is None:
+            return None
+
+        self.disk_hits += 1
+
+        z, pooled = stored
+        z = z.to(devices.device)
+        if pooled is not None:
+            z.pooled = pooled.to(devices.device)
+
+        self.store(key, z)
+        return z
+
+    def store(self, key, z):
+        pooled = getattr(z, 'pooled', None)
+        size = sd_models_residency.tensors_size([z, pooled])
+
+        for evicted_key, evicted_z in self.tier.evict(size=size, count=1):
+            if opts.cond_cache_disk:
+                evicted_pooled = getattr(evicted_z, 'pooled', None)
+                cache.cache("text-encoder-conds")[self.disk_key(evicted_key)] = (evicted_z.cpu(), None if evicted_pooled is None else evicted_pooled.cpu())
+
+        if self.tier.has_room(size):
+            self.tier.put(key, z, size)
+
+    def stats(self):
+        res = self.tier.stats()
+        res["disk_hits"] = self.disk_hits
+        return res
+
+
+cond_cache = ConditioningCache()
+
+
+def collect_metrics():
+    cond_cache.tier.export_metrics("conds")
+    metrics.cache_lookups_total.set(cond_cache.disk_hits, cache="conds disk", result="hit")
+
+
+metrics.add_collector(collect_metrics)
+
+bytes_per_chunk_token = 1280 * 40
+"""rough estimate of how much memory text encoder needs for each token of a prompt chunk, in units of its element size: the widest
+supported encoder (OpenCLIP ViT-bigG) has 1280 channels, and all of its hidden states are kept when CLIP skip is used"""
+
+
 class TextConditionalModel(torch.nn.Module):
     def __init__(self):
         super().__init__()
@@ -43,6 +129,12 @@ class TextConditionalModel(torch.nn.Module):
         self.id_end = None
         self.id_pad = None
 
+        self.sd_checkpoint_filename = None
+        """filename of the checkpoint with this model's weights, set when the checkpoint is hijacked; outputs are only cached if it's set"""
+
+        self.planned_outputs = {}
+        """maps encoding_key() of a prompt chunk to (z, pooled) tuple with transformers' output for it, computed in advance by plan_encoding()"""
+
     def empty_chunk(self):
         """creates an empty PromptChunk and returns it"""
 
@@ -196,6 +288,113 @@ class TextConditionalModel(torch.nn.Module):
 
         return batch_chunks, token_count
 
+    def cond_cache_key(self, batch_chunk):
+        """Returns a key for cond_cache that identifies the output of process_tokens for a batch of chunks, or None if the output should not be cached."""
+
+        if self.sd_checkpoint_filename is None:
+            return None
+
+        return (
+            type(self).__name__,
+            self.sd_checkpoint_filename,
+            opts.CLIP_stop_at_last_layers,
+            opts.sdxl_clip_l_skip,
+            opts.emphasis,
+            tuple(sorted(text_encoder_weights_keys.items())),
+            tuple((tuple(x.tokens), tuple(x.multipliers), tuple((offset, embedding.name, embedding.checksum()) for offset, embedding in x.fixes)) for x in batch_chunk),
+        )
+
+    @staticmethod
+    def encoding_key(tokens, fixes):
+        """Identifies the output of transformers for one prompt chunk; unlike cond_cache_key, multipliers are not included because emphasis is applied after transformers."""
+
+        return tuple(tokens), tuple((offset, embedding.name, embedding.checksum()) for offset, embedding in fixes)
+
+    def get_encode_batch_size(self, count):
+        """Returns how many of count prompt chunks plan_encoding() passes through transformers at once: cond_encode_batch_size setting, or, if it's 0, as many as fit into free memory."""
+
+        if opts.cond_encode_batch_size > 0:
+            return min(opts.cond_encode_batch_size, count)
+
+        element_size = torch.tensor([], dtype=devices.dtype).element_size()
+        bytes_per_chunk = (self.chunk_length + 2) * bytes_per_chunk_token * element_size
+
+        available = sd_hijack_optimizations.get_available_vram()
+
+        return max(1, min(count, int(available // bytes_per_chunk)))
+
+    def plan_encoding(self, batches):
+        """
+        Runs transformers, in advance, for all prompt chunks that forward() is going to need when called with each of batches (lists of
+        texts). Chunks are deduplicated across all batches and encoded in as few transformers calls as memory allows, instead of one call
+        for each chunk index of each forward() call. Outputs are put into self.planned_outputs, where process_tokens() finds them.
+        Chunks whose output forward() will take from cond_cache are skipped.
+        """
+
+        unique_chunks = {}
+        for texts in batches:
+            batch_chunks, _ = self.process_texts(texts)
+            chunk_count = max([len(x) for x in batch_chunks])
+
+            for i in range(chunk_count):
+                batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+
+                cache_key = self.cond_cache_key(batch_chunk) if cond_cache.enabled() else None
+                if cache_key is not None and cache_key in cond_cache:
+                    continue
+
+                for chunk in batch_chunk:
+                    key = self.encoding_key(chunk.tokens, chunk.fixes)
+                    if key not in self.planned_outputs:
+                        unique_chunks[key] = chunk
+
+        keys = list(unique_chunks)
+        batch_size = self.get_encode_batch_size(len(keys))
+
+        devices.torch_npu_set_device()
+
+        i = 0
+        while i < len(keys):
+            part_keys = keys[i:i + batch_size]
+            part = [unique_chunks[key] for key in part_keys]
+
+            self.hijack.fixes = [x.fixes for x in part]
+            try:
+                z = self.encode_with_transformers(self.prepare_tokens([x.tokens for x in part]))
+            except torch.cuda.OutOfMemoryError:
+                self.hijack.fixes = None
+                if batch_size == 1:
+                    raise
+
+                batch_size = max(1, batch_size // 2)
+                devices.torch_gc()
+                continue
+
+            pooled = getattr(z, 'pooled', None)
+            for j, key in enumerate(part_keys):
+                self.planned_outputs[key] = (z[j], None if pooled is None else pooled[j])
+
+            i += len(part)
+
+    def get_planned_output(self, remade_batch_tokens):
+        """Returns transformers' output for a batch of chunks assembled from self.planned_outputs, or None if any of chunks is not there."""
+
+        if not self.planned_outputs:
+            return None
+
+        fixes = self.hijack.fixes or [[] for _ in remade_batch_tokens]
+        outputs = [self.planned_outputs.get(self.encoding_key(tokens, chunk_fixes)) for tokens, chunk_fixes in zip(remade_batch_tokens, fixes)]
+        if any(x is None for x in outputs):
+            return None
+
+        self.hijack.fixes = None
+
+        z = torch.stack([x[0] for x in outputs])
+        if outputs[0][1] is not None:
+            z.pooled = torch.stack([x[1] for x in outputs])
+
+        return z
+
     def forward(self, texts):
         """
         Accepts an array of texts; Passes texts through transformers network to create a tensor with numerical representation of those texts.
@@ -223,14 +422,25 @@ class TextConditionalModel(torch.nn.Module):
             for fixes in self.hijack.fixes:
                 for _position, embedding in fixes:
                     used_embeddings[embedding.name] = embedding
-            devices.torch_npu_set_device()
-            z = self.process_tokens(tokens, multipliers)
+
+            cache_key = self.cond_cache_key(batch_chunk) if cond_cache.enabled() else None
+            z = cond_cache.get(cache_key) if cache_key is not None else None
+
+            if z is None:
+                devices.torch_npu_set_device()
+                z = self.process_tokens(tokens, multipliers)
+
+                if cache_key is not None:
+                    cond_cache.store(cache_key, z)
+            else:
+                self.hijack.fixes = None
+
             zs.append(z)
 
         if opts.textual_inversion_add_hashes_to_infotext and used_embeddings:
             hashes = []
             for name, embedding in used_embeddings.items():
-                shorthash = embedding.shorthash
+                shorthash = embedding.wait_for_hash()
                 if not shorthash:
                     continue
 
@@ -250,6 +460,19 @@ class TextConditionalModel(torch.nn.Module):
         else:
             return torch.hstack(zs)
 
+    def prepare_tokens(self, remade_batch_tokens):
+        """converts a batch of tokens (a list of lists) into a tensor that can be passed to encode_with_transformers"""
+
+        tokens = torch.asarray(remade_batch_tokens).to(devices.device)
+
+        # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
+        if self.id_end != self.id_pad:
+            for batch_pos in range(len(remade_batch_tokens)):
+                index = remade_batch_tokens[batch_pos].index(self.id_end)
+                tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
+
+        return tokens
+
     def process_tokens(self, remade_batch_tokens, batch_multipliers):
         """
         sends one single prompt chunk to be encoded by transformers neural network.
@@ -258,15 +481,10 @@ class TextConditionalModel(torch.nn.Module):
         Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
         corresponds to one token.
         """
-        tokens = torch.asarray(remade_batch_tokens).to(devices.device)
-
-        # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
-        if self.id_end != self.id_pad:
-            for batch_pos in range(len(remade_batch_tokens)):
-                index = remade_batch_tokens[batch_pos].index(self.id_end)
-                tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
 
-        z = self.encode_with_transformers(tokens)
+        z = self.get_planned_output(remade_batch_tokens)
+        if z is None:
+            z = self.encode_with_transformers(self.prepare_tokens(remade_batch_tokens))
 
         pooled = getattr(z, 'pooled', None)
 
@@ -285,6 +503,30 @@ class TextConditionalModel(torch.nn.Module):
         return z
 
 
+def planning_enabled(sd_model):
+    return opts.cond_encode_batch_size != 1 and not opts.use_old_emphasis_implementation and not torch.is_grad_enabled() and not lowvram.is_enabled(sd_model)
+
+
+@contextlib.contextmanager
+def encoding_plan(sd_model, batches):
+    """
+    While active, text encoders of sd_model use outputs computed in advance for all texts in batches (lists of texts, each list being
+    what one forward() call will get); see TextConditionalModel.plan_encoding(). Texts that are not in batches are encoded as usual.
+    """
+
+    models = [x for x in sd_hijack.model_hijack.layers or [] if isinstance(x, TextConditionalModel)] if batches and planning_enabled(sd_model) else []
+
+    try:
+        with devices.autocast():
+            for model in models:
+                model.plan_encoding(batches)
+
+        yield
+    finally:
+        for model in models:
+            model.planned_outputs.clear()
+
+
 class FrozenCLIPEmbedderWithCustomWordsBase(TextConditionalModel):
     """A pytorch module that is a wrapper for FrozenCLIPEmbedder module. it enhances FrozenCLIPEmbedder, making it possible to
     have unlimited prompt length and assign weights to tokens in prompt.
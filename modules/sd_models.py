@@ -1,8 +1,9 @@
-import collections
+import collections.abc
 import importlib
 import os
 import sys
 import threading
+import time
 import enum
 
 import torch
@@ -12,7 +13,7 @@ from omegaconf import OmegaConf, ListConfig
 from urllib import request
 import ldm.modules.midas as midas
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, extra_networks, processing, lowvram, sd_hijack, patches, safetensors_index, sd_models_residency, metrics
 from modules.timer import Timer
 from modules.shared import opts
 import tomesd
@@ -24,7 +25,94 @@ model_path = os.path.abspath(os.path.join(paths.models_path, model_dir))
 checkpoints_list = {}
 checkpoint_aliases = {}
 checkpoint_alisases = checkpoint_aliases  # for compatibility with old name
-checkpoints_loaded = collections.OrderedDict()
+residency = sd_models_residency.residency
+
+
+class CheckpointsLoaded(collections.abc.MutableMapping):
+    """
+    State dicts in the ram residency tier, by CheckpointInfo, least recently used first; this used to be an OrderedDict
+    and is kept for compatibility with extensions. Checkpoints are stored via residency.store_state_dict, so they are
+    subject to the tier's budget. Other keys, such as VAE filenames used by sd_vae, are kept in a plain OrderedDict whose
+    size is managed by whoever puts them there, as before.
+    """
+
+    def __init__(self):
+        self.other = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        if not isinstance(key, CheckpointInfo):
+            return self.other[key]
+
+        state_dict = residency.ram.peek(key.filename)
+        if state_dict is None:
+            raise KeyError(key)
+
+        return state_dict
+
+    def __setitem__(self, key, state_dict):
+        if not isinstance(key, CheckpointInfo):
+            self.other[key] = state_dict
+            return
+
+        residency.ram.pop(key.filename)
+        residency.store_state_dict(key.filename, state_dict)
+
+    def __delitem__(self, key):
+        if not isinstance(key, CheckpointInfo):
+            del self.other[key]
+        elif residency.ram.pop(key.filename) is None:
+            raise KeyError(key)
+
+    def __iter__(self):
+        infos = {info.filename: info for info in checkpoints_list.values()}
+        return iter([infos[filename] for filename in list(residency.ram.entries) if filename in infos] + list(self.other))
+
+    def __len__(self):
+        return len(residency.ram.entries) + len(self.other)
+
+    def move_to_end(self, key, last=True):
+        if not isinstance(key, CheckpointInfo):
+            self.other.move_to_end(key, last=last)
+            return
+
+        with residency.ram.lock:
+            residency.ram.entries.move_to_end(key.filename, last=last)
+
+    def popitem(self, last=True):
+        keys = list(self)
+        if not keys:
+            raise KeyError("popitem(): checkpoints_loaded is empty")
+
+        key = keys[-1] if last else keys[0]
+        return key, self.pop(key)
+
+
+checkpoints_loaded = CheckpointsLoaded()
+
+
+class LoadedSdModels(collections.abc.MutableSequence):
+    """
+    Models in the gpu residency tier, most recently used first; this used to be a list and is kept for compatibility with
+    extensions. Position is determined by use, so inserted models always become the first element.
+    """
+
+    def __getitem__(self, index):
+        return residency.gpu.values()[index]
+
+    def __setitem__(self, index, model):
+        del self[index]
+        self.insert(0, model)
+
+    def __delitem__(self, index):
+        models = self[index] if isinstance(index, slice) else [self[index]]
+        for model in models:
+            residency.gpu.discard_value(model)
+
+    def __len__(self):
+        return len(residency.gpu.entries)
+
+    def insert(self, index, model):
+        residency.gpu.put(model.sd_checkpoint_info.filename, model, sd_models_residency.model_size(model))
 
 
 class ModelType(enum.Enum):
@@ -71,16 +159,15 @@ class CheckpointInfo:
         if name.startswith("\\") or name.startswith("/"):
             name = name[1:]
 
-        def read_metadata():
-            metadata = read_metadata_from_safetensors(filename)
-            self.modelspec_thumbnail = metadata.pop('modelspec.thumbnail', None)
-
-            return metadata
-
         self.metadata = {}
+        self.modelspec_thumbnail = None
+        self.sd_version = None
         if self.is_safetensors:
             try:
-                self.metadata = cache.cached_data_for_file('safetensors-metadata', "checkpoint/" + name, filename, read_metadata)
+                header = safetensors_index.get(filename)
+                self.metadata = dict(header["metadata"])
+                self.modelspec_thumbnail = self.metadata.pop('modelspec.thumbnail', None)
+                self.sd_version = header["sd_version"]
             except Exception as e:
                 errors.display(e, f"reading metadata for {filename}")
 
@@ -176,6 +263,12 @@ def list_models():
         checkpoint_info = CheckpointInfo(filename)
         checkpoint_info.register()
 
+    safetensors_index.forget_missing(model_list, [model_path, shared.cmd_opts.ckpt_dir])
+
+
+def prewarm_hashes():
+    hashes.prewarm((info.filename, f"checkpoint/{info.name}", False) for info in checkpoints_list.values())
+
 
 re_strip_checksum = re.compile(r"\s*\[[^]]+]\s*$")
 
@@ -282,31 +375,7 @@ def get_state_dict_from_checkpoint(pl_sd):
 
 
 def read_metadata_from_safetensors(filename):
-    import json
-
-    with open(filename, mode="rb") as file:
-        metadata_len = file.read(8)
-        metadata_len = int.from_bytes(metadata_len, "little")
-        json_start = file.read(2)
-
-        assert metadata_len > 2 and json_start in (b'{"', b"{'"), f"{filename} is not a safetensors file"
-
-        res = {}
-
-        try:
-            json_data = json_start + file.read(metadata_len-2)
-            json_obj = json.loads(json_data)
-            for k, v in json_obj.get("__metadata__", {}).items():
-                res[k] = v
-                if isinstance(v, str) and v[0:1] == '{':
-                    try:
-                        res[k] = json.loads(v)
-                    except Exception:
-                        pass
-        except Exception:
-             errors.report(f"Error reading metadata from file: {filename}", exc_info=True)
-
-        return res
+    return dict(safetensors_index.get(filename)["metadata"])
 
 
 def read_state_dict(checkpoint_file, print_global_state=False, map_location=None):
@@ -330,19 +399,29 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
 
 
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
-    sd_model_hash = checkpoint_info.calculate_shorthash()
-    timer.record("calculate hash")
+    cached_state_dict = residency.get_state_dict(checkpoint_info.filename)
+    if cached_state_dict is not None:
+        sd_model_hash = checkpoint_info.calculate_shorthash()
+        timer.record("calculate hash")
+
+        print(f"Loading weights [{sd_model_hash}] from RAM cache")
+        return cached_state_dict
 
-    if checkpoint_info in checkpoints_loaded:
-        # use checkpoint cache
-        print(f"Loading weights [{sd_model_hash}] from cache")
-        # move to end as latest
-        checkpoints_loaded.move_to_end(checkpoint_info)
-        return checkpoints_loaded[checkpoint_info]
+    # hash the file on a background thread while its weights are being read
+    hashes.sha256_async(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}", priority=hashes.PRIORITY_REQUEST)
+
+    res = residency.take_prefetched(checkpoint_info.filename)
+    if res is not None:
+        print(f"Loading weights [{checkpoint_info.shorthash}] prefetched from {checkpoint_info.filename}")
+        timer.record("load weights from prefetch")
+    else:
+        print(f"Loading weights [{checkpoint_info.shorthash}] from {checkpoint_info.filename}")
+        res = read_state_dict(checkpoint_info.filename)
+        timer.record("load weights from disk")
+        residency.record_disk_read(checkpoint_info.filename, sd_models_residency.state_dict_size(res))
 
-    print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
-    timer.record("load weights from disk")
+    checkpoint_info.calculate_shorthash()
+    timer.record("calculate hash")
 
     return res
 
@@ -430,9 +509,8 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     if model.is_ssd:
         sd_hijack.model_hijack.convert_sdxl_to_ssd(model)
 
-    if shared.opts.sd_checkpoint_cache > 0:
-        # cache newly loaded model
-        checkpoints_loaded[checkpoint_info] = state_dict.copy()
+    # cache newly loaded weights in RAM
+    residency.store_state_dict(checkpoint_info.filename, state_dict)
 
     if hasattr(model, "before_load_weights"):
         model.before_load_weights(state_dict)
@@ -520,10 +598,6 @@ def load_model_weights(model, checkpoint_info: CheckpointInfo, state_dict, timer
     model.first_stage_model.to(devices.dtype_vae)
     timer.record("apply dtype to VAE")
 
-    # clean up cache if limit is reached
-    while len(checkpoints_loaded) > shared.opts.sd_checkpoint_cache:
-        checkpoints_loaded.popitem(last=False)
-
     model.sd_model_hash = sd_model_hash
     model.sd_model_checkpoint = checkpoint_info.filename
     model.sd_checkpoint_info = checkpoint_info
@@ -676,10 +750,24 @@ sdxl_refiner_clip_weight = 'conditioner.embedders.0.model.ln_final.weight'
 class SdModelData:
     def __init__(self):
         self.sd_model = None
-        self.loaded_sd_models = []
         self.was_loaded_at_least_once = False
         self.lock = threading.Lock()
 
+    @property
+    def loaded_sd_models(self):
+        """models kept loaded in the gpu residency tier, most recently used first"""
+
+        return LoadedSdModels()
+
+    @loaded_sd_models.setter
+    def loaded_sd_models(self, models):
+        models = list(models)
+
+        with residency.gpu.lock:
+            residency.gpu.entries.clear()
+            for model in reversed(models):
+                LoadedSdModels().insert(0, model)
+
     def get_sd_model(self):
         if self.was_loaded_at_least_once:
             return self.sd_model
@@ -707,13 +795,10 @@ class SdModelData:
             sd_vae.loaded_vae_file = getattr(v, "loaded_vae_file", None)
             sd_vae.checkpoint_info = v.sd_checkpoint_info
 
-        try:
-            self.loaded_sd_models.remove(v)
-        except ValueError:
-            pass
+        residency.gpu.discard_value(v)
 
         if v is not None:
-            self.loaded_sd_models.insert(0, v)
+            residency.gpu.put(v.sd_checkpoint_info.filename, v, sd_models_residency.model_size(v))
 
 
 model_data = SdModelData()
@@ -790,6 +875,7 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     timer = Timer()
 
     if model_data.sd_model:
+        residency.gpu.discard_value(model_data.sd_model)
         send_model_to_trash(model_data.sd_model)
         model_data.sd_model = None
         devices.torch_gc()
@@ -875,36 +961,50 @@ def load_model(checkpoint_info=None, already_loaded_state_dict=None):
     return sd_model
 
 
+def estimated_model_size(sd_model):
+    """
+    How much memory a newly loaded checkpoint will take, for checking whether it fits into the gpu residency tier budget before
+    it's loaded: the measured size of parameters of the current model, which has the same dtype and usually the same architecture.
+    """
+
+    if sd_model is None:
+        return 0
+
+    entry = residency.gpu.entries.get(sd_model.sd_checkpoint_info.filename)
+    return entry.size if entry is not None else sd_models_residency.model_size(sd_model)
+
+
 def reuse_model_from_already_loaded(sd_model, checkpoint_info, timer):
     """
-    Checks if the desired checkpoint from checkpoint_info is not already loaded in model_data.loaded_sd_models.
+    Checks if the desired checkpoint from checkpoint_info is not already loaded in the gpu residency tier.
     If it is loaded, returns that (moving it to GPU if necessary, and moving the currently loadded model to CPU if necessary).
     If not, returns the model that can be used to load weights from checkpoint_info's file.
     If no such model exists, returns None.
-    Additionally deletes loaded models that are over the limit set in settings (sd_checkpoints_limit).
+    Additionally deletes loaded models that are over the budget set in settings (sd_checkpoints_limit, sd_residency_gpu_mb),
+    starting from least recently (or frequently, depending on sd_residency_policy) used ones.
+
+    The current model is only moved to CPU (if sd_checkpoints_keep_in_cpu is set) when it stays loaded next to the one that is
+    going to be used; if its weights are going to be replaced, reload_model_weights decides whether it needs to leave the device.
     """
 
     if sd_model is not None and sd_model.sd_checkpoint_info.filename == checkpoint_info.filename:
         return sd_model
 
-    if shared.opts.sd_checkpoints_keep_in_cpu:
-        send_model_to_cpu(sd_model)
-        timer.record("send model to cpu")
+    def keep_current_model_in_cpu():
+        if shared.opts.sd_checkpoints_keep_in_cpu and sd_model is not None:
+            send_model_to_cpu(sd_model)
+            timer.record("send model to cpu")
 
-    already_loaded = None
-    for i in reversed(range(len(model_data.loaded_sd_models))):
-        loaded_model = model_data.loaded_sd_models[i]
-        if loaded_model.sd_checkpoint_info.filename == checkpoint_info.filename:
-            already_loaded = loaded_model
-            continue
+    already_loaded = residency.gpu.get(checkpoint_info.filename)
 
-        if len(model_data.loaded_sd_models) > shared.opts.sd_checkpoints_limit > 0:
-            print(f"Unloading model {len(model_data.loaded_sd_models)} over the limit of {shared.opts.sd_checkpoints_limit}: {loaded_model.sd_checkpoint_info.title}")
-            del model_data.loaded_sd_models[i]
-            send_model_to_trash(loaded_model)
-            timer.record("send model to trash")
+    for _, loaded_model in residency.gpu.evict(keep={checkpoint_info.filename}):
+        print(f"Unloading model over the limit: {loaded_model.sd_checkpoint_info.title}")
+        send_model_to_trash(loaded_model)
+        timer.record("send model to trash")
 
     if already_loaded is not None:
+        keep_current_model_in_cpu()
+
         send_model_to_device(already_loaded)
         timer.record("send model to device")
 
@@ -917,14 +1017,20 @@ def reuse_model_from_already_loaded(sd_model, checkpoint_info, timer):
         print(f"Using already loaded model {already_loaded.sd_checkpoint_info.title}: done in {timer.summary()}")
         sd_vae.reload_vae_weights(already_loaded)
         return model_data.sd_model
-    elif shared.opts.sd_checkpoints_limit > 1 and len(model_data.loaded_sd_models) < shared.opts.sd_checkpoints_limit:
-        print(f"Loading model {checkpoint_info.title} ({len(model_data.loaded_sd_models) + 1} out of {shared.opts.sd_checkpoints_limit})")
+    elif shared.opts.sd_checkpoints_limit > 1 and residency.gpu.has_room(estimated_model_size(sd_model)):
+        print(f"Loading model {checkpoint_info.title} ({len(residency.gpu.entries) + 1} out of {shared.opts.sd_checkpoints_limit})")
+
+        keep_current_model_in_cpu()
 
         model_data.sd_model = None
         load_model(checkpoint_info)
         return model_data.sd_model
-    elif len(model_data.loaded_sd_models) > 0:
-        sd_model = model_data.loaded_sd_models.pop()
+    elif len(residency.gpu.entries) > 0:
+        victim = residency.gpu.pop(residency.gpu.victim())
+        if victim is not sd_model:
+            keep_current_model_in_cpu()
+
+        sd_model = victim
         model_data.sd_model = sd_model
 
         sd_vae.base_vae = getattr(sd_model, "base_vae", None)
@@ -937,6 +1043,21 @@ def reuse_model_from_already_loaded(sd_model, checkpoint_info, timer):
         return None
 
 
+def model_swap_source(checkpoint_info):
+    """Where weights for checkpoint_info would come from if it were loaded now; used as a label for model swap metrics."""
+
+    if checkpoint_info.filename in residency.gpu:
+        return "gpu"
+
+    if residency.has_state_dict(checkpoint_info.filename):
+        return "ram"
+
+    if residency.is_prefetched(checkpoint_info.filename):
+        return "prefetch"
+
+    return "disk"
+
+
 def reload_model_weights(sd_model=None, info=None, forced_reload=False):
     checkpoint_info = info or select_checkpoint()
 
@@ -955,13 +1076,21 @@ def reload_model_weights(sd_model=None, info=None, forced_reload=False):
         elif sd_model.sd_model_checkpoint == checkpoint_info.filename and not forced_reload:
             return sd_model
 
+    swap_source = model_swap_source(checkpoint_info)
+    swap_started_at = time.perf_counter()
+
     sd_model = reuse_model_from_already_loaded(sd_model, checkpoint_info, timer)
     if not forced_reload and sd_model is not None and sd_model.sd_checkpoint_info.filename == checkpoint_info.filename:
+        metrics.model_swap_seconds.observe(time.perf_counter() - swap_started_at, source=swap_source)
         return sd_model
 
     if sd_model is not None:
         sd_unet.apply_unet("None")
-        send_model_to_cpu(sd_model)
+
+        # with weights in pinned RAM, they are copied directly into the model on device, so there's no need to move it
+        if sd_model.lowvram or not residency.has_state_dict(checkpoint_info.filename):
+            send_model_to_cpu(sd_model)
+
         sd_hijack.model_hijack.undo_hijack(sd_model)
 
     state_dict = get_checkpoint_state_dict(checkpoint_info, timer)
@@ -972,9 +1101,11 @@ def reload_model_weights(sd_model=None, info=None, forced_reload=False):
 
     if sd_model is None or checkpoint_config != sd_model.used_config:
         if sd_model is not None:
+            residency.gpu.discard_value(sd_model)
             send_model_to_trash(sd_model)
 
         load_model(checkpoint_info, already_loaded_state_dict=state_dict)
+        metrics.model_swap_seconds.observe(time.perf_counter() - swap_started_at, source=swap_source)
         return model_data.sd_model
 
     try:
@@ -999,6 +1130,8 @@ def reload_model_weights(sd_model=None, info=None, forced_reload=False):
     model_data.set_sd_model(sd_model)
     sd_unet.apply_unet()
 
+    metrics.model_swap_seconds.observe(time.perf_counter() - swap_started_at, source=swap_source)
+
     return sd_model
 
 
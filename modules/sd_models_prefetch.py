@@ -0,0 +1,113 @@
+import contextlib
+import threading
+from concurrent.futures import Future
+
+from modules import sd_models, shared, errors, hashes
+
+residency = sd_models.residency
+
+
+class CheckpointPrefetcher:
+    """
+    Keeps track of checkpoints requested by queued API jobs via override_settings, and reads weights of the next checkpoint
+    that will be needed into RAM on a background thread while the current job runs. The result is picked up by
+    sd_models.get_checkpoint_state_dict when the job that needs it starts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        """maps task id to CheckpointInfo for queued tasks, in order of arrival"""
+
+        self.running = {}
+        """maps task id to CheckpointInfo for tasks that are running right now"""
+
+    def add_task(self, task_id, checkpoint_name):
+        if not shared.opts.sd_checkpoint_prefetch or not checkpoint_name:
+            return
+
+        checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint_name)
+        if checkpoint_info is None:
+            return
+
+        with self.lock:
+            self.pending[task_id] = checkpoint_info
+
+        self.prefetch_next()
+
+    @contextlib.contextmanager
+    def task(self, task_id, checkpoint_name):
+        """Registers a queued task for the duration of its request; the request handler runs inside of this."""
+
+        self.add_task(task_id, checkpoint_name)
+        try:
+            yield
+        finally:
+            self.finish_task(task_id)
+
+    def start_task(self, task_id):
+        with self.lock:
+            checkpoint_info = self.pending.pop(task_id, None)
+            if checkpoint_info is not None:
+                self.running[task_id] = checkpoint_info
+
+        self.prefetch_next()
+
+    def finish_task(self, task_id):
+        """Forgets the task when its request ends, whether it ran, failed or never started; drops weights read in advance if no other task needs them."""
+
+        with self.lock:
+            self.pending.pop(task_id, None)
+            self.running.pop(task_id, None)
+            needed = {checkpoint_info.filename for checkpoint_info in [*self.pending.values(), *self.running.values()]}
+
+        prefetched_filename = residency.prefetched_filename
+        if prefetched_filename is not None and prefetched_filename not in needed:
+            residency.drop_prefetched(prefetched_filename)
+
+        self.prefetch_next()
+
+    def is_resident(self, checkpoint_info):
+        current = sd_models.model_data.sd_model
+        if current is not None and current.sd_checkpoint_info.filename == checkpoint_info.filename:
+            return True
+
+        return checkpoint_info.filename in residency.gpu or residency.has_state_dict(checkpoint_info.filename) or residency.is_prefetched(checkpoint_info.filename)
+
+    def next_needed(self):
+        with self.lock:
+            running_filenames = {checkpoint_info.filename for checkpoint_info in self.running.values()}
+
+            for checkpoint_info in self.pending.values():
+                if checkpoint_info.filename not in running_filenames:
+                    return checkpoint_info
+
+        return None
+
+    def prefetch_next(self):
+        checkpoint_info = self.next_needed()
+        if checkpoint_info is None or self.is_resident(checkpoint_info):
+            return
+
+        future = Future()
+        if not residency.set_prefetched(checkpoint_info.filename, future):
+            return
+
+        hashes.sha256_async(checkpoint_info.filename, f"checkpoint/{checkpoint_info.name}", priority=hashes.PRIORITY_REQUEST)
+
+        thread = threading.Thread(target=self.read, args=(checkpoint_info, future), name="checkpoint-prefetch", daemon=True)
+        thread.start()
+
+    def read(self, checkpoint_info, future):
+        try:
+            print(f"Prefetching weights for {checkpoint_info.title}")
+            state_dict = sd_models.read_state_dict(checkpoint_info.filename, map_location="cpu")
+            residency.record_disk_read(checkpoint_info.filename, sd_models.sd_models_residency.state_dict_size(state_dict))
+        except Exception as e:
+            errors.display(e, f"prefetching {checkpoint_info.filename}")
+            state_dict = None
+
+        future.set_result(state_dict)
+
+
+prefetcher = CheckpointPrefetcher()
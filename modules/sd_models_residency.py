@@ -0,0 +1,315 @@
+import collections
+import threading
+
+import torch
+
+from modules import devices, shared, metrics
+
+MB = 1024 * 1024
+
+
+def tensors_size(tensors):
+    return sum(x.numel() * x.element_size() for x in tensors if isinstance(x, torch.Tensor) and not x.is_meta)
+
+
+def state_dict_size(state_dict):
+    return tensors_size(state_dict.values())
+
+
+def model_size(model):
+    return tensors_size(model.parameters()) + tensors_size(model.buffers())
+
+
+def can_pin_memory():
+    return torch.cuda.is_available() and devices.device.type == "cuda"
+
+
+def pin_state_dict(state_dict):
+    """
+    Returns a shallow copy of state_dict with CPU tensors moved to pinned memory, which makes copying them to GPU faster.
+    If pinning is not supported or fails, tensors are kept as they were.
+    """
+
+    if not can_pin_memory():
+        return dict(state_dict)
+
+    res = {}
+    try:
+        for k, v in state_dict.items():
+            if isinstance(v, torch.Tensor) and v.device.type == "cpu" and not v.is_pinned():
+                v = v.pin_memory()
+
+            res[k] = v
+    except RuntimeError as e:
+        print(f"Could not pin checkpoint weights in memory: {e}")
+        return dict(state_dict)
+
+    return res
+
+
+disk_tier_entries = 64
+"""how many recently read files the disk tier remembers"""
+
+
+class TierEntry:
+    def __init__(self, value, size):
+        self.value = value
+        self.size = size
+        self.uses = 1
+
+
+class Tier:
+    """
+    A set of items that are resident at one level of memory, with a budget in bytes and/or in number of entries.
+    Entries are ordered from least to most recently used; eviction picks least recently used or least frequently used
+    entries, depending on policy (sd_residency_policy setting by default). Eviction only selects entries: what happens to
+    evicted values (demoting them to a lower tier or dropping them) is decided by the caller.
+    """
+
+    def __init__(self, name, budget=None, max_entries=None, policy=None):
+        self.name = name
+        self.budget = budget
+        """function returning the budget in bytes; 0 or None means no limit"""
+
+        self.max_entries = max_entries
+        """function returning maximum number of entries; 0 or None means no limit"""
+
+        self.policy = policy or (lambda: shared.opts.sd_residency_policy)
+        """function returning "LRU" or "LFU"."""
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Returns the value for key, counting a hit or a miss and marking the entry as recently used."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry.uses += 1
+            self.entries.move_to_end(key)
+            return entry.value
+
+    def peek(self, key):
+        """Returns the value for key without counting it as a use."""
+
+        entry = self.entries.get(key)
+        return None if entry is None else entry.value
+
+    def put(self, key, value, size):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = TierEntry(value, size)
+            else:
+                entry.value = value
+                entry.size = size
+                entry.uses += 1
+
+            self.entries[key] = entry
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return None if entry is None else entry.value
+
+    def discard_value(self, value):
+        with self.lock:
+            for key in [k for k, entry in self.entries.items() if entry.value is value]:
+                del self.entries[key]
+
+    def values(self):
+        """Values, most recently used first."""
+
+        with self.lock:
+            return [entry.value for entry in reversed(self.entries.values())]
+
+    def total_size(self):
+        return sum(entry.size for entry in self.entries.values())
+
+    def has_room(self, size, count=1):
+        budget = self.budget() if self.budget else 0
+        max_entries = self.max_entries() if self.max_entries else 0
+
+        if budget and self.total_size() + size > budget:
+            return False
+
+        if max_entries and len(self.entries) + count > max_entries:
+            return False
+
+        return True
+
+    def victim(self, keep=()):
+        candidates = [(key, entry) for key, entry in self.entries.items() if key not in keep]
+        if not candidates:
+            return None
+
+        if self.policy() == "LFU":
+            # min() returns the first of equal elements, so ties go to the least recently used one
+            return min(candidates, key=lambda x: x[1].uses)[0]
+
+        return candidates[0][0]
+
+    def evict(self, keep=(), size=0, count=0):
+        """
+        Removes entries until the tier is within its budget with room for an additional item of specified size and count.
+        Keys in keep are never removed. Returns a list of (key, value) tuples of removed entries.
+        """
+
+        evicted = []
+
+        with self.lock:
+            while not self.has_room(size, count):
+                key = self.victim(keep)
+                if key is None:
+                    break
+
+                evicted.append((key, self.entries.pop(key).value))
+                self.evictions += 1
+
+        return evicted
+
+    def export_metrics(self, cache_name):
+        """Copies hit and miss counts and size of this tier into metrics, labeled with cache_name."""
+
+        with self.lock:
+            metrics.cache_lookups_total.set(self.hits, cache=cache_name, result="hit")
+            metrics.cache_lookups_total.set(self.misses, cache=cache_name, result="miss")
+            metrics.cache_entries.set(len(self.entries), cache=cache_name)
+            metrics.cache_bytes.set(self.total_size(), cache=cache_name)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_size(),
+                "budget_bytes": (self.budget() if self.budget else 0) or None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else None,
+                "evictions": self.evictions,
+            }
+
+
+class ModelResidency:
+    """
+    Keeps track of where weights of checkpoints are resident:
+     - gpu: whole models, ready to be used (ones other than current may be offloaded to RAM if sd_checkpoints_keep_in_cpu is set)
+     - ram: state dicts in pinned memory; switching to a checkpoint from this tier is a copy from RAM rather than a read from disk
+     - disk: files that were read from disk, without their contents; this only counts reads, each of which is a miss of
+       the tiers above, and keeps the disk_tier_entries most recently read files so that the tier does not grow forever
+
+    Entries are keyed by checkpoint filename.
+    """
+
+    def __init__(self):
+        self.gpu = Tier("gpu", budget=lambda: shared.opts.sd_residency_gpu_mb * MB, max_entries=lambda: shared.opts.sd_checkpoints_limit)
+        self.ram = Tier("ram", budget=lambda: shared.opts.sd_residency_ram_mb * MB, max_entries=lambda: 0 if shared.opts.sd_residency_ram_mb > 0 else shared.opts.sd_checkpoint_cache)
+        self.disk = Tier("disk", max_entries=lambda: disk_tier_entries)
+
+        self.prefetched_filename = None
+        self.prefetched = None
+        """Future with a state dict read in advance by sd_models_prefetch"""
+
+        self.prefetch_lock = threading.Lock()
+
+    @property
+    def tiers(self):
+        return [self.gpu, self.ram, self.disk]
+
+    def ram_enabled(self):
+        return shared.opts.sd_residency_ram_mb > 0 or shared.opts.sd_checkpoint_cache > 0
+
+    def get_state_dict(self, filename):
+        """Returns a shallow copy of the state dict from RAM tier, or None. The copy can be consumed by loading without affecting the tier."""
+
+        if not self.ram_enabled():
+            return None
+
+        state_dict = self.ram.get(filename)
+        return None if state_dict is None else dict(state_dict)
+
+    def has_state_dict(self, filename):
+        return self.ram_enabled() and filename in self.ram
+
+    def store_state_dict(self, filename, state_dict):
+        """Puts a copy of state_dict, pinned if possible, into RAM tier, dropping other entries that do not fit."""
+
+        if not self.ram_enabled() or filename in self.ram:
+            return
+
+        size = state_dict_size(state_dict)
+        for key, _ in self.ram.evict(keep={filename}, size=size, count=1):
+            print(f"Removing checkpoint weights from RAM cache: {key}")
+
+        if not self.ram.has_room(size):
+            return
+
+        self.ram.put(filename, pin_state_dict(state_dict), size)
+
+    def record_disk_read(self, filename, size):
+        with self.disk.lock:
+            self.disk.misses += 1
+            self.disk.evict(keep={filename}, count=0 if filename in self.disk else 1)
+            self.disk.put(filename, None, size)
+
+    def set_prefetched(self, filename, future):
+        """Stores the state dict that is being read in advance; returns False if another read is still in progress."""
+
+        with self.prefetch_lock:
+            if self.prefetched is not None and not self.prefetched.done():
+                return False
+
+            self.prefetched_filename = filename
+            self.prefetched = future
+            return True
+
+    def is_prefetched(self, filename):
+        return self.prefetched_filename == filename
+
+    def take_prefetched(self, filename):
+        """Returns the state dict read in advance for filename, waiting for the read to finish if necessary; None if there isn't one."""
+
+        with self.prefetch_lock:
+            if self.prefetched_filename != filename or self.prefetched is None:
+                return None
+
+            future = self.prefetched
+            self.prefetched_filename = None
+            self.prefetched = None
+
+        return future.result()
+
+    def drop_prefetched(self, filename):
+        """Forgets the state dict read in advance for filename, if there is one; a read that is still in progress finishes into nowhere."""
+
+        with self.prefetch_lock:
+            if self.prefetched_filename == filename:
+                self.prefetched_filename = None
+                self.prefetched = None
+
+    def stats(self):
+        return {tier.name: tier.stats() for tier in self.tiers}
+
+
+residency = ModelResidency()
+
+
+def collect_metrics():
+    residency.gpu.export_metrics("checkpoint gpu")
+    residency.ram.export_metrics("checkpoint ram")
+
+
+metrics.add_collector(collect_metrics)
@@ -1,5 +1,5 @@
 import torch
-from modules import prompt_parser, sd_samplers_common
+from modules import prompt_parser, sd_samplers_common, step_profiler
 
 from modules.shared import opts, state
 import modules.shared as shared
@@ -30,6 +30,67 @@ def pad_cond(tensor, repeats, empty):
     return tensor
 
 
+class CFGInputBuffers:
+    """
+    Inputs for the model that CFGDenoiser assembles at every step, kept in buffers that are allocated once and reused for as long
+    as their shapes stay the same. Rows of x, sigma and image_cond are gathered into buffers with index_select rather than
+    stacked and concatenated anew. Used when cfg_denoiser_preallocate setting is enabled; returned tensors are overwritten at the
+    next step, so they must not be kept.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.indexes = {}
+
+    def buffer(self, name, shape, like):
+        res = self.buffers.get(name)
+        if res is None or res.shape != shape or res.dtype != like.dtype or res.device != like.device:
+            res = torch.empty(shape, dtype=like.dtype, device=like.device)
+            self.buffers[name] = res
+
+        return res
+
+    def index(self, repeats, uncond_copies, device):
+        """Returns indexes of rows of x that make up x_in: row i repeated repeats[i] times for conds, followed by all rows for every copy of uncond."""
+
+        key = (tuple(repeats), uncond_copies, device)
+
+        res = self.indexes.get(key)
+        if res is None:
+            rows = [i for i, n in enumerate(repeats) for _ in range(n)] + list(range(len(repeats))) * uncond_copies
+            res = torch.tensor(rows, dtype=torch.long, device=device)
+            self.indexes[key] = res
+
+        return res
+
+    def gather(self, name, x, index):
+        return torch.index_select(x, 0, index, out=self.buffer(name, index.shape + x.shape[1:], x))
+
+    def assemble(self, x, sigma, image_cond, image_uncond, repeats, is_edit_model):
+        """Returns x_in, sigma_in and image_cond_in, same as CFGDenoiser.forward would create without buffers."""
+
+        uncond_copies = 2 if is_edit_model else 1
+        batch_size = len(repeats)
+        cond_count = sum(repeats)
+
+        x_in = self.gather("x_in", x, self.index(repeats, uncond_copies, x.device))
+        sigma_in = self.gather("sigma_in", sigma, self.index(repeats, uncond_copies, sigma.device))
+
+        index = self.index(repeats, uncond_copies, image_cond.device)
+        image_cond_in = self.buffer("image_cond_in", index.shape + image_cond.shape[1:], image_cond)
+        torch.index_select(image_cond, 0, index[:cond_count], out=image_cond_in[:cond_count])
+        image_cond_in[cond_count:cond_count + batch_size].copy_(image_uncond)
+        if is_edit_model:
+            image_cond_in[cond_count + batch_size:].zero_()
+
+        return x_in, sigma_in, image_cond_in
+
+    def output(self, x_in):
+        """Returns an uninitialized buffer for model's output for x_in."""
+
+        return self.buffer("x_out", x_in.shape, x_in)
+
+
 class CFGDenoiser(torch.nn.Module):
     """
     Classifier free guidance denoiser. A wrapper for stable diffusion model (specifically for unet)
@@ -60,6 +121,11 @@ class CFGDenoiser(torch.nn.Module):
 
         self.cond_scale_miltiplier = 1.0
 
+        self.compiled_conds = None
+        """(cond, uncond, compiled cond, compiled uncond) tuple for conds used by the latest call to forward()"""
+
+        self.input_buffers = CFGInputBuffers()
+
         self.need_last_noise_uncond = False
         self.last_noise_uncond = None
 
@@ -71,6 +137,10 @@ class CFGDenoiser(torch.nn.Module):
     def inner_model(self):
         raise NotImplementedError()
 
+    def run_inner_model(self, x, sigma, cond):
+        with step_profiler.span("unet"):
+            return self.inner_model(x, sigma, cond=cond)
+
     def combine_denoised(self, x_out, conds_list, uncond, cond_scale):
         denoised_uncond = x_out[-uncond.shape[0]:]
         denoised = torch.clone(denoised_uncond)
@@ -97,6 +167,22 @@ class CFGDenoiser(torch.nn.Module):
         self.sampler.sampler_extra_args['cond'] = c
         self.sampler.sampler_extra_args['uncond'] = uc
 
+    def get_compiled_conds(self, cond, uncond):
+        """Returns cond and uncond compiled for lookup by step (see prompt_parser.CompiledCondBatch); they are only compiled again when they change."""
+
+        if self.compiled_conds is None or self.compiled_conds[0] is not cond or self.compiled_conds[1] is not uncond:
+            self.compiled_conds = (cond, uncond, prompt_parser.CompiledMulticondBatch(cond), prompt_parser.CompiledCondBatch(uncond))
+
+        return self.compiled_conds[2], self.compiled_conds[3]
+
+    def new_output(self, x_in):
+        """Returns a tensor for model's output to be written into part by part."""
+
+        if shared.opts.cfg_denoiser_preallocate:
+            return self.input_buffers.output(x_in)
+
+        return torch.zeros_like(x_in)
+
     def pad_cond_uncond(self, cond, uncond):
         empty = shared.sd_model.cond_stage_model_empty_prompt
         num_repeats = (cond.shape[1] - uncond.shape[1]) // empty.shape[1]
@@ -165,8 +251,9 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        compiled_cond, compiled_uncond = self.get_compiled_conds(cond, uncond)
+        conds_list, tensor = compiled_cond.get(self.step)
+        uncond = compiled_uncond.get(self.step)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -199,7 +286,9 @@ class CFGDenoiser(torch.nn.Module):
             else:
                 make_condition_dict = lambda c_crossattn, c_concat: {"c_crossattn": [c_crossattn], "c_concat": [c_concat]}
 
-        if not is_edit_model:
+        if shared.opts.cfg_denoiser_preallocate:
+            x_in, sigma_in, image_cond_in = self.input_buffers.assemble(x, sigma, image_cond, image_uncond, repeats, is_edit_model)
+        elif not is_edit_model:
             x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
             sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
             image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond])
@@ -209,7 +298,8 @@ class CFGDenoiser(torch.nn.Module):
             image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond] + [torch.zeros_like(self.init_latent)])
 
         denoiser_params = CFGDenoiserParams(x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps, tensor, uncond, self)
-        cfg_denoiser_callback(denoiser_params)
+        with step_profiler.span("denoiser callbacks"):
+            cfg_denoiser_callback(denoiser_params)
         x_in = denoiser_params.x
         image_cond_in = denoiser_params.image_cond
         sigma_in = denoiser_params.sigma
@@ -246,15 +336,15 @@ class CFGDenoiser(torch.nn.Module):
                 cond_in = catenate_conds([tensor, uncond])
 
             if shared.opts.batch_cond_uncond:
-                x_out = self.inner_model(x_in, sigma_in, cond=make_condition_dict(cond_in, image_cond_in))
+                x_out = self.run_inner_model(x_in, sigma_in, cond=make_condition_dict(cond_in, image_cond_in))
             else:
-                x_out = torch.zeros_like(x_in)
+                x_out = self.new_output(x_in)
                 for batch_offset in range(0, x_out.shape[0], batch_size):
                     a = batch_offset
                     b = a + batch_size
-                    x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(subscript_cond(cond_in, a, b), image_cond_in[a:b]))
+                    x_out[a:b] = self.run_inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(subscript_cond(cond_in, a, b), image_cond_in[a:b]))
         else:
-            x_out = torch.zeros_like(x_in)
+            x_out = self.new_output(x_in)
             batch_size = batch_size*2 if shared.opts.batch_cond_uncond else batch_size
             for batch_offset in range(0, tensor.shape[0], batch_size):
                 a = batch_offset
@@ -265,10 +355,10 @@ class CFGDenoiser(torch.nn.Module):
                 else:
                     c_crossattn = torch.cat([tensor[a:b]], uncond)
 
-                x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(c_crossattn, image_cond_in[a:b]))
+                x_out[a:b] = self.run_inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(c_crossattn, image_cond_in[a:b]))
 
             if not skip_uncond:
-                x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict(uncond, image_cond_in[-uncond.shape[0]:]))
+                x_out[-uncond.shape[0]:] = self.run_inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict(uncond, image_cond_in[-uncond.shape[0]:]))
 
         denoised_image_indexes = [x[0][0] for x in conds_list]
         if skip_uncond:
@@ -276,17 +366,19 @@ class CFGDenoiser(torch.nn.Module):
             x_out = torch.cat([x_out, fake_uncond])  # we skipped uncond denoising, so we put cond-denoised image to where the uncond-denoised image should be
 
         denoised_params = CFGDenoisedParams(x_out, state.sampling_step, state.sampling_steps, self.inner_model)
-        cfg_denoised_callback(denoised_params)
+        with step_profiler.span("denoiser callbacks"):
+            cfg_denoised_callback(denoised_params)
 
         if self.need_last_noise_uncond:
             self.last_noise_uncond = torch.clone(x_out[-uncond.shape[0]:])
 
-        if is_edit_model:
-            denoised = self.combine_denoised_for_edit_model(x_out, cond_scale * self.cond_scale_miltiplier)
-        elif skip_uncond:
-            denoised = self.combine_denoised(x_out, conds_list, uncond, 1.0)
-        else:
-            denoised = self.combine_denoised(x_out, conds_list, uncond, cond_scale * self.cond_scale_miltiplier)
+        with step_profiler.span("cfg combine"):
+            if is_edit_model:
+                denoised = self.combine_denoised_for_edit_model(x_out, cond_scale * self.cond_scale_miltiplier)
+            elif skip_uncond:
+                denoised = self.combine_denoised(x_out, conds_list, uncond, 1.0)
+            else:
+                denoised = self.combine_denoised(x_out, conds_list, uncond, cond_scale * self.cond_scale_miltiplier)
 
         # Blend in the original latents (after)
         if not self.mask_before_denoising and self.mask is not None:
@@ -304,7 +396,8 @@ class CFGDenoiser(torch.nn.Module):
         sd_samplers_common.store_latent(preview)
 
         after_cfg_callback_params = AfterCFGCallbackParams(denoised, state.sampling_step, state.sampling_steps)
-        cfg_after_cfg_callback(after_cfg_callback_params)
+        with step_profiler.span("denoiser callbacks"):
+            cfg_after_cfg_callback(after_cfg_callback_params)
         denoised = after_cfg_callback_params.x
 
         self.step += 1
@@ -1,9 +1,10 @@
 import inspect
+import time
 from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models
+from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models, sd_vae_tiled, metrics
 from modules.shared import opts, state
 import k_diffusion.sampling
 
@@ -54,7 +55,7 @@ def samples_to_images_tensor(sample, approximation=None, model=None):
     else:
         if model is None:
             model = shared.sd_model
-        with torch.no_grad(), devices.without_autocast(): # fixes an issue with unstable VAEs that are flaky even in fp32
+        with torch.no_grad(), devices.without_autocast(), sd_vae_tiled.tiled_vae(model.first_stage_model, sample.shape[2], sample.shape[3]): # fixes an issue with unstable VAEs that are flaky even in fp32
             x_sample = model.decode_first_stage(sample.to(model.first_stage_model.dtype))
 
     return x_sample
@@ -99,15 +100,16 @@ def images_tensor_to_samples(image, approximation=None, model=None):
 
         image = image.to(shared.device, dtype=devices.dtype_vae)
         image = image * 2 - 1
-        if len(image) > 1:
-            x_latent = torch.stack([
-                model.get_first_stage_encoding(
-                    model.encode_first_stage(torch.unsqueeze(img, 0))
-                )[0]
-                for img in image
-            ])
-        else:
-            x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
+        with sd_vae_tiled.tiled_vae(model.first_stage_model, image.shape[2] // 8, image.shape[3] // 8):
+            if len(image) > 1:
+                x_latent = torch.stack([
+                    model.get_first_stage_encoding(
+                        model.encode_first_stage(torch.unsqueeze(img, 0))
+                    )[0]
+                    for img in image
+                ])
+            else:
+                x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
 
     return x_latent
 
@@ -268,6 +270,8 @@ class Sampler:
         state.sampling_steps = steps
         state.sampling_step = 0
 
+        started_at = time.perf_counter()
+
         try:
             return func()
         except RecursionError:
@@ -279,6 +283,10 @@ class Sampler:
             return self.last_latent
         except InterruptedException:
             return self.last_latent
+        finally:
+            sampler_name = self.config.name if self.config is not None else self.funcname
+            metrics.sampling_steps_total.inc(state.sampling_step + 1, sampler=sampler_name)
+            metrics.sampling_seconds_total.inc(time.perf_counter() - started_at, sampler=sampler_name)
 
     def number_of_needed_noises(self, p):
         return p.steps
@@ -198,6 +198,9 @@ def load_vae(model, vae_file=None, vae_source="from unknown source"):
     cache_enabled = shared.opts.sd_vae_checkpoint_cache > 0
 
     if vae_file:
+        # VAE hash goes into infotext; start calculating it now so that it's ready by the time it's needed
+        hashes.sha256_async(vae_file, 'vae', priority=hashes.PRIORITY_REQUEST)
+
         if cache_enabled and vae_file in checkpoints_loaded:
             # use vae checkpoint cache
             print(f"Loading VAE weights {vae_source}: cached {get_filename(vae_file)}")
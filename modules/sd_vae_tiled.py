@@ -0,0 +1,191 @@
+"""
+Tiled VAE: runs VAE's encoder and decoder on overlapping tiles, so that memory use does not grow with image size.
+
+GroupNorm layers normalize using statistics of the whole image, so running them on tiles separately would make each tile
+come out with different colors. To avoid that, the network is first run on a downscaled copy of the whole input, recording
+statistics of every GroupNorm call, and then the tiles are run with GroupNorm using recorded statistics instead of their own.
+Tiles are blended with linear ramps where they overlap.
+"""
+
+import contextlib
+import functools
+
+import torch
+
+from modules import devices, shared, sd_hijack_optimizations
+
+bytes_per_latent_pixel = 64 * 128 * 12
+"""rough estimate of how much memory VAE needs for each pixel of latent space, in units of VAE's element size: each latent pixel is 8x8 image pixels, and the decoder keeps about a dozen 128-channel tensors at full resolution"""
+
+
+class GroupNormStats:
+    def __init__(self):
+        self.recording = True
+        self.stats = {}
+        """maps GroupNorm module to a list of (mean, var) tuples, one for each call during recording"""
+
+        self.position = {}
+
+    def rewind(self):
+        self.position = {}
+
+    def forward(self, module, x):
+        n = x.shape[0]
+
+        if self.recording:
+            var, mean = torch.var_mean(x.float().reshape(n, module.num_groups, -1), dim=2, unbiased=False)
+            self.stats.setdefault(module, []).append((mean, var))
+
+            return torch.nn.functional.group_norm(x, module.num_groups, module.weight, module.bias, module.eps)
+
+        calls = self.stats.get(module, [])
+        index = self.position.get(module, 0)
+        if index >= len(calls) or calls[index][0].shape[0] != n:
+            return torch.nn.functional.group_norm(x, module.num_groups, module.weight, module.bias, module.eps)
+
+        self.position[module] = index + 1
+        mean, var = calls[index]
+
+        res = x.float().reshape(n, module.num_groups, -1)
+        res = (res - mean[..., None]) * torch.rsqrt(var[..., None] + module.eps)
+        res = res.reshape(x.shape).to(x.dtype)
+
+        if module.affine:
+            shape = (1, -1) + (1,) * (x.dim() - 2)
+            res = res * module.weight.view(shape) + module.bias.view(shape)
+
+        return res
+
+
+@contextlib.contextmanager
+def group_norm_override(network, stats):
+    modules = [x for x in network.modules() if isinstance(x, torch.nn.GroupNorm)]
+
+    for module in modules:
+        module.forward = functools.partial(stats.forward, module)
+
+    try:
+        yield
+    finally:
+        for module in modules:
+            del module.forward
+
+
+def tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+
+    stride = max(1, tile - overlap)
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+
+    return starts
+
+
+def blend_ramp(length, ramp, at_start, at_end, device):
+    res = torch.ones(length, device=device)
+
+    ramp = min(ramp, length // 2)
+    if ramp > 0:
+        values = torch.linspace(1 / (ramp + 1), ramp / (ramp + 1), ramp, device=device)
+        if at_start:
+            res[:ramp] = values
+        if at_end:
+            res[-ramp:] = values.flip(0)
+
+    return res
+
+
+def tiled_forward(forward, network, x, scale_in, scale_out, tile_size, overlap, **kwargs):
+    """
+    Runs forward (encoder's or decoder's original forward) on tiles of x, where tile_size and overlap are in units of latent pixels;
+    scale_in and scale_out are how many pixels of input and output correspond to one latent pixel.
+    """
+
+    n, _, height, width = x.shape
+    units_h, units_w = height // scale_in, width // scale_in
+
+    if units_h <= tile_size and units_w <= tile_size:
+        return forward(x, **kwargs)
+
+    stats = GroupNormStats()
+
+    with group_norm_override(network, stats):
+        factor = tile_size / max(units_h, units_w)
+        small = torch.nn.functional.interpolate(x, size=(max(1, int(units_h * factor)) * scale_in, max(1, int(units_w * factor)) * scale_in), mode="area")
+        forward(small, **kwargs)
+        del small
+
+        stats.recording = False
+
+        res = None
+        weights = None
+
+        ys = tile_starts(units_h, tile_size, overlap)
+        xs = tile_starts(units_w, tile_size, overlap)
+
+        for y in ys:
+            for x0 in xs:
+                h, w = min(tile_size, units_h), min(tile_size, units_w)
+
+                stats.rewind()
+                tile = forward(x[:, :, y * scale_in:(y + h) * scale_in, x0 * scale_in:(x0 + w) * scale_in], **kwargs)
+
+                if res is None:
+                    res = torch.zeros((n, tile.shape[1], units_h * scale_out, units_w * scale_out), device=tile.device, dtype=torch.float32)
+                    weights = torch.zeros((1, 1, units_h * scale_out, units_w * scale_out), device=tile.device, dtype=torch.float32)
+
+                ramp = overlap * scale_out // 2
+                weight_y = blend_ramp(h * scale_out, ramp, y > 0, y + h < units_h, tile.device)
+                weight_x = blend_ramp(w * scale_out, ramp, x0 > 0, x0 + w < units_w, tile.device)
+                weight = weight_y[:, None] * weight_x[None, :]
+
+                region = (slice(None), slice(None), slice(y * scale_out, (y + h) * scale_out), slice(x0 * scale_out, (x0 + w) * scale_out))
+                res[region] += tile.float() * weight
+                weights[region] += weight
+
+                del tile
+
+    return (res / weights).to(x.dtype)
+
+
+def should_tile(latent_height, latent_width):
+    mode = shared.opts.sd_vae_tiling
+    if mode == "Never":
+        return False
+
+    tile_size = shared.opts.sd_vae_tile_size // 8
+    if latent_height <= tile_size and latent_width <= tile_size:
+        return False
+
+    if mode == "Always":
+        return True
+
+    element_size = torch.tensor([], dtype=devices.dtype_vae).element_size()
+    required = latent_height * latent_width * bytes_per_latent_pixel * element_size
+
+    return required > sd_hijack_optimizations.get_available_vram()
+
+
+@contextlib.contextmanager
+def tiled_vae(first_stage_model, latent_height, latent_width):
+    """While active, VAE's encoder and decoder run on tiles if should_tile() decides so for the specified latent size."""
+
+    if not should_tile(latent_height, latent_width):
+        yield
+        return
+
+    tile_size = shared.opts.sd_vae_tile_size // 8
+    overlap = shared.opts.sd_vae_tile_overlap // 8
+
+    encoder = first_stage_model.encoder
+    decoder = first_stage_model.decoder
+
+    encoder.forward = functools.partial(tiled_forward, encoder.forward, encoder, scale_in=8, scale_out=1, tile_size=tile_size, overlap=overlap)
+    decoder.forward = functools.partial(tiled_forward, decoder.forward, decoder, scale_in=1, scale_out=8, tile_size=tile_size, overlap=overlap)
+
+    try:
+        yield
+    finally:
+        del encoder.forward
+        del decoder.forward
@@ -36,7 +36,11 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "samples_format": OptionInfo('png', 'File format for images'),
     "samples_filename_pattern": OptionInfo("", "Images filename pattern", component_args=hide_dirs).link("wiki", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/wiki/Custom-Images-Filename-Name-and-Subdirectory"),
     "save_images_add_number": OptionInfo(True, "Add number to filename when saving", component_args=hide_dirs),
+    "save_images_sequence_cache": OptionInfo(True, "Remember next number for filenames in cache").info("avoids listing the whole output directory for every saved image; numbers of deleted images are not reused"),
     "save_images_replace_action": OptionInfo("Replace", "Saving the image to an existing file", gr.Radio, {"choices": ["Replace", "Add number suffix"], **hide_dirs}),
+    "save_images_async": OptionInfo(False, "Save images in background").info("generation continues while images are being written to disk; image saved callbacks of extensions are called from a background thread"),
+    "save_images_async_threads": OptionInfo(2, "Number of threads for saving images in background", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
+    "save_images_async_max_pending": OptionInfo(16, "Maximum number of images waiting to be saved in background", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}).info("when reached, generation waits for images to be written"),
     "grid_save": OptionInfo(True, "Always save all generated image grids"),
     "grid_format": OptionInfo('png', 'File format for grids'),
     "grid_extended_filename": OptionInfo(False, "Add extended info (seed, prompt) to filename when saving grid"),
@@ -103,6 +107,7 @@ options_templates.update(options_section(('upscaling', "Upscaling", "postprocess
     "dat_enabled_models": OptionInfo(["DAT x2", "DAT x3", "DAT x4"], "Select which DAT models to show in the web UI.", gr.CheckboxGroup, lambda: {"choices": shared_items.dat_models_names()}),
     "DAT_tile": OptionInfo(192, "Tile size for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 512, "step": 16}).info("0 = no tiling"),
     "DAT_tile_overlap": OptionInfo(8, "Tile overlap for DAT upscalers.", gr.Slider, {"minimum": 0, "maximum": 48, "step": 1}).info("Low values = visible seam"),
+    "upscaler_tile_batch_size": OptionInfo(0, "Number of tiles to upscale at once", gr.Slider, {"minimum": 0, "maximum": 64, "step": 1}).info("0 = as many as fit into free memory"),
     "upscaler_for_img2img": OptionInfo(None, "Upscaler for img2img", gr.Dropdown, lambda: {"choices": [x.name for x in shared.sd_upscalers]}),
     "set_scale_by_when_changing_upscaler": OptionInfo(False, "Automatically set the Scale by factor based on the name of the selected Upscaler."),
 }))
@@ -126,6 +131,7 @@ options_templates.update(options_section(('system', "System", "system"), {
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
     "list_hidden_files": OptionInfo(True, "Load models/files in hidden directories").info("directory is hidden if its name starts with \".\""),
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
+    "hash_threads": OptionInfo(2, "Number of threads for calculating model hashes in background", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("files needed by the current generation are hashed first").needs_restart(),
     "hide_ldm_prints": OptionInfo(True, "Prevent Stability-AI's ldm/sgm modules from printing noise to console."),
     "dump_stacks_on_signal": OptionInfo(False, "Print stack traces before exiting the program with ctrl+c."),
 }))
@@ -144,12 +150,22 @@ Warning: writing profile can take a lot of time, up to 30 seconds, and the file
     "profiling_profile_memory": OptionInfo(True, "Profile memory"),
     "profiling_with_stack": OptionInfo(True, "Include python stack"),
     "profiling_filename": OptionInfo("trace.json", "Profile filename"),
+    "step_profiler_enable": OptionInfo(True, "Record time spent in generation components").info("text encoding, noise, UNet, CFG, callbacks, LoRA patching, VAE decode, postprocessing scripts, saving; reported in generation info and by /sdapi/v1/profile API"),
+    "step_profiler_timing": OptionInfo("CUDA events", "Component timing method", gr.Radio, {"choices": ["CUDA events", "perf_counter"]}).info("CUDA events measure time spent by GPU, and are only used on CUDA devices; perf_counter measures time spent by CPU"),
+    "step_profiler_window": OptionInfo(1000, "Number of latest timings to keep for each component", gr.Slider, {"minimum": 1, "maximum": 10000, "step": 1}).info("for histograms reported by /sdapi/v1/profile API"),
 }))
 
 options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "api_image_transport": OptionInfo("base64", "How to send generated images in API responses", gr.Radio, {"choices": ["base64", "binary", "path", "url"]}).info("base64 = strings in JSON; binary = parts of multipart/form-data response; path/url = references to files stored on server; can be changed per request with X-Image-Transport header"),
+    "api_image_reference_ttl": OptionInfo(600, "Time to keep images returned by reference", gr.Number).info("seconds"),
+    "api_job_grouping": OptionInfo(False, "Reorder queued jobs to run ones using the same checkpoint, VAE and resolution together").info("fewer model switches at the cost of jobs not always running in order of arrival"),
+    "api_job_grouping_max_skips": OptionInfo(4, "Maximum number of times a queued job can be passed over by reordering", gr.Slider, {"minimum": 0, "maximum": 32, "step": 1}).info("0 = run jobs in order of arrival"),
+    "api_dynamic_batching": OptionInfo(False, "Batch together txt2img requests that only differ in prompt and seed").info("requests with scripts or n_iter above 1 are never batched"),
+    "api_dynamic_batching_window": OptionInfo(50, "Time to wait for more requests to batch with", gr.Slider, {"minimum": 0, "maximum": 1000, "step": 10}).info("milliseconds; the first request of a batch is delayed by this much"),
+    "api_dynamic_batching_max_size": OptionInfo(8, "Maximum number of images in a batched txt2img job", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -171,7 +187,11 @@ options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": shared_items.list_checkpoint_tiles(shared.opts.sd_checkpoint_dropdown_use_short)}, refresh=shared_items.refresh_checkpoints, infotext='Model hash'),
     "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
     "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
-    "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
+    "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the settings above and below instead"),
+    "sd_residency_gpu_mb": OptionInfo(0, "Memory budget for loaded checkpoints", gr.Number, {"precision": 0}).info("in MB; 0 = only limit by the maximum number of checkpoints above"),
+    "sd_residency_ram_mb": OptionInfo(0, "Memory budget for checkpoint weights cached in RAM", gr.Number, {"precision": 0}).info("in MB; weights are kept in pinned memory, so switching to a cached checkpoint is a copy from RAM rather than a read from disk; 0 = use the obsolete setting above"),
+    "sd_checkpoint_prefetch": OptionInfo(False, "Prefetch checkpoints for queued API requests").info("while a job runs, read weights of the checkpoint needed by the next queued request into RAM; uses RAM for one additional checkpoint"),
+    "sd_residency_policy": OptionInfo("LRU", "Which cached checkpoints to evict first", gr.Radio, {"choices": ["LRU", "LFU"]}).info("LRU = least recently used; LFU = least frequently used"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
     "emphasis": OptionInfo("Original", "Emphasis mode", gr.Radio, lambda: {"choices": [x.name for x in sd_emphasis.options]}, infotext="Emphasis").info("makes it possible to make model to pay (more:1.1) or (less:0.9) attention to text when you use the syntax in prompt; " + sd_emphasis.get_options_descriptions()),
@@ -210,6 +230,10 @@ For img2img, VAE is used to process user's input image before the sampling, and
     "auto_vae_precision": OptionInfo(True, "Automatically revert VAE to 32-bit floats").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image"),
     "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask)"),
     "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Decoder').info("method to decode latent to image"),
+    "sd_vae_tiling": OptionInfo("Automatic", "Tiled VAE", gr.Radio, {"choices": ["Automatic", "Always", "Never"]}).info("encode and decode large images in tiles to use less memory; Automatic = only when the whole image is not expected to fit into free memory"),
+    "sd_vae_tile_size": OptionInfo(1024, "Tiled VAE tile size", gr.Slider, {"minimum": 256, "maximum": 4096, "step": 64}).info("in pixels"),
+    "sd_vae_tile_overlap": OptionInfo(64, "Tiled VAE tile overlap", gr.Slider, {"minimum": 0, "maximum": 256, "step": 8}).info("in pixels"),
+    "sd_vae_decode_batch_size": OptionInfo(0, "Maximum number of images to decode with VAE at once", gr.Slider, {"minimum": 0, "maximum": 16, "step": 1}).info("0 = as many as fit into free memory; 1 = one at a time"),
 }))
 
 options_templates.update(options_section(('img2img', "img2img", "sd"), {
@@ -239,6 +263,10 @@ options_templates.update(options_section(('optimizations', "Optimizations", "sd"
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "cond_cache_mb": OptionInfo(64, "Text encoder output cache size", gr.Number, {"precision": 0}).info("in MB of VRAM; keeps text encoder outputs for prompt chunks across generations, so that chunks repeated in many prompts are only encoded once; 0 = disable"),
+    "cond_cache_disk": OptionInfo(False, "Write text encoder outputs evicted from cache to disk").info("and read them back when the same prompt chunk is used again"),
+    "cond_encode_batch_size": OptionInfo(0, "Maximum number of prompt chunks to encode with text encoder at once", gr.Slider, {"minimum": 0, "maximum": 256, "step": 1}).info("chunks of all prompts of a batch, positive and negative, are encoded together; 0 = as many as fit into free memory; 1 = one prompt at a time"),
+    "cfg_denoiser_preallocate": OptionInfo(False, "Reuse sampling input buffers").info("allocate inputs for the model once per sampling run instead of at every step; reduces per-step overhead; may break extensions that keep denoiser inputs or outputs between steps"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond commandline argument"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
@@ -258,6 +286,7 @@ options_templates.update(options_section(('compatibility', "Compatibility", "sd"
 
 options_templates.update(options_section(('interrogate', "Interrogate"), {
     "interrogate_keep_models_in_memory": OptionInfo(False, "Keep models in VRAM"),
+    "interrogate_batch_size": OptionInfo(8, "Batch size for interrogating multiple images", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}).info("used by API and by captioning in Extras"),
     "interrogate_return_ranks": OptionInfo(False, "Include ranks of model tags matches in results.").info("booru only"),
     "interrogate_clip_num_beams": OptionInfo(1, "BLIP: num_beams", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}),
     "interrogate_clip_min_length": OptionInfo(24, "BLIP: minimum description length", gr.Slider, {"minimum": 1, "maximum": 128, "step": 1}),
@@ -351,6 +380,8 @@ It is displayed in UI below the image. To use infotext, paste it into the prompt
 """),
     "enable_pnginfo": OptionInfo(True, "Write infotext to metadata of the generated image"),
     "save_txt": OptionInfo(False, "Create a text file with infotext next to every generated image"),
+    "infotext_index_enable": OptionInfo(False, "Add saved images to infotext index").info("allows searching images by seed, prompt, model, sampler, size and LoRA using /sdapi/v1/infotext-index API without reading every file"),
+    "infotext_index_save_every": OptionInfo(50, "Write infotext index to disk after this many saved images", gr.Slider, {"minimum": 1, "maximum": 1000, "step": 1}),
 
     "add_model_name_to_info": OptionInfo(True, "Add model name to infotext"),
     "add_model_hash_to_info": OptionInfo(True, "Add model hash to infotext"),
@@ -0,0 +1,204 @@
+"""
+Lightweight timing of generation components (text encoding, noise, UNet, VAE decode, saving and so on) that is always on,
+unlike torch profiler in profiling.py. Code marks a component with span(name); while a job started with job() is running,
+time spent in spans is added to that job's totals, which end up in Processed.js(), and to rolling histograms of the
+latest durations of every component, which are available via /sdapi/v1/profile.
+"""
+
+import collections
+import contextlib
+import functools
+import threading
+import time
+
+import torch
+
+from modules import devices, shared, metrics
+
+histogram_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+"""upper bounds, in seconds, of histogram buckets; durations above the last one are only counted in the +Inf bucket"""
+
+
+class RollingHistogram:
+    """Durations of the latest calls of one component, plus a count and a total of all calls ever made."""
+
+    def __init__(self, size):
+        self.durations = collections.deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, duration):
+        self.durations.append(duration)
+        self.count += 1
+        self.total += duration
+
+    def summary(self):
+        durations = sorted(self.durations)
+
+        def percentile(p):
+            return durations[min(len(durations) - 1, int(p * len(durations)))] if durations else None
+
+        buckets = {}
+        position = 0
+        for bound in histogram_buckets:
+            while position < len(durations) and durations[position] <= bound:
+                position += 1
+
+            buckets[str(bound)] = position
+
+        buckets["+Inf"] = len(durations)
+
+        return {
+            "count": self.count,
+            "total": self.total,
+            "window": len(durations),
+            "mean": sum(durations) / len(durations) if durations else None,
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "buckets": buckets,
+        }
+
+
+histograms = {}
+"""maps component name to RollingHistogram"""
+
+histograms_lock = threading.Lock()
+
+
+def record(name, duration):
+    window = max(1, int(shared.opts.step_profiler_window))
+
+    with histograms_lock:
+        histogram = histograms.get(name)
+        if histogram is None or histogram.durations.maxlen != window:
+            histogram = RollingHistogram(window)
+            histograms[name] = histogram
+
+        histogram.add(duration)
+
+    metrics.component_seconds.observe(duration, component=name)
+
+
+class JobProfile:
+    """
+    Time spent in every component during one job. With CUDA events, durations are only known once the GPU has done the work,
+    so events are kept until finish().
+    """
+
+    def __init__(self, use_cuda_events):
+        self.use_cuda_events = use_cuda_events
+        self.pending = []
+        """list of (name, start event, end event) tuples"""
+
+        self.components = {}
+        """maps component name to [count, total seconds]"""
+
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.duration = None
+
+    def add(self, name, duration):
+        with self.lock:
+            entry = self.components.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+
+        record(name, duration)
+
+    def finish(self):
+        if self.pending:
+            torch.cuda.synchronize()
+
+            for name, start, end in self.pending:
+                self.add(name, start.elapsed_time(end) / 1000)
+
+            self.pending.clear()
+
+        self.duration = time.perf_counter() - self.started_at
+
+    def result(self):
+        return {
+            "total": self.duration,
+            "timing": "CUDA events" if self.use_cuda_events else "perf_counter",
+            "components": {name: {"count": count, "total": total, "mean": total / count} for name, (count, total) in self.components.items()},
+        }
+
+
+current_job = None
+last_job = None
+
+
+@contextlib.contextmanager
+def job():
+    """Records spans into a new JobProfile, which is returned by the context manager; None is returned if a job is already running or if profiling is disabled."""
+
+    global current_job, last_job
+
+    if current_job is not None or not shared.opts.step_profiler_enable:
+        yield None
+        return
+
+    profile = JobProfile(use_cuda_events=shared.opts.step_profiler_timing == "CUDA events" and devices.device.type == "cuda")
+    current_job = profile
+
+    try:
+        yield profile
+    finally:
+        current_job = None
+        profile.finish()
+        last_job = profile
+
+
+@contextlib.contextmanager
+def span(name):
+    """Adds time spent inside the context manager to component name of the running job; does nothing if there is no job."""
+
+    profile = current_job
+    if profile is None:
+        yield
+        return
+
+    if profile.use_cuda_events:
+        start = torch.cuda.Event(enable_timing=True)
+        start.record()
+
+        try:
+            yield
+        finally:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            profile.pending.append((name, start, end))
+
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator that makes every call of the function a span of component name."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def summary():
+    with histograms_lock:
+        components = {name: histogram.summary() for name, histogram in histograms.items()}
+
+    return {
+        "last_job": last_job.result() if last_job is not None else None,
+        "components": components,
+    }
@@ -50,6 +50,7 @@ class Embedding:
         self.filename = None
         self.hash = None
         self.shorthash = None
+        self.hash_future = None
 
     def save(self, filename):
         embedding_data = {
@@ -87,6 +88,26 @@ class Embedding:
         self.hash = v
         self.shorthash = self.hash[0:12]
 
+    def set_hash_from_future(self, future):
+        if future.exception() is None:
+            self.set_hash(future.result() or '')
+
+        self.hash_future = None
+
+    def wait_for_hash(self):
+        """Returns shorthash, waiting for the hash to be calculated if it's still in progress; the hash is moved ahead of files that are hashed in advance."""
+
+        future = self.hash_future
+        if future is not None:
+            if not future.done():
+                hashes.sha256_async(self.filename, "textual_inversion/" + self.name, priority=hashes.PRIORITY_IMMEDIATE)
+
+            # done callbacks run after waiters are woken up, so set_hash_from_future may not have run yet
+            if future.exception() is None:
+                self.set_hash(future.result() or '')
+
+        return self.shorthash
+
 
 class DirWithTextualInversionEmbeddings:
     def __init__(self, path):
@@ -209,6 +230,17 @@ class EmbeddingDatabase:
                     errors.report(f"Error loading embedding {fn}", exc_info=True)
                     continue
 
+    def prewarm_hashes(self):
+        def files():
+            for embdir in self.embedding_dirs.values():
+                for root, _, fns in os.walk(embdir.path, followlinks=True):
+                    for fn in fns:
+                        name, ext = os.path.splitext(fn)
+                        if ext.upper() in ['.BIN', '.PT', '.SAFETENSORS']:
+                            yield os.path.join(root, fn), "textual_inversion/" + name, False
+
+        hashes.prewarm(files())
+
     def load_textual_inversion_embeddings(self, force_reload=False):
         if not force_reload:
             need_reload = False
@@ -318,7 +350,9 @@ def create_embedding_from_data(data, name, filename='unknown embedding file', fi
 
     if filepath:
         embedding.filename = filepath
-        embedding.set_hash(hashes.sha256(filepath, "textual_inversion/" + name) or '')
+        embedding.set_hash('')
+        embedding.hash_future = hashes.sha256_async(filepath, "textual_inversion/" + name)
+        embedding.hash_future.add_done_callback(embedding.set_hash_from_future)
 
     return embedding
 
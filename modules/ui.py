@@ -13,7 +13,7 @@ from PIL import Image, PngImagePlugin  # noqa: F401
 from modules.call_queue import wrap_gradio_gpu_call, wrap_queued_call, wrap_gradio_call, wrap_gradio_call_no_job # noqa: F401
 
 from modules import gradio_extensons, sd_schedulers  # noqa: F401
-from modules import sd_hijack, sd_models, script_callbacks, ui_extensions, deepbooru, extra_networks, ui_common, ui_postprocessing, progress, ui_loadsave, shared_items, ui_settings, timer, sysinfo, ui_checkpoint_merger, scripts, sd_samplers, processing, ui_extra_networks, ui_toprow, launch_utils
+from modules import sd_hijack, sd_models, script_callbacks, ui_extensions, deepbooru, postprocessing, extra_networks, ui_common, ui_postprocessing, progress, ui_loadsave, shared_items, ui_settings, timer, sysinfo, ui_checkpoint_merger, scripts, sd_samplers, processing, ui_extra_networks, ui_toprow, launch_utils
 from modules.ui_components import FormRow, FormGroup, ToolButton, FormHTML, InputAccordion, ResizeHandleRow
 from modules.paths import script_path
 from modules.ui_common import create_refresh_button
@@ -110,7 +110,7 @@ def resize_from_to_html(width, height, scale_by):
     return f"resize: from <span class='resolution'>{width}x{height}</span> to <span class='resolution'>{target_width}x{target_height}</span>"
 
 
-def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_dir, *ii_singles):
+def process_interrogate(interrogation_function, batch_interrogation_function, mode, ii_input_dir, ii_output_dir, *ii_singles):
     if mode in {0, 1, 3, 4}:
         return [interrogation_function(ii_singles[mode]), None]
     elif mode == 2:
@@ -124,11 +124,16 @@ def process_interrogate(interrogation_function, mode, ii_input_dir, ii_output_di
         else:
             ii_output_dir = ii_input_dir
 
-        for image in images:
-            img = Image.open(image)
-            filename = os.path.basename(image)
-            left, _ = os.path.splitext(filename)
-            print(interrogation_function(img), file=open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8'))
+        batch_size = max(1, shared.opts.interrogate_batch_size)
+
+        with postprocessing.models_resident():
+            for i in range(0, len(images), batch_size):
+                batch = images[i:i + batch_size]
+
+                for image, prompt in zip(batch, batch_interrogation_function([Image.open(x) for x in batch])):
+                    left, _ = os.path.splitext(os.path.basename(image))
+                    with open(os.path.join(ii_output_dir, f"{left}.txt"), 'a', encoding='utf-8') as file:
+                        print(prompt, file=file)
 
         return [gr.update(), None]
 
@@ -822,12 +827,12 @@ def create_ui():
             )
 
             toprow.button_interrogate.click(
-                fn=lambda *args: process_interrogate(interrogate, *args),
+                fn=lambda *args: process_interrogate(interrogate, shared.interrogator.interrogate_batch, *args),
                 **interrogate_args,
             )
 
             toprow.button_deepbooru.click(
-                fn=lambda *args: process_interrogate(interrogate_deepbooru, *args),
+                fn=lambda *args: process_interrogate(interrogate_deepbooru, deepbooru.model.tag_batch, *args),
                 **interrogate_args,
             )
 
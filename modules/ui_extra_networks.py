@@ -7,7 +7,7 @@ from pathlib import Path
 from typing import Optional, Union
 from dataclasses import dataclass
 
-from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util
+from modules import shared, ui_extra_networks_user_metadata, errors, extra_networks, util, safetensors_index
 from modules.images import read_info_from_image, save_image_with_geninfo
 import gradio as gr
 import json
@@ -663,7 +663,7 @@ class ExtraNetworksPage:
         """
 
         file = f"{path}.safetensors"
-        if self.lister.exists(file) and 'ssmd_cover_images' in metadata and len(list(filter(None, json.loads(metadata['ssmd_cover_images'])))) > 0:
+        if self.lister.exists(file) and 'ssmd_cover_images' in metadata and safetensors_index.get(file)["has_cover_images"]:
             return f"./sd_extra_networks/cover-images?page={self.extra_networks_tabname}&item={name}"
 
         return None
@@ -7,7 +7,7 @@ import gradio.components
 
 from PIL import PngImagePlugin
 
-from modules import shared
+from modules import shared, images
 
 
 Savedfile = namedtuple("Savedfile", ["name"])
@@ -33,6 +33,9 @@ def check_tmp_file(gradio, filename):
 
 def save_pil_to_file(self, pil_image, dir=None, format="png"):
     already_saved_as = getattr(pil_image, 'already_saved_as', None)
+    if already_saved_as:
+        images.background_saver.wait(already_saved_as)
+
     if already_saved_as and os.path.isfile(already_saved_as):
         register_tmp_file(shared.demo, already_saved_as)
         filename_with_mtime = f'{already_saved_as}?{os.path.getmtime(already_saved_as)}'
@@ -6,7 +6,7 @@ import torch
 import tqdm
 from PIL import Image
 
-from modules import devices, images, shared, torch_utils
+from modules import devices, shared, torch_utils
 
 logger = logging.getLogger(__name__)
 
@@ -38,14 +38,122 @@ def torch_bgr_to_pil_image(tensor: torch.Tensor) -> Image.Image:
 def upscale_pil_patch(model, img: Image.Image) -> Image.Image:
     """
     Upscale a given PIL image using the given model.
+    Kept for compatibility; this is `upscale_with_model` without tiling.
     """
-    param = torch_utils.get_param(model)
+    return upscale_with_model(model, img, tile_size=0)
 
-    with torch.inference_mode():
-        tensor = pil_image_to_torch_bgr(img).unsqueeze(0)  # add batch dimension
-        tensor = tensor.to(device=param.device, dtype=param.dtype)
+
+tile_bytes_per_input_pixel = 64 * 16 * 3
+"""rough estimate of how much memory an upscaler model needs for each pixel of its input, in units of model's element size: 4x models keep a few 64-channel tensors at output resolution"""
+
+
+def get_tile_batch_size(tile_size: int, tile_count: int, dtype: torch.dtype) -> int:
+    """Returns how many tiles are stacked for one forward pass: upscaler_tile_batch_size setting, or, if it's 0, as many as fit into free memory."""
+
+    if shared.opts.upscaler_tile_batch_size > 0:
+        return max(1, min(shared.opts.upscaler_tile_batch_size, tile_count))
+
+    from modules.sd_hijack_optimizations import get_available_vram
+
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    bytes_per_tile = tile_size * tile_size * tile_bytes_per_input_pixel * element_size
+
+    return max(1, min(tile_count, int(get_available_vram() // bytes_per_tile)))
+
+
+def tile_positions(size: int, tile_size: int, tile_overlap: int) -> list[int]:
+    stride = max(1, tile_size - tile_overlap)
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def feather_weights(size: int, overlap: int, *, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Returns a (size, size) tensor of blending weights for a tile: 1 in the middle, falling off linearly over overlap pixels
+    near the edges. Weights never reach 0, so a pixel covered by only one tile (near the edge of the image) keeps its value.
+    """
+
+    overlap = min(overlap, size // 2)
+    ramp = torch.ones(size, dtype=torch.float32)
+    if overlap > 0:
+        edge = torch.linspace(1 / (overlap + 1), overlap / (overlap + 1), overlap)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = torch.minimum(ramp[-overlap:], edge.flip(0))
+
+    return (ramp[:, None] * ramp[None, :]).to(device=device, dtype=dtype)
+
+
+def tiled_upscale(
+    img: torch.Tensor,
+    model: Callable[[torch.Tensor], torch.Tensor],
+    *,
+    tile_size: int,
+    tile_overlap: int,
+    device: torch.device,
+    dtype: torch.dtype | None = None,
+    desc="Tiled upscale",
+) -> torch.Tensor | None:
+    """
+    Upscales a BCHW tensor using model, running it on square tiles of tile_size pixels overlapping by tile_overlap pixels.
+    Several tiles are stacked into one batch for each forward pass (see `get_tile_batch_size`); if a batch does not fit
+    into memory, it's split in half and retried. Overlapping parts of tiles are blended using `feather_weights`.
+    Model's scale is determined from the size of its output. Returns None if interrupted.
+    """
+
+    dtype = dtype or img.dtype
+    b, c, h, w = img.size()
+
+    if tile_size <= 0 or (tile_size >= h and tile_size >= w):
+        logger.debug("Upscaling %s without tiling", img.shape)
         with devices.without_autocast():
-            return torch_bgr_to_pil_image(model(tensor))
+            return model(img.to(device=device, dtype=dtype))
+
+    tile_size = min(tile_size, h, w)
+    positions = [(y, x) for y in tile_positions(h, tile_size, tile_overlap) for x in tile_positions(w, tile_size, tile_overlap)]
+    batch_size = get_tile_batch_size(tile_size, len(positions), dtype)
+
+    result = None
+    weights = None
+    weight_tile = None
+    scale = 1
+
+    with tqdm.tqdm(total=len(positions), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
+        i = 0
+        while i < len(positions):
+            if shared.state.interrupted or shared.state.skipped:
+                return None
+
+            batch_positions = positions[i:i + batch_size]
+            in_patches = torch.cat([img[..., y:y + tile_size, x:x + tile_size] for y, x in batch_positions]).to(device=device, dtype=dtype)
+
+            try:
+                with devices.without_autocast():
+                    out_patches = model(in_patches)
+            except torch.cuda.OutOfMemoryError:
+                if batch_size == 1:
+                    raise
+
+                del in_patches
+                batch_size = max(1, batch_size // 2)
+                devices.torch_gc()
+                continue
+
+            if result is None:
+                scale = out_patches.shape[-1] // tile_size
+                result = torch.zeros((b, out_patches.shape[1], h * scale, w * scale), device=device, dtype=out_patches.dtype)
+                weights = torch.zeros((1, 1, h * scale, w * scale), device=device, dtype=out_patches.dtype)
+                weight_tile = feather_weights(tile_size * scale, tile_overlap * scale, device=device, dtype=out_patches.dtype)
+                logger.debug("Upscaling %s to %s with tiles, %d at a time", img.shape, result.shape, batch_size)
+
+            out_patches = out_patches.view(len(batch_positions), b, *out_patches.shape[1:])
+            for (y, x), out_patch in zip(batch_positions, out_patches):
+                region = (..., slice(y * scale, (y + tile_size) * scale), slice(x * scale, (x + tile_size) * scale))
+                result[region].addcmul_(out_patch, weight_tile)
+                weights[region].add_(weight_tile)
+
+            i += len(batch_positions)
+            pbar.update(len(batch_positions))
+
+    return result.div_(weights)
 
 
 def upscale_with_model(
@@ -56,36 +164,24 @@ def upscale_with_model(
     tile_overlap: int = 0,
     desc="tiled upscale",
 ) -> Image.Image:
-    if tile_size <= 0:
-        logger.debug("Upscaling %s without tiling", img)
-        output = upscale_pil_patch(model, img)
-        logger.debug("=> %s", output)
-        return output
-
-    grid = images.split_grid(img, tile_size, tile_size, tile_overlap)
-    newtiles = []
-
-    with tqdm.tqdm(total=grid.tile_count, desc=desc, disable=not shared.opts.enable_upscale_progressbar) as p:
-        for y, h, row in grid.tiles:
-            newrow = []
-            for x, w, tile in row:
-                if shared.state.interrupted:
-                    return img
-                output = upscale_pil_patch(model, tile)
-                scale_factor = output.width // tile.width
-                newrow.append([x * scale_factor, w * scale_factor, output])
-                p.update(1)
-            newtiles.append([y * scale_factor, h * scale_factor, newrow])
-
-    newgrid = images.Grid(
-        newtiles,
-        tile_w=grid.tile_w * scale_factor,
-        tile_h=grid.tile_h * scale_factor,
-        image_w=grid.image_w * scale_factor,
-        image_h=grid.image_h * scale_factor,
-        overlap=grid.overlap * scale_factor,
-    )
-    return images.combine_grid(newgrid)
+    param = torch_utils.get_param(model)
+    tensor = pil_image_to_torch_bgr(img).unsqueeze(0)  # add batch dimension
+
+    with torch.inference_mode():
+        output = tiled_upscale(
+            tensor,
+            model,
+            tile_size=tile_size,
+            tile_overlap=tile_overlap,
+            device=param.device,
+            dtype=param.dtype,
+            desc=desc,
+        )
+
+        if output is None:
+            return img
+
+        return torch_bgr_to_pil_image(output)
 
 
 def tiled_upscale_2(
@@ -98,68 +194,12 @@ def tiled_upscale_2(
     device: torch.device,
     desc="Tiled upscale",
 ):
-    # Alternative implementation of `upscale_with_model` originally used by
-    # SwinIR and ScuNET.  It differs from `upscale_with_model` in that tiling and
-    # weighting is done in PyTorch space, as opposed to `images.Grid` doing it in
-    # Pillow space without weighting.
-
-    b, c, h, w = img.size()
-    tile_size = min(tile_size, h, w)
-
-    if tile_size <= 0:
-        logger.debug("Upscaling %s without tiling", img.shape)
-        return model(img)
-
-    stride = tile_size - tile_overlap
-    h_idx_list = list(range(0, h - tile_size, stride)) + [h - tile_size]
-    w_idx_list = list(range(0, w - tile_size, stride)) + [w - tile_size]
-    result = torch.zeros(
-        b,
-        c,
-        h * scale,
-        w * scale,
-        device=device,
-        dtype=img.dtype,
-    )
-    weights = torch.zeros_like(result)
-    logger.debug("Upscaling %s to %s with tiles", img.shape, result.shape)
-    with tqdm.tqdm(total=len(h_idx_list) * len(w_idx_list), desc=desc, disable=not shared.opts.enable_upscale_progressbar) as pbar:
-        for h_idx in h_idx_list:
-            if shared.state.interrupted or shared.state.skipped:
-                break
-
-            for w_idx in w_idx_list:
-                if shared.state.interrupted or shared.state.skipped:
-                    break
+    # Kept for compatibility; `tiled_upscale` does the work and determines scale from model's output,
+    # so scale argument is not used. Unlike `tiled_upscale`, returns the input if interrupted.
 
-                # Only move this patch to the device if it's not already there.
-                in_patch = img[
-                    ...,
-                    h_idx : h_idx + tile_size,
-                    w_idx : w_idx + tile_size,
-                ].to(device=device)
+    output = tiled_upscale(img, model, tile_size=tile_size, tile_overlap=tile_overlap, device=device, desc=desc)
 
-                out_patch = model(in_patch)
-
-                result[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch)
-
-                out_patch_mask = torch.ones_like(out_patch)
-
-                weights[
-                    ...,
-                    h_idx * scale : (h_idx + tile_size) * scale,
-                    w_idx * scale : (w_idx + tile_size) * scale,
-                ].add_(out_patch_mask)
-
-                pbar.update(1)
-
-    output = result.div_(weights)
-
-    return output
+    return img if output is None else output
 
 
 def upscale_2(
@@ -168,23 +208,27 @@ def upscale_2(
     *,
     tile_size: int,
     tile_overlap: int,
-    scale: int,
+    scale: int = None,
     desc: str,
 ):
     """
-    Convenience wrapper around `tiled_upscale_2` that handles PIL images.
+    Convenience wrapper around `tiled_upscale` that handles PIL images.
+    scale is accepted for compatibility and not used: `tiled_upscale` determines it from model's output.
     """
     param = torch_utils.get_param(model)
     tensor = pil_image_to_torch_bgr(img).to(dtype=param.dtype).unsqueeze(0)  # add batch dimension
 
     with torch.no_grad():
-        output = tiled_upscale_2(
+        output = tiled_upscale(
             tensor,
             model,
             tile_size=tile_size,
             tile_overlap=tile_overlap,
-            scale=scale,
             desc=desc,
             device=param.device,
         )
+
+    if output is None:
+        return img
+
     return torch_bgr_to_pil_image(output)
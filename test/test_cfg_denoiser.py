@@ -0,0 +1,92 @@
+import time
+import types
+
+import pytest
+import torch
+
+
+class TimedModel:
+    """Stands in for UNet; keeps track of time spent in it, so that it can be subtracted from time spent in the denoiser."""
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self, x, sigma, cond):
+        start = time.perf_counter()
+        res = x * 0.5 + cond["c_crossattn"][0].mean(dim=(1, 2)).reshape(-1, 1, 1, 1)
+        self.time += time.perf_counter() - start
+
+        return res
+
+
+def create_denoiser(model, steps):
+    from modules import sd_samplers_cfg_denoiser
+
+    class Denoiser(sd_samplers_cfg_denoiser.CFGDenoiser):
+        @property
+        def inner_model(self):
+            return model
+
+    denoiser = Denoiser(types.SimpleNamespace(sampler_extra_args={}, last_latent=None))
+    denoiser.p = types.SimpleNamespace(refiner_checkpoint_info=None, refiner_switch_at=None, scripts=None, extra_generation_params={})
+    denoiser.total_steps = steps
+
+    return denoiser
+
+
+def run_denoiser(batch_size, steps, warmup=5):
+    """Returns average time per step, in seconds, that the denoiser spends outside of the model, and the output of the last step."""
+
+    from modules import prompt_parser
+
+    generator = torch.Generator().manual_seed(0)
+
+    def make_cond():
+        return torch.randn((77, 768), generator=generator)
+
+    cond = prompt_parser.MulticondLearnedConditioning(shape=(batch_size,), batch=[
+        [prompt_parser.ComposableScheduledPromptConditioning([prompt_parser.ScheduledPromptConditioning(steps, make_cond())])]
+        for _ in range(batch_size)
+    ])
+    uncond = [[prompt_parser.ScheduledPromptConditioning(steps, make_cond())] for _ in range(batch_size)]
+
+    x = torch.randn((batch_size, 4, 64, 64), generator=generator)
+    sigma = torch.full((batch_size,), 5.0)
+    image_cond = torch.zeros((batch_size, 5, 1, 1))
+
+    model = TimedModel()
+    denoiser = create_denoiser(model, steps)
+
+    for _ in range(warmup):
+        denoiser(x, sigma, uncond, cond, 7.0, 0.0, image_cond)
+
+    model.time = 0.0
+    start = time.perf_counter()
+
+    for _ in range(steps):
+        denoised = denoiser(x, sigma, uncond, cond, 7.0, 0.0, image_cond)
+
+    total = time.perf_counter() - start
+
+    return (total - model.time) / steps, denoised
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.parametrize("batch_cond_uncond", [True, False])
+def test_cfg_denoiser_overhead(monkeypatch, batch_cond_uncond):
+    """Microbenchmark: reports per-step time spent in CFGDenoiser outside of the model, with and without preallocated buffers; run with -s to see it."""
+
+    from modules import shared, sd_models
+
+    monkeypatch.setattr(sd_models.model_data, "sd_model", types.SimpleNamespace(cond_stage_key="crossattn", model=types.SimpleNamespace(conditioning_key="crossattn")))
+    monkeypatch.setattr(sd_models.model_data, "was_loaded_at_least_once", True)
+    monkeypatch.setitem(shared.opts.data, "batch_cond_uncond", batch_cond_uncond)
+
+    results = {}
+    for preallocate in [False, True]:
+        monkeypatch.setitem(shared.opts.data, "cfg_denoiser_preallocate", preallocate)
+        results[preallocate] = run_denoiser(batch_size=8, steps=40)
+
+        print(f"CFGDenoiser overhead, batch_cond_uncond={batch_cond_uncond}, preallocate={preallocate}: {results[preallocate][0] * 1e6:.1f} us/step")
+
+    assert torch.equal(results[False][1], results[True][1])
@@ -1,5 +1,10 @@
+import json
+import os
+
 import requests
 
+from test.conftest import test_files_path
+
 
 def test_simple_upscaling_performed(base_url, img2img_basic_image_base64):
     payload = {
@@ -20,6 +25,41 @@ def test_simple_upscaling_performed(base_url, img2img_basic_image_base64):
     assert requests.post(f"{base_url}/sdapi/v1/extra-single-image", json=payload).status_code == 200
 
 
+def test_batch_upscaling_streamed(base_url, img2img_basic_image_base64):
+    payload = {
+        "upscaling_resize": 2,
+        "upscaler_1": "Lanczos",
+        "imageList": [
+            {"data": img2img_basic_image_base64, "name": "first.png"},
+            {"data": img2img_basic_image_base64, "name": "second.png"},
+        ],
+    }
+    response = requests.post(f"{base_url}/sdapi/v1/extra-batch-images-stream", json=payload)
+    assert response.status_code == 200
+
+    items = [json.loads(line) for line in response.text.splitlines() if line]
+    assert [item["index"] for item in items] == [0, 1]
+    assert all(len(item["images"]) == 1 for item in items)
+
+
+def test_upscaling_with_binary_images(base_url):
+    with open(os.path.join(test_files_path, "img2img_basic.png"), "rb") as file:
+        response = requests.post(f"{base_url}/sdapi/v1/images", data=file.read())
+    assert response.status_code == 200
+
+    reference = response.json()["images"][0]
+    assert requests.get(f"{base_url}{reference}").status_code == 200
+
+    payload = {
+        "upscaling_resize": 2,
+        "upscaler_1": "Lanczos",
+        "image": reference,
+    }
+    response = requests.post(f"{base_url}/sdapi/v1/extra-single-image", json=payload, headers={"X-Image-Transport": "binary"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/form-data")
+
+
 def test_png_info_performed(base_url, img2img_basic_image_base64):
     payload = {
         "image": img2img_basic_image_base64,
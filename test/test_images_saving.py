@@ -0,0 +1,92 @@
+import os
+import threading
+
+import pytest
+from PIL import Image
+
+
+@pytest.mark.usefixtures("initialize")
+def test_background_saver_reserves_sequence_numbers(monkeypatch, tmp_path):
+    from modules import images, shared
+
+    monkeypatch.setitem(shared.opts.data, "save_images_async", True)
+    monkeypatch.setitem(shared.opts.data, "save_to_dirs", False)
+    monkeypatch.setitem(shared.opts.data, "samples_filename_pattern", "")
+    monkeypatch.setitem(shared.opts.data, "save_images_add_number", True)
+
+    release = threading.Event()
+    original_save = images.save_image_with_geninfo
+
+    def slow_save(*args, **kwargs):
+        release.wait(10)
+        return original_save(*args, **kwargs)
+
+    monkeypatch.setattr(images, "save_image_with_geninfo", slow_save)
+
+    image = Image.new("RGB", (64, 64))
+    first, _ = images.save_image(image, str(tmp_path), "", seed=1, prompt="a", extension="png")
+    second, _ = images.save_image(image, str(tmp_path), "", seed=2, prompt="b", extension="png")
+
+    assert first != second
+    assert not os.path.exists(first)
+    assert images.background_saver.is_pending(first)
+
+    release.set()
+    assert images.background_saver.flush(timeout=10)
+
+    assert os.path.isfile(first)
+    assert os.path.isfile(second)
+    assert not images.background_saver.is_pending(first)
+
+
+@pytest.mark.usefixtures("initialize")
+def test_sequence_numbers_scan_only_without_cache_entry(monkeypatch, tmp_path):
+    from modules import images, shared
+
+    monkeypatch.setitem(shared.opts.data, "save_images_sequence_cache", True)
+
+    store = {}
+    monkeypatch.setattr(images.cache, "cache", lambda subsection: store)
+
+    (tmp_path / "00041-123.png").touch()
+
+    scans = []
+    original_scan = images.get_next_sequence_number
+
+    def counting_scan(path, basename):
+        scans.append(path)
+        return original_scan(path, basename)
+
+    monkeypatch.setattr(images, "get_next_sequence_number", counting_scan)
+
+    assert images.sequence_numbers.next(str(tmp_path), "") == 42
+    assert images.sequence_numbers.next(str(tmp_path), "") == 43
+
+    images.sequence_numbers.used(str(tmp_path), "", 50)
+    assert images.sequence_numbers.next(str(tmp_path), "") == 51
+
+    assert len(scans) == 1
+
+
+@pytest.mark.usefixtures("initialize")
+def test_sequence_numbers_rescan_after_directory_changes(monkeypatch, tmp_path):
+    from modules import images, shared
+
+    monkeypatch.setitem(shared.opts.data, "save_images_sequence_cache", True)
+
+    store = {}
+    monkeypatch.setattr(images.cache, "cache", lambda subsection: store)
+
+    assert images.sequence_numbers.next(str(tmp_path), "") == 0
+
+    # own writes do not make the entry stale
+    (tmp_path / "00000-1.png").touch()
+    images.sequence_numbers.written(str(tmp_path), "")
+    assert images.sequence_numbers.next(str(tmp_path), "") == 1
+
+    # another process adds a file with a higher number
+    (tmp_path / "00100-2.png").touch()
+    stat = os.stat(tmp_path)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert images.sequence_numbers.next(str(tmp_path), "") == 101
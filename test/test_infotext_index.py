@@ -0,0 +1,88 @@
+import pytest
+
+
+@pytest.fixture
+def index(tmp_path):
+    from modules import infotext_index
+
+    return infotext_index.InfotextIndex(str(tmp_path / "index.npz"))
+
+
+def make_image(path, infotext):
+    from PIL import Image, PngImagePlugin
+
+    pnginfo = PngImagePlugin.PngInfo()
+    pnginfo.add_text("parameters", infotext)
+    Image.new("RGB", (8, 8)).save(path, pnginfo=pnginfo)
+
+
+infotext_a = """a cat
+Negative prompt: blurry
+Steps: 20, Sampler: Euler a, CFG scale: 7, Seed: 100, Size: 512x768, Model hash: aaaa, Model: modelA, Lora hashes: "cat: 1234, style: 5678\""""
+
+infotext_b = """a dog
+Steps: 30, Sampler: DPM++ 2M, CFG scale: 5.5, Seed: 200, Size: 1024x1024, Model hash: bbbb, Model: modelB"""
+
+
+@pytest.mark.usefixtures("initialize")
+def test_infotext_index_query(index, tmp_path):
+    make_image(tmp_path / "a.png", infotext_a)
+    make_image(tmp_path / "b.png", infotext_b)
+
+    assert index.refresh([str(tmp_path)]) == {"added": 2, "removed": 0, "total": 2}
+
+    total, entries = index.query(model_hash="aaaa")
+    assert total == 1
+    assert entries[0]["prompt"] == "a cat"
+    assert entries[0]["negative_prompt"] == "blurry"
+    assert (entries[0]["width"], entries[0]["height"], entries[0]["steps"]) == (512, 768, 20)
+
+    assert index.query(seed_min=150)[0] == 1
+    assert index.query(seed_min=50, seed_max=250)[0] == 2
+    assert index.query(prompt="dog")[1][0]["model"] == "modelB"
+    assert index.query(lora="cat")[0] == 1
+    assert index.query(lora="5678")[0] == 1
+    assert index.query(sampler="Euler")[0] == 0
+
+
+@pytest.mark.usefixtures("initialize")
+def test_infotext_index_is_incremental_and_persistent(index, tmp_path):
+    from modules import infotext_index
+
+    make_image(tmp_path / "a.png", infotext_a)
+    make_image(tmp_path / "b.png", infotext_b)
+    index.refresh([str(tmp_path)])
+
+    (tmp_path / "b.png").unlink()
+    assert index.refresh([str(tmp_path)]) == {"added": 0, "removed": 1, "total": 1}
+
+    reloaded = infotext_index.InfotextIndex(index.filename)
+    total, entries = reloaded.query()
+    assert total == 1
+    assert entries[0]["seed"] == 100
+    assert entries[0]["path"] == str(tmp_path / "a.png")
+
+
+@pytest.mark.usefixtures("initialize")
+def test_infotext_index_concurrent_saves(index, tmp_path):
+    import threading
+
+    from modules import infotext_index
+
+    make_image(tmp_path / "a.png", infotext_a)
+
+    def add_and_save(i):
+        for j in range(20):
+            index.add(str(tmp_path / "a.png"), infotext_b if (i + j) % 2 else infotext_a)
+            index.save()
+
+    threads = [threading.Thread(target=add_and_save, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    index.save()
+
+    assert infotext_index.InfotextIndex(index.filename).query()[0] == 1
+    assert not (tmp_path / "index.npz.tmp").exists()
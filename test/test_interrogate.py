@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+
+@pytest.fixture
+def ranking(monkeypatch):
+    """Returns a function that makes InterrogateModels with random text features for categories, and random normalized image features."""
+
+    from modules import interrogate, shared
+
+    monkeypatch.setitem(shared.opts.data, "interrogate_clip_dict_limit", 0)
+
+    generator = torch.Generator().manual_seed(0)
+
+    def normalized(*shape):
+        x = torch.randn(shape, generator=generator)
+        return x / x.norm(dim=-1, keepdim=True)
+
+    def make(categories, image_count):
+        models = interrogate.InterrogateModels("unused")
+        models.dtype = torch.float32
+        for cat in categories:
+            models.text_features[interrogate.items_hash(cat.items)] = normalized(len(cat.items), 16)
+
+        return models, normalized(image_count, 16)
+
+    return make
+
+
+@pytest.mark.usefixtures("initialize")
+def test_rank_categories_matches_per_category_ranking(ranking):
+    from modules import interrogate
+
+    categories = [
+        interrogate.Category(name="artists", topn=2, items=[f"artist {i}" for i in range(50)]),
+        interrogate.Category(name="mediums", topn=1, items=[f"medium {i}" for i in range(7)]),
+    ]
+
+    models, image_features = ranking(categories, 1)
+
+    res = models.rank_categories(image_features, categories)
+
+    for cat, matches in zip(categories, res):
+        probs = (100.0 * image_features @ models.text_features[interrogate.items_hash(cat.items)].T).softmax(dim=-1)[0]
+        top_probs, top_labels = probs.topk(cat.topn)
+
+        assert [match for match, _ in matches] == [cat.items[i] for i in top_labels.tolist()]
+        assert [score for _, score in matches] == pytest.approx((top_probs * 100).tolist())
+
+
+@pytest.mark.usefixtures("initialize")
+def test_rank_categories_batch_matches_single_image_ranking(ranking):
+    from modules import interrogate
+
+    categories = [
+        interrogate.Category(name="artists", topn=3, items=[f"artist {i}" for i in range(50)]),
+        interrogate.Category(name="flavors", topn=2, items=[f"flavor {i}" for i in range(20)]),
+    ]
+
+    models, image_features = ranking(categories, 5)
+
+    res = models.rank_categories_batch(image_features, categories)
+    expected = [models.rank_categories(image_features[i:i + 1], categories) for i in range(5)]
+
+    assert len(res) == len(expected)
+    for image_res, image_expected in zip(res, expected):
+        for matches, expected_matches in zip(image_res, image_expected):
+            assert [match for match, _ in matches] == [match for match, _ in expected_matches]
+            assert [score for _, score in matches] == pytest.approx([score for _, score in expected_matches])
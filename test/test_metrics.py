@@ -0,0 +1,42 @@
+from modules import metrics
+
+
+def test_counter_and_gauge_exposition():
+    counter = metrics.Counter("test_lookups_total", "Lookups", ["cache", "result"])
+    counter.inc(cache="hash", result="hit")
+    counter.inc(2, cache="hash", result="hit")
+    counter.inc(cache="a \"quoted\" name", result="miss")
+
+    gauge = metrics.Gauge("test_bytes", "Bytes")
+    gauge.set(1.5)
+
+    assert counter.exposition() == [
+        "# HELP test_lookups_total Lookups",
+        "# TYPE test_lookups_total counter",
+        'test_lookups_total{cache="hash",result="hit"} 3',
+        'test_lookups_total{cache="a \\"quoted\\" name",result="miss"} 1',
+    ]
+
+    assert gauge.exposition()[2:] == ["test_bytes 1.5"]
+
+
+def test_histogram_exposition():
+    histogram = metrics.Histogram("test_seconds", "Durations", ["phase"], buckets=[0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 3.0]:
+        histogram.observe(value, phase="unet")
+
+    assert histogram.exposition()[2:] == [
+        'test_seconds_bucket{phase="unet",le="0.1"} 2',
+        'test_seconds_bucket{phase="unet",le="1"} 3',
+        'test_seconds_bucket{phase="unet",le="+Inf"} 4',
+        'test_seconds_sum{phase="unet"} 3.65',
+        'test_seconds_count{phase="unet"} 4',
+    ]
+
+
+def test_register_returns_existing_metric():
+    a = metrics.counter("test_registered_total", "Registered", ["x"])
+    b = metrics.counter("test_registered_total", "Registered", ["x"])
+
+    assert a is b
+    assert "# TYPE test_registered_total counter" in metrics.exposition()
@@ -0,0 +1,41 @@
+import types
+
+import pytest
+import torch
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.parametrize("decode_batch_size", [2, 3, 4])
+def test_decode_latent_batch_recovers_from_nans_in_every_sample(monkeypatch, decode_batch_size):
+    from modules import devices, processing, shared
+
+    monkeypatch.setattr(devices, "dtype_vae", torch.float16)
+    monkeypatch.setattr(shared.cmd_opts, "disable_nan_check", False)
+    monkeypatch.setitem(shared.opts.data, "auto_vae_precision_bfloat16", False)
+    monkeypatch.setitem(shared.opts.data, "auto_vae_precision", True)
+    monkeypatch.setitem(shared.opts.data, "sd_vae_decode_batch_size", decode_batch_size)
+
+    decoded_batches = []
+
+    def decode_first_stage(model, x):
+        """Stands in for VAE that produces NaNs in half precision."""
+
+        decoded_batches.append((devices.dtype_vae, x.shape[0]))
+
+        res = x.float().repeat_interleave(2, dim=2).repeat_interleave(2, dim=3)[:, :3]
+        if devices.dtype_vae == torch.float16:
+            res = torch.full_like(res, float("nan"))
+
+        return res
+
+    monkeypatch.setattr(processing, "decode_first_stage", decode_first_stage)
+
+    model = types.SimpleNamespace(first_stage_model=torch.nn.Identity())
+    batch = torch.randn((4, 4, 8, 8))
+
+    samples = processing.decode_latent_batch(model, batch, check_for_nans=True)
+
+    assert devices.dtype_vae == torch.float32
+    assert len(samples) == 4
+    assert all(not torch.isnan(x).any() for x in samples)
+    assert sum(count for dtype, count in decoded_batches if dtype == torch.float32) == 4
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from modules import prompt_parser
+
+
+@pytest.mark.parametrize("as_dict", [False, True])
+def test_compiled_multicond_batch_matches_reconstruct(as_dict):
+    generator = torch.Generator().manual_seed(0)
+
+    def make_cond(chunks):
+        crossattn = torch.randn((77 * chunks, 16), generator=generator)
+        if as_dict:
+            return {"crossattn": crossattn, "vector": torch.randn((8,), generator=generator)}
+
+        return crossattn
+
+    def scheduled(*conds):
+        """conds are (end_at_step, number of chunks) tuples"""
+        return [prompt_parser.ScheduledPromptConditioning(end_at_step, make_cond(chunks)) for end_at_step, chunks in conds]
+
+    # like [short:very long prompt:0.5] in first prompt, AND with a second prompt, and a prompt without editing
+    c = prompt_parser.MulticondLearnedConditioning(shape=(2,), batch=[
+        [
+            prompt_parser.ComposableScheduledPromptConditioning(scheduled((5, 1), (10, 3)), 1.0),
+            prompt_parser.ComposableScheduledPromptConditioning(scheduled((7, 2), (10, 1)), 0.5),
+        ],
+        [
+            prompt_parser.ComposableScheduledPromptConditioning(scheduled((10, 1)), 1.0),
+        ],
+    ])
+
+    compiled = prompt_parser.CompiledMulticondBatch(c)
+
+    for step in range(12):
+        conds_list, tensor = compiled.get(step)
+        expected_conds_list, expected = prompt_parser.reconstruct_multicond_batch(c, step)
+
+        assert conds_list == expected_conds_list
+
+        if as_dict:
+            assert tensor.keys() == expected.keys()
+            assert tensor.shape == expected.shape
+            assert all(torch.equal(tensor[k], expected[k]) for k in expected)
+        else:
+            assert torch.equal(tensor, expected)
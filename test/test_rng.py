@@ -0,0 +1,44 @@
+import numpy as np
+import torch
+
+from modules import rng, rng_philox
+
+
+def test_philox_randn():
+    expected = np.array([
+        [-0.92466259, -0.42534415, -2.6438457, 0.14518388],
+        [-0.12086647, -0.57972564, -0.62285122, -0.32838709],
+        [-1.07454231, -0.36314407, -1.67105067, 2.26550497],
+    ], dtype=np.float32)
+
+    assert np.allclose(rng_philox.Generator(seed=0).randn(shape=(3, 4)), expected)
+
+
+def test_philox_randn_many():
+    seeds = [0, 1, 12345, 2 ** 32 + 7]
+
+    generators = [rng_philox.Generator(seed) for seed in seeds]
+    generators[1].randn((2, 5, 5))
+
+    expected = []
+    for seed, offset in zip(seeds, [0, 1, 0, 0]):
+        generator = rng_philox.Generator(seed)
+        generator.offset = offset
+        expected.append(generator.randn((4, 5, 5)))
+
+    res = rng_philox.randn_many(generators, (4, 5, 5))
+
+    assert np.array_equal(res, np.stack(expected))
+    assert [x.offset for x in generators] == [1, 2, 1, 1]
+
+
+def test_slerp_batch():
+    generator = torch.Generator().manual_seed(0)
+    low = torch.randn((3, 4, 8, 8), generator=generator)
+    high = torch.randn((3, 4, 8, 8), generator=generator)
+    high[1] = low[1] * 1.0001  # nearly identical vectors take the linear interpolation branch
+
+    res = rng.slerp_batch(0.3, low, high)
+    expected = torch.stack([rng.slerp(0.3, a, b) for a, b in zip(low, high)])
+
+    assert torch.equal(res, expected)
@@ -0,0 +1,86 @@
+import pytest
+import torch
+
+
+def toy_network():
+    """Stands in for VAE's encoder or decoder; 1x1 convolutions make every output pixel depend only on its input pixel and on GroupNorm statistics."""
+
+    torch.manual_seed(0)
+
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, kernel_size=1),
+        torch.nn.GroupNorm(4, 8),
+        torch.nn.SiLU(),
+        torch.nn.Conv2d(8, 8, kernel_size=1),
+        torch.nn.GroupNorm(2, 8),
+        torch.nn.Conv2d(8, 3, kernel_size=1),
+    ).eval()
+
+
+@pytest.mark.usefixtures("initialize")
+def test_tile_starts_and_blend_ramp():
+    from modules import sd_vae_tiled
+
+    assert sd_vae_tiled.tile_starts(8, 8, 2) == [0]
+    assert sd_vae_tiled.tile_starts(20, 8, 2) == [0, 6, 12]
+
+    ramp = sd_vae_tiled.blend_ramp(8, 2, True, True, device="cpu")
+    assert ramp.tolist() == pytest.approx([1 / 3, 2 / 3, 1, 1, 1, 1, 2 / 3, 1 / 3])
+
+    ramp = sd_vae_tiled.blend_ramp(8, 2, False, True, device="cpu")
+    assert ramp.tolist() == pytest.approx([1, 1, 1, 1, 1, 1, 2 / 3, 1 / 3])
+
+
+@pytest.mark.usefixtures("initialize")
+def test_tiled_forward_matches_untiled_with_full_size_stats(monkeypatch):
+    from modules import sd_vae_tiled
+
+    network = toy_network()
+    x = torch.randn((1, 3, 20, 14), generator=torch.Generator().manual_seed(1))
+
+    with torch.no_grad():
+        expected = network(x)
+
+        # record GroupNorm statistics from the input itself rather than from its downscaled copy
+        monkeypatch.setattr(torch.nn.functional, "interpolate", lambda x, size, mode: x)
+        res = sd_vae_tiled.tiled_forward(network.forward, network, x, scale_in=1, scale_out=1, tile_size=8, overlap=2)
+
+    assert res.shape == expected.shape
+    assert torch.allclose(res, expected, atol=1e-5)
+    assert not any("forward" in vars(module) for module in network.modules())
+
+
+@pytest.mark.usefixtures("initialize")
+def test_group_norm_stats_replay_recorded_statistics():
+    from modules import sd_vae_tiled
+
+    network = toy_network()
+    x = torch.randn((1, 3, 12, 12), generator=torch.Generator().manual_seed(2))
+
+    stats = sd_vae_tiled.GroupNormStats()
+    with torch.no_grad(), sd_vae_tiled.group_norm_override(network, stats):
+        expected = network(x)
+
+        stats.recording = False
+        stats.rewind()
+        tile = network(x[:, :, :6, :6])
+
+    assert torch.allclose(tile, expected[:, :, :6, :6], atol=1e-5)
+
+
+@pytest.mark.usefixtures("initialize")
+def test_tiled_forward_skips_tiling_for_single_tile():
+    from modules import sd_vae_tiled
+
+    calls = []
+
+    def forward(x):
+        calls.append(x)
+        return x * 2
+
+    x = torch.randn((1, 3, 64, 64))
+    res = sd_vae_tiled.tiled_forward(forward, torch.nn.Identity(), x, scale_in=8, scale_out=1, tile_size=8, overlap=2)
+
+    assert len(calls) == 1
+    assert calls[0] is x
+    assert torch.equal(res, x * 2)
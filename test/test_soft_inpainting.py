@@ -0,0 +1,118 @@
+import importlib.util
+import os
+import time
+
+import numpy as np
+import pytest
+
+from modules import paths_internal
+
+
+def load_soft_inpainting():
+    path = os.path.join(paths_internal.extensions_builtin_dir, "soft-inpainting", "scripts", "soft_inpainting.py")
+    spec = importlib.util.spec_from_file_location("soft_inpainting", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def weighted_histogram_filter_reference(img, kernel, kernel_center, percentile_min=0.0, percentile_max=1.0, min_width=1.0):
+    """The filter as it was written before it was vectorized: every pixel's neighbourhood is sorted and walked in Python."""
+
+    kernel_min = -np.array(kernel_center)
+    kernel_max = np.array(kernel.shape) - kernel_center
+
+    def single(idx):
+        idx = np.array(idx)
+        min_index = np.maximum(0, idx + kernel_min)
+        max_index = np.minimum(np.array(img.shape), idx + kernel_max)
+
+        values = []
+        for window_index in np.ndindex(tuple(max_index - min_index)):
+            image_index = np.array(window_index) + min_index
+            values.append((float(img[tuple(image_index)]), float(kernel[tuple(image_index - idx + kernel_center)])))
+
+        values.sort(key=lambda x: x[0])
+
+        stack = []
+        total = 0
+        for value, weight in values:
+            stack.append((value, total, total + weight))
+            total += weight
+
+        window_min = total * percentile_min
+        window_max = total * percentile_max
+
+        if window_max - window_min < min_width:
+            window_center = (window_min + window_max) / 2
+            window_min = window_center - min_width / 2
+            window_max = window_center + min_width / 2
+
+            if window_max > total:
+                window_max = total
+                window_min = total - min_width
+
+            if window_min < 0:
+                window_min = 0
+                window_max = min_width
+
+        res = 0
+        res_weight = 0
+        for value, start, end in stack:
+            if window_min >= end:
+                continue
+            if window_max <= start:
+                break
+
+            w = min(window_max, end) - max(window_min, start)
+            res += value * w
+            res_weight += w
+
+        return res / res_weight if res_weight != 0 else 0
+
+    img_out = img.copy()
+    for index in np.ndindex(img.shape):
+        img_out[index] = single(index)
+
+    return img_out
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.parametrize("percentile_min, percentile_max, min_width", [(0.9, 1.0, 1.0), (0.25, 0.75, 1.0), (0.0, 1.0, 1.0), (0.5, 0.5, 0.1)])
+def test_weighted_histogram_filter_matches_reference(percentile_min, percentile_max, min_width):
+    soft_inpainting = load_soft_inpainting()
+
+    img = np.random.default_rng(0).random((24, 20), dtype=np.float32)
+    img[5:9, 5:9] = 0.5  # equal values in a neighbourhood
+    kernel, kernel_center = soft_inpainting.get_gaussian_kernel(stddev_radius=1.5, max_radius=2)
+
+    res = soft_inpainting.weighted_histogram_filter(img, kernel, kernel_center, percentile_min, percentile_max, min_width)
+    expected = weighted_histogram_filter_reference(img, kernel, kernel_center, percentile_min, percentile_max, min_width)
+
+    assert res.dtype == img.dtype
+    assert np.allclose(res, expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.usefixtures("initialize")
+@pytest.mark.skipif(not os.environ.get("WEBUI_TEST_BENCHMARKS"), reason="benchmark; set WEBUI_TEST_BENCHMARKS=1 to run")
+def test_weighted_histogram_filter_speed():
+    """Microbenchmark: filters a latent-sized distance map of a 1024x1024 image the way soft inpainting does; run with -s to see timings."""
+
+    soft_inpainting = load_soft_inpainting()
+
+    img = np.random.default_rng(0).random((128, 128), dtype=np.float32)
+    kernel, kernel_center = soft_inpainting.get_gaussian_kernel(stddev_radius=1.5, max_radius=2)
+
+    def run(func):
+        start = time.perf_counter()
+        res = func(img, kernel, kernel_center, percentile_min=0.9, percentile_max=1, min_width=1)
+        res = func(res, kernel, kernel_center, percentile_min=0.25, percentile_max=0.75, min_width=1)
+        return time.perf_counter() - start, res
+
+    vectorized_time, res = run(soft_inpainting.weighted_histogram_filter)
+    reference_time, expected = run(weighted_histogram_filter_reference)
+
+    print(f"weighted_histogram_filter, 128x128: {vectorized_time * 1000:.1f} ms vectorized, {reference_time * 1000:.1f} ms per-pixel")
+
+    assert np.allclose(res, expected, rtol=1e-5, atol=1e-6)
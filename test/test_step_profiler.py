@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    from modules import shared, step_profiler
+
+    monkeypatch.setitem(shared.opts.data, "step_profiler_enable", True)
+    monkeypatch.setitem(shared.opts.data, "step_profiler_timing", "perf_counter")
+    monkeypatch.setitem(shared.opts.data, "step_profiler_window", 10)
+    monkeypatch.setattr(step_profiler, "histograms", {})
+
+    return step_profiler
+
+
+@pytest.mark.usefixtures("initialize")
+def test_spans_are_added_to_job(profiler):
+    @profiler.timed("test decorated")
+    def decorated():
+        return 1
+
+    with profiler.job() as profile:
+        for _ in range(2):
+            with profiler.span("test sleep"):
+                time.sleep(0.01)
+
+        assert decorated() == 1
+
+    assert profiler.current_job is None
+    assert profiler.last_job is profile
+
+    result = profile.result()
+    assert result["timing"] == "perf_counter"
+    assert result["components"]["test sleep"]["count"] == 2
+    assert result["components"]["test sleep"]["total"] >= 0.02
+    assert result["components"]["test decorated"]["count"] == 1
+    assert result["total"] >= result["components"]["test sleep"]["total"]
+
+    summary = profiler.summary()["components"]["test sleep"]
+    assert summary["count"] == 2
+    assert summary["window"] == 2
+    assert summary["buckets"]["+Inf"] == 2
+
+
+@pytest.mark.usefixtures("initialize")
+def test_spans_outside_of_job_are_not_recorded(profiler, monkeypatch):
+    with profiler.span("test outside"):
+        pass
+
+    assert "test outside" not in profiler.summary()["components"]
+
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "step_profiler_enable", False)
+    with profiler.job() as profile:
+        assert profile is None
+
+
+@pytest.mark.usefixtures("initialize")
+def test_invalid_window_does_not_break_recording(profiler, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "step_profiler_window", -5)
+
+    with profiler.job():
+        for _ in range(3):
+            with profiler.span("test window"):
+                pass
+
+    summary = profiler.summary()["components"]["test window"]
+    assert summary["count"] == 3
+    assert summary["window"] == 1
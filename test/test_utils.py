@@ -23,6 +23,8 @@ def test_options_write(base_url):
     "sdapi/v1/samplers",
     "sdapi/v1/upscalers",
     "sdapi/v1/sd-models",
+    "sdapi/v1/sd-models/hash-progress",
+    "sdapi/v1/sd-models/residency",
     "sdapi/v1/hypernetworks",
     "sdapi/v1/face-restorers",
     "sdapi/v1/realesrgan-models",